@@ -0,0 +1,57 @@
+#!/env/python
+"""
+Measures the peak RSS of holding the accepted variants of a large case, either as tuples pointing into the parsed
+report events or as AcceptedVariant records. Every measurement runs in its own process so peaks do not add up.
+"""
+import argparse
+import multiprocessing
+import random
+import resource
+
+from protocols.cva_1_0_0 import ReportEventEntry
+from gel2decipher.case_sender import Gel2Decipher, AcceptedVariant
+
+from synthetic import synthetic_report_event
+
+
+def accept(report_event_json, proband_id, records):
+    report_event = ReportEventEntry.fromJsonDict(report_event_json)
+    proband_ov = Gel2Decipher._get_proband_observed_variant(report_event.observedVariants, proband_id=proband_id)
+    grch37_variant = Gel2Decipher._get_variant_representation_grch37(proband_ov)
+    if records:
+        return AcceptedVariant(report_event, grch37_variant, proband_ov.variantCall)
+    return grch37_variant, report_event, proband_ov.variantCall
+
+
+def measure(args):
+    events, family_size, transcripts, records = args
+    random.seed(1)
+    participant_ids = ["proband"] + ["member{}".format(i) for i in range(family_size - 1)]
+    accepted = [accept(synthetic_report_event(participant_ids, transcripts), "proband", records)
+                for _ in range(events)]
+    # ru_maxrss is in kilobytes on Linux
+    return len(accepted), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak RSS of the accepted variants of a case')
+    parser.add_argument('--events', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--family-size', type=int, default=3)
+    parser.add_argument('--transcripts', type=int, default=20)
+    args = parser.parse_args()
+
+    print "events\ttuples_peak_rss_mb\trecords_peak_rss_mb"
+    for events in args.events:
+        peaks = []
+        for records in [False, True]:
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            try:
+                _, peak = pool.apply(measure, ((events, args.family_size, args.transcripts, records),))
+            finally:
+                pool.terminate()
+            peaks.append(peak / 1024.0)
+        print "{}\t{:.1f}\t{:.1f}".format(events, peaks[0], peaks[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/env/python
+"""
+Benchmarks the bytes on the wire and the latency of posting batches of variants with and without request body
+compression. Requests are sent with the RestClient to a local server that throttles its reads to emulate the
+bandwidth of the link to Decipher.
+"""
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from StringIO import StringIO
+
+from gel2decipher.clients.rest_client import RestClient
+
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+
+    bandwidth = None        # bytes per second
+    received_bytes = []
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length'))
+        body = self.rfile.read(length)
+        ThrottledHandler.received_bytes.append(length)
+        time.sleep(float(length) / self.bandwidth)
+        if self.headers.getheader('content-encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        snvs = json.loads(body)
+        response = json.dumps([{"patient_snv_id": i} for i, _ in enumerate(snvs)])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def random_snv(patient_id):
+    alleles = ["A", "C", "G", "T"]
+    return {
+        "patient_id": patient_id,
+        "assembly": "GRCh37/hg19",
+        "chr": str(random.randint(1, 22)),
+        "start": random.randint(1, 200000000),
+        "ref_allele": random.choice(alleles),
+        "alt_allele": random.choice(alleles),
+        "genotype": random.choice(["Heterozygous", "Homozygous"]),
+        "intergenic": False,
+        "inheritance": "Unknown",
+        "user_transcript": "ENST{:011d}".format(random.randint(1, 600000)),
+        "user_gene": "GENE{}".format(random.randint(1, 20000))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks request body compression for batches of variants')
+    parser.add_argument('--batch-sizes', help='Number of variants per batch', nargs='+', type=int,
+                        default=[100, 1000, 10000])
+    parser.add_argument('--bandwidth-mbps', help='Emulated bandwidth in megabits per second', type=float, default=10)
+    parser.add_argument('--repetitions', help='Repetitions per batch size', type=int, default=5)
+    args = parser.parse_args()
+
+    ThrottledHandler.bandwidth = args.bandwidth_mbps * 1000 * 1000 / 8
+    server = HTTPServer(('localhost', 0), ThrottledHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url_base = "http://localhost:{}/".format(server.server_port)
+
+    print "{:>10} {:>10} {:>14} {:>14}".format("batch", "compress", "bytes", "latency (ms)")
+    for batch_size in args.batch_sizes:
+        snvs = [random_snv(12345) for _ in range(batch_size)]
+        for compress in [False, True]:
+            client = RestClient(url_base, compress_requests=compress)
+            ThrottledHandler.received_bytes = []
+            start = time.time()
+            for _ in range(args.repetitions):
+                client.post("patients/12345/snvs", payload=snvs)
+            latency = (time.time() - start) * 1000 / args.repetitions
+            print "{:>10} {:>10} {:>14} {:>14.1f}".format(
+                batch_size, str(compress), ThrottledHandler.received_bytes[0], latency)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
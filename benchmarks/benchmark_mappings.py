@@ -0,0 +1,147 @@
+#!/env/python
+"""
+Microbenchmarks of the CPU bound mappings at several scales over synthetic pedigrees and report events. Results are
+written as JSON so two runs can be compared with --compare to spot regressions.
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import timeit
+
+from protocols.cva_1_0_0 import ReportEventEntry
+import gel2decipher.models.gel2decipher_mappings as gel2decipher
+from gel2decipher.models.decipher_models import Patient, Snv, Phenotype
+from gel2decipher.case_sender import Gel2Decipher, AcceptedVariant
+
+from synthetic import synthetic_pedigree, synthetic_report_events
+
+
+def time_call(func, repeat, min_seconds):
+    """
+    :return: the best time per call over several repetitions and the number of calls per repetition
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_seconds:
+        number *= 10
+    return min(timer.repeat(repeat, number)) / number, number
+
+
+def pedigree_benchmarks(scales):
+    # the lambdas bind their data as default arguments as they are run after the generator is exhausted
+    for hpo_terms in scales:
+        member = synthetic_pedigree(1, hpo_terms)[0]
+        yield "map_pedigree_member_to_patient", hpo_terms, \
+            lambda member=member: gel2decipher.map_pedigree_member_to_patient(member, 1, 1)
+        yield "obfuscate_pedigree_member", hpo_terms, \
+            lambda member=member: gel2decipher.obfuscate_pedigree_member(member)
+        yield "map_pedigree_member_phenotypes", hpo_terms, \
+            lambda member=member: Gel2Decipher._map_pedigree_member_phenotypes(member, True)
+    member = synthetic_pedigree(4, 1)[3]
+    phenotype = member.hpoTermList[0]
+    yield "map_pedigree_member_to_person", 1, lambda: gel2decipher.map_pedigree_member_to_person(member, 1, "Son")
+    yield "map_phenotype", 1, lambda: gel2decipher.map_phenotype(phenotype, 1)
+    yield "hash_id", 1, lambda: gel2decipher.hash_id(member.participantId)
+
+
+def report_event_benchmarks(scales):
+    for family_size in scales:
+        participant_ids = ["11{:07d}".format(index) for index in range(family_size)]
+        report_event = ReportEventEntry.fromJsonDict(
+            synthetic_report_events(1, 1, participant_ids=participant_ids)[0])
+        # the proband is searched last, the worst case
+        proband_id = participant_ids[-1]
+        yield "get_proband_observed_variant", family_size, \
+            lambda observed_variants=report_event.observedVariants, proband_id=proband_id: \
+            Gel2Decipher._get_proband_observed_variant(observed_variants, proband_id)
+    for transcripts in scales:
+        report_event = ReportEventEntry.fromJsonDict(synthetic_report_events(1, transcripts)[0])
+        observed_variant = report_event.observedVariants[0]
+        grch37_variant = Gel2Decipher._get_variant_representation_grch37(observed_variant)
+        gene_symbols = [entity.geneSymbol for entity in report_event.reportEvent.genomicEntities]
+        consequence_types = grch37_variant.annotation.consequenceTypes
+        tier = report_event.reportEvent.tier
+        yield "select_consequence_type", transcripts, \
+            lambda consequence_types=consequence_types, gene_symbols=gene_symbols, tier=tier: \
+            Gel2Decipher._select_consequence_type(consequence_types, gene_symbols, tier)
+        variant_call = observed_variant.variantCall
+        yield "accepted_variant", transcripts, \
+            lambda report_event=report_event, grch37_variant=grch37_variant, variant_call=variant_call: \
+            AcceptedVariant(report_event, grch37_variant, variant_call)
+    accepted_variant = AcceptedVariant(report_event, grch37_variant, observed_variant.variantCall)
+    consequence_type = Gel2Decipher._select_consequence_type(consequence_types, gene_symbols, tier)
+    yield "map_report_event", 1, lambda: gel2decipher.map_report_event(
+        report_event.reportEvent, grch37_variant, observed_variant.variantCall, consequence_type, 1)
+    yield "map_accepted_variant", 1, lambda: gel2decipher.map_accepted_variant(accepted_variant, consequence_type, 1)
+
+
+def model_benchmarks():
+    member = synthetic_pedigree(1, 10)[0]
+    patient = dict(gel2decipher.map_pedigree_member_to_patient(member, 1, 1))
+    report_event = ReportEventEntry.fromJsonDict(synthetic_report_events(1, 5)[0])
+    observed_variant = report_event.observedVariants[0]
+    grch37_variant = Gel2Decipher._get_variant_representation_grch37(observed_variant)
+    consequence_type = grch37_variant.annotation.consequenceTypes[0]
+    snv = dict(gel2decipher.map_report_event(
+        report_event.reportEvent, grch37_variant, observed_variant.variantCall, consequence_type, 1))
+    yield "validate_patient", 1, lambda: Patient(**patient).validate()
+    yield "validate_snv", 1, lambda: Snv(**snv).validate()
+    yield "validate_phenotype", 1, lambda: Phenotype(person_id=1, phenotype_id=1234, observation="present").validate()
+
+
+def compare(results, previous_file, threshold):
+    with open(previous_file) as previous:
+        previous_results = dict(((result['benchmark'], result['scale']), result['seconds_per_call'])
+                                for result in json.load(previous)['results'])
+    regressions = 0
+    print "benchmark\tscale\tprevious_us\tcurrent_us\tratio"
+    for result in results:
+        before = previous_results.get((result['benchmark'], result['scale']))
+        if before is None:
+            continue
+        ratio = result['seconds_per_call'] / before
+        flag = " REGRESSION" if ratio > 1 + threshold else ""
+        regressions += 1 if flag else 0
+        print "{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}{}".format(
+            result['benchmark'], result['scale'], before * 1e6, result['seconds_per_call'] * 1e6, ratio, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the mappings')
+    parser.add_argument('--scales', type=int, nargs='+', default=[5, 50, 500],
+                        help="Number of HPO terms, family members and transcripts")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-seconds', type=float, default=0.2, help="Minimum duration of a repetition")
+    parser.add_argument('--only', help="Runs the benchmarks with this text in their name")
+    parser.add_argument('--output', default="benchmark_mappings.json")
+    parser.add_argument('--compare', help="Results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Slowdown reported as a regression")
+    args = parser.parse_args()
+    # the mappings log every call
+    logging.disable(logging.CRITICAL)
+
+    benchmarks = list(pedigree_benchmarks(args.scales)) + list(report_event_benchmarks(args.scales)) + \
+        list(model_benchmarks())
+    results = []
+    for name, scale, func in benchmarks:
+        if args.only and args.only not in name:
+            continue
+        seconds_per_call, calls = time_call(func, args.repeat, args.min_seconds)
+        results.append({'benchmark': name, 'scale': scale, 'seconds_per_call': seconds_per_call,
+                        'calls_per_repeat': calls, 'repeat': args.repeat})
+        sys.stderr.write("{}\t{}\t{:.2f} us\n".format(name, scale, seconds_per_call * 1e6))
+
+    with open(args.output, "w") as output:
+        json.dump({'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+                   'platform': platform.platform(), 'results': results}, output, indent=2)
+    if args.compare:
+        if compare(results, args.compare, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
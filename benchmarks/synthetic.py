@@ -0,0 +1,110 @@
+"""
+Generates synthetic pedigrees and report events shaped like those returned by the CIPAPI and CVA, for benchmarks.
+The generation is seeded so every run produces the same data.
+"""
+import random
+
+from protocols.participant_1_0_3 import PedigreeMember, HpoTerm, ConsentStatus
+
+
+ZYGOSITIES = ["heterozygous", "alternate_homozygous", "alternate_hemizygous", "reference_homozygous"]
+SEGREGATIONS = ["deNovo", "SimpleRecessive", "CompoundHeterozygous", "XLinkedMonoallelic",
+                "InheritedAutosomalDominant"]
+TIER1_SO_TERMS = ["SO:0001893", "SO:0001574", "SO:0001575", "SO:0001587", "SO:0001589", "SO:0001578", "SO:0001582"]
+TIER2_SO_TERMS = ["SO:0001889", "SO:0001821", "SO:0001822", "SO:0001583", "SO:0001630", "SO:0001626"]
+BIOTYPES = ["protein_coding", "nonsense_mediated_decay", "processed_transcript", "retained_intron"]
+
+
+def synthetic_pedigree_member(index, hpo_terms, rng=random):
+    """
+    :param index: the position of the member in the pedigree, the proband is 0 and its parents 1 and 2
+    :param hpo_terms: the number of HPO terms
+    :rtype: PedigreeMember
+    """
+    participant_id = "11{:07d}".format(index)
+    return PedigreeMember(
+        pedigreeId=index + 1,
+        isProband=index == 0,
+        participantId=participant_id,
+        gelSuperFamilyId="FAM1",
+        sex=rng.choice(["MALE", "FEMALE"]) if index > 2 else ["MALE", "MALE", "FEMALE"][index],
+        personKaryotypicSex=rng.choice(["XX", "XY", "XXY", "UNKNOWN"]),
+        yearOfBirth=rng.randint(1940, 2015),
+        fatherId=2 if index == 0 else None,
+        motherId=3 if index == 0 else None,
+        superFatherId=None,
+        superMotherId=None,
+        affectionStatus=rng.choice(["AFFECTED", "UNAFFECTED", "UNCERTAIN"]),
+        consentStatus=ConsentStatus(programmeConsent=True, primaryFindingConsent=True,
+                                    secondaryFindingConsent=rng.choice([True, False]), carrierStatusConsent=False),
+        hpoTermList=[HpoTerm(term="HP:{:07d}".format(rng.randint(1, 3000000)),
+                             termPresence=rng.choice(["yes", "no", "unknown"])) for _ in range(hpo_terms)]
+    )
+
+
+def synthetic_pedigree(members, hpo_terms, seed=1):
+    """
+    :param members: the number of members, the first is the proband
+    :param hpo_terms: the number of HPO terms of every member
+    :rtype: list
+    """
+    rng = random.Random(seed)
+    return [synthetic_pedigree_member(index, hpo_terms, rng) for index in range(members)]
+
+
+def synthetic_consequence_type(gene_name, rng=random):
+    return {
+        'geneName': gene_name,
+        'ensemblGeneId': "ENSG{:011d}".format(rng.randint(1, 60000)),
+        'ensemblTranscriptId': "ENST{:011d}".format(rng.randint(1, 600000)),
+        'biotype': rng.choice(BIOTYPES),
+        'transcriptAnnotationFlags': rng.choice([["basic"], ["basic", "CCDS"], []]),
+        'sequenceOntologyTerms': [{'accession': rng.choice(TIER1_SO_TERMS + TIER2_SO_TERMS), 'name': "synthetic"}]
+    }
+
+
+def synthetic_report_event(participant_ids, transcripts, rng=random):
+    """
+    A raw report event with an observed variant for every participant and annotations with many transcripts
+    :param participant_ids: the participants with a call, the first is the proband
+    :param transcripts: the number of consequence types of the variant
+    :rtype: dict
+    """
+    gene_names = ["GENE{}".format(rng.randint(1, 20000)) for _ in range(3)]
+    variant = {
+        'chromosome': str(rng.randint(1, 22)),
+        'start': rng.randint(1, 200000000),
+        'reference': rng.choice("ACGT"),
+        'alternate': rng.choice("ACGT"),
+        'annotation': {'consequenceTypes': [
+            synthetic_consequence_type(rng.choice(gene_names), rng) for _ in range(transcripts)]}
+    }
+    tier = rng.choice(["TIER1", "TIER2"])
+    # a transcript that always passes the selection
+    variant['annotation']['consequenceTypes'][0].update({
+        'geneName': gene_names[0], 'biotype': "protein_coding", 'transcriptAnnotationFlags': ["basic"],
+        'sequenceOntologyTerms': [{'accession': (TIER1_SO_TERMS if tier == "TIER1" else TIER2_SO_TERMS)[0],
+                                   'name': "synthetic"}]})
+    return {
+        'reportEvent': {
+            'tier': tier,
+            'eventJustification': "Classified as: {}, passed the {} segregation filter".format(
+                tier.capitalize(), rng.choice(SEGREGATIONS)),
+            'genomicEntities': [{'geneSymbol': gene_names[0]}]
+        },
+        'observedVariants': [{
+            'variantCall': {'participantId': participant_id, 'sampleId': participant_id,
+                            'zygosity': rng.choice(ZYGOSITIES)},
+            'variant': {'variants': [{'assembly': "GRCh37", 'variant': variant}]}
+        } for participant_id in participant_ids]
+    }
+
+
+def synthetic_report_events(variants, transcripts, participant_ids=("110000000",), seed=1):
+    """
+    :param variants: the number of report events
+    :param transcripts: the number of consequence types of every variant
+    :rtype: list
+    """
+    rng = random.Random(seed)
+    return [synthetic_report_event(list(participant_ids), transcripts, rng) for _ in range(variants)]
@@ -0,0 +1,78 @@
+import logging
+from datetime import datetime
+from pycipapi.cipapi_client import CipApiClient
+from gel2decipher_sender.clients.rest_client import prefetch_pages
+
+
+class CaseDiscovery(object):
+
+    IR_ENDPOINT = "api/2/interpretation-request"
+    PAGE_SIZE = 100
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+    def __init__(self, cipapi, page_size=PAGE_SIZE):
+        """
+        Lists the interpretation requests in the CIPAPI matching some filters
+        :type cipapi: CipApiClient
+        :type page_size: int
+        """
+        self.cipapi = cipapi
+        self.page_size = page_size
+
+    def _get_page(self, url_params):
+        return self.cipapi.get(self.IR_ENDPOINT, url_params=url_params)
+
+    @staticmethod
+    def _next_page_params(url_params, response):
+        if response.get('next') is None:
+            return None
+        url_params = dict(url_params)
+        url_params['page'] += 1
+        return url_params
+
+    def _get_pages(self, url_params):
+        """
+        Iterates over the pages of interpretation requests while the next page is being fetched in the background
+        :type url_params: dict
+        :rtype: collections.Iterable[list]
+        """
+        url_params = dict(url_params)
+        url_params['page'] = 1
+        url_params['page_size'] = self.page_size
+        for response in prefetch_pages(self._get_page, CaseDiscovery._next_page_params, url_params):
+            yield response.get('results', [])
+
+    @staticmethod
+    def _parse_date(date):
+        # ignores microseconds and timezone, CIPAPI dates are in UTC
+        return datetime.strptime(date[:19], CaseDiscovery.DATE_FORMAT) if date else None
+
+    def discover_cases(self, status=None, programme=None, from_date=None, to_date=None):
+        """
+        The status and programme are filtered by the CIPAPI while the date window is applied on the last modification
+        date of each interpretation request.
+        :param status: the last status of the case (eg: sent_to_gmcs)
+        :type status: str
+        :param programme: the programme of the case (eg: rare_disease)
+        :type programme: str
+        :type from_date: datetime
+        :type to_date: datetime
+        :return: iterates over (case_id, case_version)
+        """
+        url_params = {}
+        if status is not None:
+            url_params['last_status'] = status
+        if programme is not None:
+            url_params['program'] = programme
+        discovered = 0
+        for results in self._get_pages(url_params):
+            for interpretation_request in results:
+                last_modified = CaseDiscovery._parse_date(interpretation_request.get('last_modified'))
+                if from_date is not None and (last_modified is None or last_modified < from_date):
+                    continue
+                if to_date is not None and (last_modified is None or last_modified > to_date):
+                    continue
+                discovered += 1
+                yield str(interpretation_request['interpretation_request_id']), \
+                    str(interpretation_request['version'])
+        logging.info("Discovered {} cases in the CIPAPI".format(discovered))
@@ -0,0 +1,145 @@
+import csv
+import logging
+import numpy
+from multiprocessing.pool import ThreadPool
+import gel2decipher_sender.models.gel2decipher_mappings as gel2decipher
+from gel2decipher_sender.models.decipher_models import Phenotype
+from gel2decipher_sender.report_event_columns import ReportEventColumns
+from gel2decipher_sender.case_sender import Gel2Decipher
+
+
+class CasePreScan(object):
+    """
+    Checks a list of cases before sending them, with report events fetched without annotations. A case is a no-go
+    when sending it would fail: a report event without a call for the proband, no variant in GRCh37, a proband
+    genotype Decipher does not accept or a pedigree that does not map into valid Decipher models. Nothing is written
+    to Decipher.
+    """
+
+    GO = "go"
+    NO_GO = "no-go"
+    FIELDS = ["case_id", "case_version", "decision", "report_events", "grch37_events", "unmappable_genotypes",
+              "members", "hpo_terms", "reasons"]
+    PLACEHOLDER_ID = 0
+
+    def __init__(self, sender, workers=8):
+        """
+        :type sender: Gel2Decipher
+        :param workers: the number of threads fetching cases
+        """
+        self.sender = sender
+        self.workers = workers
+
+    def _check_pedigree(self, pedigree):
+        """
+        Maps the pedigree as map_case does and validates the Decipher models, persons and phenotypes are given a
+        placeholder id as their patient does not exist yet
+        :return: the reason why the pedigree cannot be sent or None
+        """
+        options = self.sender.mapping_options()
+        try:
+            proband = pedigree.get_proband()
+            nuclear_family = [member.pedigreeId for member in
+                              [proband, pedigree.get_father(proband), pedigree.get_mother(proband)]
+                              if member is not None]
+            models = [gel2decipher.map_pedigree_member_to_patient(
+                proband, options['project_id'], options['user_id'])]
+            for member in pedigree.members:
+                if member.pedigreeId not in nuclear_family:
+                    models.append(gel2decipher.map_pedigree_member_to_person(
+                        member, self.PLACEHOLDER_ID, pedigree.get_relationship(member.pedigreeId, proband.pedigreeId)))
+                for phenotype in Gel2Decipher._map_pedigree_member_phenotypes(
+                        member, options['send_absent_phenotypes'], options['hpo_index'], options['migrate_hpo_terms']):
+                    models.append(Phenotype(person_id=self.PLACEHOLDER_ID, phenotype_id=phenotype['phenotype_id'],
+                                            observation=phenotype['observation']))
+        except Exception, ex:
+            return "unmappable pedigree: {}".format(str(ex))
+        validation_errors = ["{} {}".format(type(model).__name__, dict(model.validation_errors))
+                             for model in models if not model.is_valid]
+        if validation_errors:
+            return "invalid pedigree: {}".format(", ".join(validation_errors))
+        return None
+
+    def _fetch(self, case):
+        case_id, case_version = case
+        try:
+            fetched_case = self.sender.fetch_case(case_id, case_version, full_populate=False)
+        except Exception, ex:
+            logging.error("Failed fetching case id={} and version={}: {}".format(case_id, case_version, str(ex)))
+            return {'case_id': case_id, 'case_version': case_version, 'report_events': [], 'members': 0,
+                    'hpo_terms': 0, 'error': "fetch failed: {}".format(str(ex))}
+        pedigree = fetched_case['pedigree']
+        members = pedigree.members if pedigree is not None else []
+        return {'case_id': case_id, 'case_version': case_version, 'report_events': fetched_case['report_events'],
+                'members': len(members), 'hpo_terms': sum(len(member.hpoTermList or []) for member in members),
+                'error': self._check_pedigree(pedigree)}
+
+    def scan(self, cases):
+        """
+        :param cases: the (case_id, case_version) to check
+        :return: one row per case with the fields in FIELDS
+        :rtype: list
+        """
+        errors = []
+        pedigree_sizes = []
+
+        def fetched_cases():
+            pool = ThreadPool(self.workers)
+            try:
+                for fetched_case in pool.imap(self._fetch, cases):
+                    errors.append(fetched_case['error'])
+                    pedigree_sizes.append((fetched_case['members'], fetched_case['hpo_terms']))
+                    yield fetched_case
+            finally:
+                pool.terminate()
+        columns = ReportEventColumns.from_fetched_cases(fetched_cases())
+        # the same checks as map_case and Decipher, vectorised across every report event
+        called = columns.has_proband_call
+        grch37 = called & columns.has_grch37
+        report_events = columns.count_by_case()
+        missing_calls = columns.count_by_case(~called)
+        grch37_events = columns.count_by_case(grch37)
+        unmappable = columns.count_by_case(grch37 & ~columns.mappable_genotype())
+        go = (missing_calls == 0) & (grch37_events > 0) & (unmappable == 0) & \
+            numpy.array([error is None for error in errors], dtype=numpy.bool_)
+
+        rows = []
+        for index, (case_id, case_version) in enumerate(columns.case_ids):
+            reasons = [errors[index]] if errors[index] is not None else []
+            if missing_calls[index] > 0:
+                reasons.append("{} report events without a proband call".format(missing_calls[index]))
+            if grch37_events[index] == 0:
+                reasons.append("no variants in GRCh37")
+            if unmappable[index] > 0:
+                reasons.append("{} genotypes not accepted by Decipher".format(unmappable[index]))
+            rows.append({
+                'case_id': case_id,
+                'case_version': case_version,
+                'decision': self.GO if go[index] else self.NO_GO,
+                'report_events': int(report_events[index]),
+                'grch37_events': int(grch37_events[index]),
+                'unmappable_genotypes': int(unmappable[index]),
+                'members': pedigree_sizes[index][0],
+                'hpo_terms': pedigree_sizes[index][1],
+                'reasons': "; ".join(reasons)
+            })
+        logging.info("Pre-scanned {} cases, {} go".format(len(rows), int(go.sum())))
+        return rows
+
+    @staticmethod
+    def write_table(rows, output_file):
+        """
+        Writes the go/no-go table as tab separated values
+        """
+        with open(output_file, "wb") as output:
+            writer = csv.DictWriter(output, fieldnames=CasePreScan.FIELDS, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(rows)
+
+    @staticmethod
+    def go_cases(rows):
+        """
+        :return: the (case_id, case_version) that can be sent
+        :rtype: list
+        """
+        return [(row['case_id'], row['case_version']) for row in rows if row['decision'] == CasePreScan.GO]
@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import logging
+import threading
+
+
+class CaseScheduler(object):
+    """
+    Orders the cases to send by their estimated cost, shortest first, so a few huge cases do not hold back many small
+    ones. Every case is added before the first one is taken, so no new small case can hold back a large one forever.
+    Cases costing more than huge_cost go to their own lane, served first by the workers dedicated to it so huge cases
+    run alongside the small ones instead of after them. Cases without a known cost are scheduled in the order they
+    were added, as every case is when shortest_first is disabled and the costs only serve to budget the cases in
+    flight.
+    """
+
+    SMALL = "small"
+    HUGE = "huge"
+    # a member costs a person and its phenotypes in Decipher, about as much as this number of report events
+    MEMBER_WEIGHT = 20
+    HPO_TERM_WEIGHT = 1
+
+    def __init__(self, costs=None, huge_cost=None, shortest_first=True):
+        """
+        :param costs: the estimated cost of every (case_id, case_version), see estimate_cost
+        :type costs: dict
+        :param huge_cost: cases above this cost are scheduled in the huge lane, None for a single lane
+        :param shortest_first: orders the cases by cost, otherwise by arrival
+        """
+        self.costs = costs if costs is not None else {}
+        self.huge_cost = huge_cost
+        self.shortest_first = shortest_first
+        self._lanes = {self.SMALL: [], self.HUGE: []}
+        # ties are broken by arrival order
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_cost(members, report_events, hpo_terms=0):
+        """
+        :param members: the number of members in the pedigree
+        :param report_events: the number of report events
+        :param hpo_terms: the number of HPO terms across every member
+        :rtype: float
+        """
+        return float(report_events + members * CaseScheduler.MEMBER_WEIGHT + hpo_terms * CaseScheduler.HPO_TERM_WEIGHT)
+
+    @staticmethod
+    def costs_from_pre_scan(rows):
+        """
+        :param rows: the rows of a CasePreScan
+        :return: the estimated cost of every case
+        :rtype: dict
+        """
+        return dict(((row['case_id'], row['case_version']),
+                     CaseScheduler.estimate_cost(row['members'], row['report_events'], row['hpo_terms']))
+                    for row in rows)
+
+    def add_cases(self, cases):
+        """
+        :param cases: the (case_id, case_version) to schedule
+        :return: the number of cases added
+        """
+        added = 0
+        with self._lock:
+            for case in cases:
+                cost = self.costs.get(case, 0.0)
+                lane = self.HUGE if self.huge_cost is not None and cost > self.huge_cost else self.SMALL
+                priority = cost if self.shortest_first else 0.0
+                heapq.heappush(self._lanes[lane], (priority, next(self._sequence), case))
+                added += 1
+        return added
+
+    def pop(self, lane=SMALL):
+        """
+        :param lane: the lane served first, a worker takes from the other lane when its own is empty
+        :return: the next (case_id, case_version) or None when every case is scheduled
+        """
+        with self._lock:
+            for current_lane in [lane, self.HUGE if lane == self.SMALL else self.SMALL]:
+                if self._lanes[current_lane]:
+                    return heapq.heappop(self._lanes[current_lane])[2]
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(lane) for lane in self._lanes.values())
+
+    def __iter__(self):
+        """
+        Drains the cases in order
+        """
+        case = self.pop()
+        while case is not None:
+            yield case
+            case = self.pop()
+
+    def log_summary(self):
+        with self._lock:
+            logging.info("Scheduled {} cases, {} in the huge lane".format(
+                len(self._lanes[self.SMALL]) + len(self._lanes[self.HUGE]), len(self._lanes[self.HUGE])))
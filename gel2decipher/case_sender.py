@@ -1,13 +1,25 @@
 import logging
+import threading
 from pycipapi.cipapi_client import CipApiClient
 from gel2decipher_sender.clients.decipher_client import DecipherClient
+from gel2decipher_sender.clients.rest_client import RestClient
+from gel2decipher_sender.clients.deadline import DeadlineExceeded, deadline, check_deadline
+from gel2decipher_sender.clients.hedging import Hedger
+from gel2decipher_sender.clients.circuit_breaker import get_breaker
+from gel2decipher_sender.clients.transport import RecordingTransport, ReplayTransport
 import gel2decipher_sender.models.gel2decipher_mappings as gel2decipher
 from gel2decipher_sender.models.decipher_models import *
+from gel2decipher_sender.models.hpo_index import HpoIndex
+from gel2decipher_sender.transcript_cache import TranscriptCache
+from gel2decipher_sender.pseudonym_index import PseudonymIndex
+from gel2decipher_sender.project_mirror import ProjectMirror, snv_key
+from gel2decipher_sender.profiler import NullProfiler
+from gel2decipher_sender.case_snapshot import CaseSnapshot
 from protocols.migration.migration_helpers import MigrationHelpers
 from protocols.cva_1_0_0 import ReportEventEntry, ObservedVariant, VariantRepresentation, Assembly, VariantAvro, \
     VariantAnnotation, ConsequenceType, VariantCall, ReportEvent, Tier, SequenceOntologyTerm, HpoTerm, TernaryOption
 from requests import HTTPError
-from pyark.cva_client import CvaClient
+from gel2decipher_sender.clients.cva_client import CvaClient
 from DataModels.GelPedigree import GelRDParticipant
 
 
@@ -18,20 +30,110 @@ class UnacceptableCase(ValueError):
 
 class Gel2Decipher(object):
 
+    # the time given to delete a patient left half registered when the deadline of its case is exceeded
+    ROLLBACK_SECONDS = 30
+
     def __init__(self, config):
         Gel2Decipher._sanity_checks(config)
-        self.gel_user = config['gel_user']
-        self.gel_password = config['gel_password']
-        self.cipapi_url = config['cipapi_url']
-        self.cipapi = CipApiClient(self.cipapi_url, user=self.gel_user, password=self.gel_password)
-        self.cva_url = config['cva_url']
-        self.cva = CvaClient(self.cva_url, user=self.gel_user, password=self.gel_password)
-        self.report_events_client = self.cva.report_events()
-        self.decipher_system_key = config['decipher_system_key']
-        self.decipher_user_key = config['decipher_user_key']
-        self.decipher_url = config['decipher_url']
+        self.decipher_url = config.get('decipher_url')
+        # every upstream host has a circuit breaker shared by all its clients
+        breaker_settings = dict((setting, config[key]) for setting, key in [
+            ('failure_rate', 'breaker_failure_rate'), ('open_seconds', 'breaker_open_seconds')]
+            if config.get(key) is not None)
+        if self.decipher_url:
+            get_breaker(self.decipher_url, **breaker_settings)
+        # every upstream keeps its own latencies and budget of hedges
+        hedge_percentile = config.get('hedge_percentile')
+        hedge_max_extra_load = config.get('hedge_max_extra_load', 0.05)
+        # CVA and Decipher traffic can be recorded into a cassette and replayed without the network
+        self.transport = config.get('transport')
+        if self.transport is None and config.get('replay_cassette'):
+            self.transport = ReplayTransport(config['replay_cassette'])
+        elif self.transport is None and config.get('record_cassette'):
+            self.transport = RecordingTransport(config['record_cassette'])
+        if config.get('snapshot_dir'):
+            # cases and report events are read from local dumps, no GEL credentials are needed
+            self.snapshot = CaseSnapshot(config['snapshot_dir'])
+            self.cipapi = self.snapshot
+            self.cva = self.snapshot
+        else:
+            self.snapshot = None
+            self.gel_user = config['gel_user']
+            self.gel_password = config['gel_password']
+            self.cipapi_url = config['cipapi_url']
+            self.cipapi = CipApiClient(self.cipapi_url, user=self.gel_user, password=self.gel_password)
+            self.cva_url = config['cva_url']
+            get_breaker(self.cva_url, **breaker_settings)
+            self.cva = CvaClient(self.cva_url, user=self.gel_user, password=self.gel_password,
+                                 compress_requests=config.get('cva_compress_requests', False),
+                                 compression_threshold=config.get('cva_compression_threshold',
+                                                                  RestClient.COMPRESSION_THRESHOLD),
+                                 accept_encoding=config.get('cva_accept_encoding', "gzip, deflate"),
+                                 timeout=config.get('cva_timeout', RestClient.TIMEOUT),
+                                 endpoint_timeouts=config.get('cva_endpoint_timeouts'),
+                                 hedger=Hedger(hedge_percentile, hedge_max_extra_load) if hedge_percentile else None,
+                                 transport=self.transport)
+        self.decipher_system_key = config.get('decipher_system_key')
+        self.decipher_user_key = config.get('decipher_user_key')
+        # the project and user the patients are created for, asked to Decipher when not configured
+        self.decipher_project_id = config.get('decipher_project_id')
+        self.decipher_user_id = config.get('decipher_user_id')
         self.send_absent_phenotypes = config['send_absent_phenotypes']
-        self.decipher = DecipherClient(self.decipher_url, self.decipher_system_key, self.decipher_user_key)
+        self.hpo_index = HpoIndex.from_obo(config['hpo_obo']) if config.get('hpo_obo') else None
+        self.migrate_hpo_terms = config.get('migrate_hpo_terms', False)
+        self.transcript_cache = TranscriptCache(
+            config['transcript_cache'], config.get('annotation_version'),
+            max_entries=config.get('transcript_cache_size', 1000000)) if config.get('transcript_cache') else None
+        self.pseudonym_index = PseudonymIndex(config['pseudonym_index']) if config.get('pseudonym_index') else None
+        # the Decipher client asks Decipher for its info when created, it is only created once it is needed
+        self._decipher = None
+        self._decipher_lock = threading.Lock()
+        self._decipher_settings = {
+            'compress_requests': config.get('decipher_compress_requests', False),
+            'compression_threshold': config.get('decipher_compression_threshold', RestClient.COMPRESSION_THRESHOLD),
+            'accept_encoding': config.get('decipher_accept_encoding', "gzip, deflate"),
+            'timeout': config.get('decipher_timeout', RestClient.TIMEOUT),
+            'endpoint_timeouts': config.get('decipher_endpoint_timeouts'),
+            'hedger': Hedger(hedge_percentile, hedge_max_extra_load) if hedge_percentile else None,
+            'transport': self.transport
+        }
+        # the seconds given to send every case, None means no deadline
+        self.case_deadline = config.get('case_deadline')
+        self.profiler = NullProfiler()
+        self.mirror = None
+        if config.get('mirror_project', False):
+            self.mirror = ProjectMirror(self.decipher)
+            self.mirror.build()
+
+    @property
+    def decipher(self):
+        """
+        Fetching, mapping or pre-scanning cases does not need Decipher, the client is created on first use
+        :rtype: DecipherClient
+        """
+        if self._decipher is None:
+            with self._decipher_lock:
+                if self._decipher is None:
+                    if not self.decipher_url:
+                        raise ValueError("The Decipher URL and keys are needed to send cases")
+                    self._decipher = DecipherClient(self.decipher_url, self.decipher_system_key,
+                                                    self.decipher_user_key, **self._decipher_settings)
+        return self._decipher
+
+    @property
+    def project_id(self):
+        return self.decipher_project_id if self.decipher_project_id is not None else self.decipher.project_id
+
+    @property
+    def user_id(self):
+        return self.decipher_user_id if self.decipher_user_id is not None else self.decipher.user_id
+
+    def set_profiler(self, profiler):
+        """
+        Every case sent is profiled by the given profiler
+        :param profiler: a DeterministicProfiler, a SamplingProfiler or None to stop profiling
+        """
+        self.profiler = profiler if profiler is not None else NullProfiler()
 
     @staticmethod
     def _sanity_checks(config):
@@ -129,125 +231,446 @@ class Gel2Decipher(object):
 
         return consequence_type
 
-    def _send_pedigree_member_phenotypes(self, pedigree_member, decipher_person_id):
+    @staticmethod
+    def _map_pedigree_member_phenotypes(pedigree_member, send_absent_phenotypes, hpo_index=None,
+                                        migrate_hpo_terms=False):
         """
         :type pedigree_member: PedigreeMember
-        :type decipher_person_id: str
-        :return:
+        :type send_absent_phenotypes: bool
+        :param hpo_index: when provided unknown and obsolete terms are not sent
+        :type hpo_index: HpoIndex
+        :param migrate_hpo_terms: obsolete terms are replaced by their current term instead of skipped
+        :return: the phenotypes as plain dictionaries without person id
         """
-        accepted_phenotypes = []
-        rejected_phenotypes = []
-        decipher_phenotype_ids = []
+        phenotypes = []
         for phenotype in pedigree_member.hpoTermList:   # type: HpoTerm
             # avoid sending unknown presence phenotypes
             if phenotype.termPresence == TernaryOption.unknown:
                 logging.warn("Skipping phenotype {}".format(phenotype.term))
                 continue
             # optionally send absent phenotypes
-            elif not self.send_absent_phenotypes and phenotype.termPresence == TernaryOption.no:
+            elif not send_absent_phenotypes and phenotype.termPresence == TernaryOption.no:
                 logging.warn("Skipping phenotype {}".format(phenotype.term))
                 continue
             else:
-                dec_phenotype = gel2decipher.map_phenotype(phenotype, decipher_person_id)
-                try:
-                    phenotype_id = self.decipher.create_phenotypes([dec_phenotype], decipher_person_id)[0]
-                    decipher_phenotype_ids.append(phenotype_id)
-                    accepted_phenotypes.append(phenotype)
-                except HTTPError:
-                    logging.warning("Rejected phenotype: {}".format(phenotype.toJsonString()))
-                    rejected_phenotypes.append(phenotype)
+                term = phenotype.term
+                # avoids a round trip for terms Decipher would reject, malformed terms are never mapped
+                if hpo_index is not None:
+                    term = hpo_index.validate(phenotype.term, migrate=migrate_hpo_terms)
+                    if term is None:
+                        logging.warn("Skipping phenotype {}".format(phenotype.term))
+                        continue
+                dec_phenotype = gel2decipher.map_phenotype(
+                    HpoTerm(term=term, termPresence=phenotype.termPresence), None)
+                phenotypes.append({
+                    'term': term,
+                    'phenotype_id': dec_phenotype.phenotype_id,
+                    'observation': dec_phenotype.observation
+                })
+        return phenotypes
+
+    def _send_phenotypes(self, phenotypes, decipher_person_id):
+        """
+        :type phenotypes: list
+        :type decipher_person_id: str
+        :return:
+        """
+        accepted_phenotypes = []
+        rejected_phenotypes = []
+        decipher_phenotype_ids = []
+        for phenotype in phenotypes:
+            dec_phenotype = Phenotype(
+                person_id=decipher_person_id,
+                phenotype_id=phenotype['phenotype_id'],
+                observation=phenotype['observation']
+            )
+            try:
+                phenotype_id = self.decipher.create_phenotypes([dec_phenotype], decipher_person_id)[0]
+                decipher_phenotype_ids.append(phenotype_id)
+                accepted_phenotypes.append(phenotype)
+            except HTTPError:
+                logging.warning("Rejected phenotype: {}".format(phenotype['term']))
+                rejected_phenotypes.append(phenotype)
         return accepted_phenotypes, rejected_phenotypes, decipher_phenotype_ids
 
-    def send_case(self, case_id, case_version):
+    def _send_new_phenotypes(self, phenotypes, decipher_person_id, new_person):
+        """
+        Sends the phenotypes not registered yet for a person, every phenotype is sent for a new person
+        :type phenotypes: list
+        :type decipher_person_id: str
+        :type new_person: bool
+        """
+        if not new_person and self.mirror is not None:
+            registered = self.mirror.get_phenotype_ids(decipher_person_id)
+            phenotypes = [phenotype for phenotype in phenotypes if phenotype['phenotype_id'] not in registered]
+        accepted_phenotypes, _, _ = self._send_phenotypes(phenotypes, decipher_person_id)
+        if self.mirror is not None:
+            self.mirror.add_phenotypes(decipher_person_id,
+                                       [phenotype['phenotype_id'] for phenotype in accepted_phenotypes])
 
-        # fetch pedigree and get proband
+    @staticmethod
+    def _report_events_query(case_id, case_version, full_populate=True):
+        return {
+            'parent_id': case_id, 'parent_version': case_version, 're_type': 'tiered', 'tier': 'TIER1,TIER2',
+            'vcf_format': True, 'full_populate': full_populate
+        }
+
+    def fetch_case(self, case_id, case_version, full_populate=True):
+        """
+        Fetches the pedigree from the CIPAPI and the raw report events from CVA. The returned case only holds
+        picklable data so it can be mapped in a different process.
+        :type case_id: str
+        :type case_version: str
+        :param full_populate: False fetches the report events without annotations, enough to check a case but not
+        to map it
+        :rtype: dict
+        """
+        # the CIPAPI client does not take timeouts, the deadline is checked once it returns
         case = self.cipapi.get_case(case_id, case_version)
+        check_deadline()
         pedigree = case.get_pedigree()
-        proband = pedigree.get_proband()
-        father = pedigree.get_father(proband)   # type: GelRDParticipant
-        mother = pedigree.get_mother(proband)   # type: GelRDParticipant
-        logging.info("The proband is {}".format(proband.participantId))
+        proband_id = pedigree.get_proband().participantId
+        # report events are parsed as they arrive and slimmed down before the next one is parsed
+        report_events = list(self.cva.get_report_events_streamed(
+            Gel2Decipher._report_events_query(case_id, case_version, full_populate),
+            transform=lambda report_event: slim_report_event(report_event, proband_id)))
+        return {
+            'case_id': case_id,
+            'case_version': case_version,
+            'pedigree': pedigree,
+            'report_events': report_events
+        }
 
-        # fetch variants from CVA
-        report_events_iterator = self.report_events_client.get_report_events({
-            'parent_id': case_id, 'parent_version': case_version, 're_type': 'tiered', 'tier': 'TIER1,TIER2',
-            'vcf_format': True, 'full_populate': True
-        })
-
-        # filters down the variants
-        accepted_variants = []
-        for report_event in report_events_iterator:  # type: ReportEventEntry
-            # selects the observed variant for the proband
-            proband_ov = Gel2Decipher._get_proband_observed_variant(
-                report_event.observedVariants, proband_id=proband.participantId)  # type: ObservedVariant
-            if proband_ov is None:
-                raise UnacceptableCase("There is a report event with no observed variant for the proband")
-            variant_call = proband_ov.variantCall  # type: VariantCall
-
-            # selects the variant representation for assembly GRCh37
-            grch37_variant = Gel2Decipher._get_variant_representation_grch37(proband_ov)
-            if grch37_variant is None:
-                logging.warning("The report event does not have coordinates in GRCh37")
-                continue
-            else:
-                accepted_variants.append((grch37_variant, report_event, variant_call))
+    def mapping_options(self):
+        """
+        :return: the keyword arguments to map_case, these can be pickled
+        :rtype: dict
+        """
+        return {
+            'project_id': self.project_id,
+            'user_id': self.user_id,
+            'send_absent_phenotypes': self.send_absent_phenotypes,
+            'hpo_index': self.hpo_index,
+            'migrate_hpo_terms': self.migrate_hpo_terms,
+            'transcript_cache': self.transcript_cache
+        }
 
-        if len(accepted_variants) == 0:
-            message = "The case id={} and version={} has no variants".format(case_id, case_version)
-            logging.warning(message)
-            raise UnacceptableCase(message)
+    def map_case(self, fetched_case):
+        """
+        :type fetched_case: dict
+        :rtype: dict
+        """
+        return map_case(fetched_case, **self.mapping_options())
+
+    def upload_case(self, mapped_case):
+        """
+        Registers a mapped case in Decipher. If the deadline is exceeded after creating a new patient, the patient is
+        deleted so the case can be sent again from scratch.
+        :type mapped_case: dict
+        :return: the Decipher patient id
+        """
+        # create patient for proband in Decipher, unless the project mirror knows it already exists. The mirror
+        # reserves the reference so threads sending the same proband do not create it twice.
+        reference = mapped_case['patient']['reference']
+        patient_id = self.mirror.reserve_patient(reference) if self.mirror is not None else None
+        new_patient = patient_id is None
+        if new_patient:
+            try:
+                patient_id = self.decipher.create_patients([Patient(**mapped_case['patient'])])[0]['patient_id']
+            except Exception, ex:
+                if self.mirror is not None:
+                    self.mirror.release_patient(reference)
+                if isinstance(ex, HTTPError):
+                    # the patient already exists??
+                    raise UnacceptableCase("Patient registration failed, don't know how to continue")
+                raise
+            if self.mirror is not None:
+                self.mirror.add_patient(reference, patient_id)
+        else:
+            logging.info("The patient {} already exists with id {}, updating it".format(reference, patient_id))
 
-        # create patient for proband in Decipher
         try:
-            patient_id = self.decipher.create_patients(
-                [gel2decipher.map_pedigree_member_to_patient(
-                    proband, self.decipher.project_id, self.decipher.user_id)])[0]['patient_id']
-        except HTTPError:
-            # the patient already exists??
-            raise UnacceptableCase("Patient registration failed, don't know how to continue")
+            self._upload_patient(mapped_case, patient_id, new_patient)
+        except DeadlineExceeded:
+            if new_patient:
+                self._rollback_patient(reference, patient_id)
+            raise
+        if self.pseudonym_index is not None:
+            self.pseudonym_index.record(mapped_case['participant_id'], mapped_case['case_id'],
+                                        mapped_case['case_version'], patient_id, self.project_id, reference)
+        return patient_id
 
+    def _rollback_patient(self, reference, patient_id):
+        logging.warning("Deadline exceeded uploading patient {}, deleting it".format(patient_id))
+        try:
+            with deadline(self.ROLLBACK_SECONDS):
+                self.decipher.delete_patient(patient_id)
+        except (DeadlineExceeded, HTTPError), ex:
+            logging.error("Failed deleting patient {}: {}".format(patient_id, str(ex)))
+        if self.mirror is not None:
+            self.mirror.remove_patient(reference)
+
+    def _upload_patient(self, mapped_case, patient_id, new_patient):
         # create phenotypes
-        dec_persons = self.decipher.get_persons_by_patient(patient_id)
+        if self.mirror is not None:
+            dec_persons = self.mirror.get_persons(patient_id)
+        else:
+            dec_persons = self.decipher.get_persons_by_patient(patient_id)
         logging.info("The persons: " + str(dec_persons))
         dec_proband = Gel2Decipher._get_person_id_by_relation(dec_persons, 'patient')
         dec_mother = Gel2Decipher._get_person_id_by_relation(dec_persons, 'mother')
         dec_father = Gel2Decipher._get_person_id_by_relation(dec_persons, 'father')
 
-        self._send_pedigree_member_phenotypes(proband, dec_proband)
-
-        # updates mother and father affection status because they are created automatically
-        if mother is not None:
-            self.decipher.update_person(gel2decipher.map_affection_status(mother.affectionStatus), dec_mother)
-            self._send_pedigree_member_phenotypes(mother, dec_mother)
-        if father is not None:
-            self.decipher.update_person(gel2decipher.map_affection_status(father.affectionStatus), dec_father)
-            self._send_pedigree_member_phenotypes(father, dec_father)
-
-        for member in pedigree.members:   # type: GelRDParticipant
-            logging.info("Member of family: {}".format(member.pedigreeId))
-            if member.pedigreeId not in [proband.pedigreeId, father.pedigreeId, mother.pedigreeId]:
-                dec_person = self.decipher.create_persons(
-                    [gel2decipher.map_pedigree_member_to_person(
-                        member, patient_id, pedigree.get_relationship(member.pedigreeId, proband.pedigreeId))],
-                    patient_id)[0]
-                self._send_pedigree_member_phenotypes(member, dec_person)
+        # the parents of an existing patient were updated when it was created, only its new phenotypes are sent
+        self._send_new_phenotypes(mapped_case['proband']['phenotypes'], dec_proband, new_patient)
+        for parent, dec_parent in [(mapped_case['mother'], dec_mother), (mapped_case['father'], dec_father)]:
+            if parent is not None:
+                # updates mother and father affection status because they are created automatically
+                if new_patient:
+                    self.decipher.update_person(parent['relation_status'], dec_parent)
+                self._send_new_phenotypes(parent['phenotypes'], dec_parent, new_patient)
+
+        # relatives of an existing patient are only created beyond those already registered with the same relation
+        existing_relatives = list(dec_persons) if not new_patient else []
+        for relative in mapped_case['relatives']:
+            existing_relative = next(
+                (person for person in existing_relatives if person['relation'] == relative['relation']), None)
+            if existing_relative is not None:
+                existing_relatives.remove(existing_relative)
+                self._send_new_phenotypes(relative['phenotypes'], existing_relative['person_id'], False)
+                continue
+            dec_person = self.decipher.create_persons(
+                [Person(patient_id=patient_id, relation=relative['relation'],
+                        relation_status=relative['relation_status'])],
+                patient_id)[0]
+            if self.mirror is not None:
+                self.mirror.add_person(patient_id, dec_person, relative['relation'])
+            self._send_new_phenotypes(relative['phenotypes'], dec_person, True)
 
         # push the variants to Decipher
-        unique_variants = {}
-        for variant, report_event, variant_call in accepted_variants:  # type: (VariantAvro, ReportEventEntry)
-            annotation = variant.annotation  # type: VariantAnnotation
-            gene_symbols = [x.geneSymbol for x in report_event.reportEvent.genomicEntities]
+        snvs = mapped_case['snvs']
+        if self.mirror is not None:
+            existing_snvs = self.mirror.get_snv_keys(patient_id)
+            snvs = [snv for snv in snvs if snv_key(snv) not in existing_snvs]
+        if len(snvs) > 0:
+            self.decipher.create_snvs([Snv(patient_id=patient_id, **snv) for snv in snvs], patient_id)
+            if self.mirror is not None:
+                self.mirror.add_snvs(patient_id, [snv_key(snv) for snv in snvs])
+
+    def send_case(self, case_id, case_version):
+        """
+        Sends a case within the configured deadline, DeadlineExceeded is raised when it runs out
+        """
+        with self.profiler.profile_case(case_id, case_version), deadline(self.case_deadline):
+            return self.upload_case(self.map_case(self.fetch_case(case_id, case_version)))
+
+
+def _slim_grch37_variant(variant):
+    annotation = variant.get('annotation') or {}
+    return {
+        'chromosome': variant.get('chromosome'),
+        'start': variant.get('start'),
+        'reference': variant.get('reference'),
+        'alternate': variant.get('alternate'),
+        'annotation': {
+            'consequenceTypes': [{
+                'geneName': ct.get('geneName'),
+                'ensemblTranscriptId': ct.get('ensemblTranscriptId'),
+                'biotype': ct.get('biotype'),
+                'transcriptAnnotationFlags': ct.get('transcriptAnnotationFlags') or [],
+                'sequenceOntologyTerms': [{'accession': so.get('accession')}
+                                          for so in ct.get('sequenceOntologyTerms') or []]
+            } for ct in annotation.get('consequenceTypes') or []]
+        }
+    }
+
+
+class AcceptedVariant(object):
+    """
+    What map_case needs from an accepted report event: the GRCh37 coordinates, the proband's zygosity, the tier, the
+    event justification, the genes and the consequence types. It is extracted as soon as the report event is parsed
+    so the report event can be freed.
+    """
+
+    __slots__ = ['chromosome', 'start', 'reference', 'alternate', 'zygosity', 'tier', 'event_justification',
+                 'gene_symbols', 'consequence_types']
+
+    def __init__(self, report_event, grch37_variant, variant_call):
+        """
+        :type report_event: ReportEventEntry
+        :type grch37_variant: VariantAvro
+        :type variant_call: VariantCall
+        """
+        self.chromosome = grch37_variant.chromosome
+        self.start = grch37_variant.start
+        self.reference = grch37_variant.reference
+        self.alternate = grch37_variant.alternate
+        self.zygosity = variant_call.zygosity
+        self.tier = report_event.reportEvent.tier
+        self.event_justification = report_event.reportEvent.eventJustification
+        self.gene_symbols = [x.geneSymbol for x in report_event.reportEvent.genomicEntities]
+        annotation = grch37_variant.annotation  # type: VariantAnnotation
+        self.consequence_types = annotation.consequenceTypes if annotation is not None else []
+
+
+def slim_report_event(report_event, proband_id):
+    """
+    Keeps only the fields of a raw report event used by map_case: the proband's variant call, the GRCh37
+    representation with its consequence types and the genomic entities. The observed variants for other family
+    members and the rest of the annotations are dropped.
+    :type report_event: dict
+    :type proband_id: str
+    :rtype: dict
+    """
+    observed_variants = []
+    for observed_variant in report_event.get('observedVariants') or []:
+        variant_call = observed_variant.get('variantCall') or {}
+        if str(variant_call.get('participantId')) == str(proband_id):
+            variant = observed_variant.get('variant') or {}
+            observed_variants.append({
+                'variantCall': {
+                    'participantId': variant_call.get('participantId'),
+                    'zygosity': variant_call.get('zygosity')
+                },
+                'variant': {
+                    'variants': [{
+                        'assembly': representation['assembly'],
+                        'variant': _slim_grch37_variant(representation.get('variant') or {})
+                    } for representation in variant.get('variants') or []
+                        if representation.get('assembly') == Assembly.GRCh37]
+                }
+            })
+            break
+    event = report_event.get('reportEvent') or {}
+    return {
+        'reportEvent': {
+            'tier': event.get('tier'),
+            'eventJustification': event.get('eventJustification'),
+            'genomicEntities': [{'geneSymbol': entity.get('geneSymbol')}
+                                for entity in event.get('genomicEntities') or []]
+        },
+        'observedVariants': observed_variants
+    }
+
+
+def map_case(fetched_case, project_id, user_id, send_absent_phenotypes=False, hpo_index=None,
+             migrate_hpo_terms=False, transcript_cache=None):
+    """
+    Maps a fetched case into plain Decipher payloads without calling Decipher. Only picklable data goes in and out
+    so this can run in a worker process.
+    :type fetched_case: dict
+    :type project_id: int
+    :type user_id: int
+    :type send_absent_phenotypes: bool
+    :type hpo_index: HpoIndex
+    :type migrate_hpo_terms: bool
+    :param transcript_cache: reuses the transcripts selected for the same variant in other cases
+    :type transcript_cache: TranscriptCache
+    :rtype: dict
+    """
+    case_id = fetched_case['case_id']
+    case_version = fetched_case['case_version']
+    pedigree = fetched_case['pedigree']
+    proband = pedigree.get_proband()
+    father = pedigree.get_father(proband)   # type: GelRDParticipant
+    mother = pedigree.get_mother(proband)   # type: GelRDParticipant
+    logging.info("The proband is {}".format(proband.participantId))
+
+    # filters down the variants
+    accepted_variants = []
+    for report_event_json in fetched_case['report_events']:
+        report_event = ReportEventEntry.fromJsonDict(report_event_json)  # type: ReportEventEntry
+        # selects the observed variant for the proband
+        proband_ov = Gel2Decipher._get_proband_observed_variant(
+            report_event.observedVariants, proband_id=proband.participantId)  # type: ObservedVariant
+        if proband_ov is None:
+            raise UnacceptableCase("There is a report event with no observed variant for the proband")
+        variant_call = proband_ov.variantCall  # type: VariantCall
+
+        # selects the variant representation for assembly GRCh37
+        grch37_variant = Gel2Decipher._get_variant_representation_grch37(proband_ov)
+        if grch37_variant is None:
+            logging.warning("The report event does not have coordinates in GRCh37")
+            continue
+        else:
+            # only a compact record is kept, the report event is freed on the next iteration
+            accepted_variants.append(AcceptedVariant(report_event, grch37_variant, variant_call))
+
+    if len(accepted_variants) == 0:
+        message = "The case id={} and version={} has no variants".format(case_id, case_version)
+        logging.warning(message)
+        raise UnacceptableCase(message)
+
+    patient = gel2decipher.map_pedigree_member_to_patient(proband, project_id, user_id)
+
+    # mother and father are created automatically in Decipher, we only update their affection status
+    parents = {}
+    for relation, parent in [('mother', mother), ('father', father)]:
+        parents[relation] = {
+            'relation_status': gel2decipher.map_affection_status(parent.affectionStatus),
+            'phenotypes': Gel2Decipher._map_pedigree_member_phenotypes(
+                parent, send_absent_phenotypes, hpo_index, migrate_hpo_terms)
+        } if parent is not None else None
+
+    relatives = []
+    nuclear_family = [member.pedigreeId for member in [proband, father, mother] if member is not None]
+    for member in pedigree.members:   # type: GelRDParticipant
+        logging.info("Member of family: {}".format(member.pedigreeId))
+        if member.pedigreeId not in nuclear_family:
+            person = gel2decipher.map_pedigree_member_to_person(
+                member, None, pedigree.get_relationship(member.pedigreeId, proband.pedigreeId))
+            relatives.append({
+                'relation': person.relation,
+                'relation_status': person.relation_status,
+                'phenotypes': Gel2Decipher._map_pedigree_member_phenotypes(
+                    member, send_absent_phenotypes, hpo_index, migrate_hpo_terms)
+            })
+
+    # maps the variants
+    snvs = []
+    unique_variants = set()
+    for accepted_variant in accepted_variants:  # type: AcceptedVariant
+        gene_symbols = accepted_variant.gene_symbols
+        tier = accepted_variant.tier
+        selection = transcript_cache.get(accepted_variant, gene_symbols, tier) if transcript_cache is not None \
+            else None
+        if selection is not None:
+            consequence_type = ConsequenceType.fromJsonDict(
+                {'ensemblTranscriptId': selection[0], 'geneName': selection[1]})  # type: ConsequenceType
+        else:
             consequence_type = Gel2Decipher._select_consequence_type(
-                annotation.consequenceTypes, gene_symbols, report_event.reportEvent.tier)  # type: ConsequenceType
-
-            # builds the variant in decipher model
-            dec_variant = gel2decipher.map_report_event(
-                report_event.reportEvent, variant, variant_call, consequence_type, patient_id)
-            uid = "{}:{}:{}:{}".format(dec_variant.chr, dec_variant.start, dec_variant.ref_allele,
-                                       dec_variant.alt_allele)
-            if uid not in unique_variants:
-                unique_variants[uid] = dec_variant
+                accepted_variant.consequence_types, gene_symbols, tier)  # type: ConsequenceType
+            if transcript_cache is not None:
+                transcript_cache.put(accepted_variant, gene_symbols, tier, consequence_type.ensemblTranscriptId,
+                                     consequence_type.geneName)
+        # the consequence types are not needed anymore
+        accepted_variant.consequence_types = None
+
+        # builds the variant in decipher model
+        dec_variant = gel2decipher.map_accepted_variant(accepted_variant, consequence_type, None)
+        uid = "{}:{}:{}:{}".format(dec_variant.chr, dec_variant.start, dec_variant.ref_allele,
+                                   dec_variant.alt_allele)
         # NOTE: this removes the duplicated variants from composite heterozygous report events
-        self.decipher.create_snvs(unique_variants.values(), patient_id)
-
-        return patient_id
+        if uid not in unique_variants:
+            unique_variants.add(uid)
+            snv = dict(dec_variant)
+            del snv['patient_id']
+            snvs.append(snv)
+    if transcript_cache is not None:
+        transcript_cache.flush()
+
+    return {
+        'case_id': case_id,
+        'case_version': case_version,
+        # kept for the pseudonym index, only the reference is sent to Decipher
+        'participant_id': proband.participantId,
+        'patient': dict(patient),
+        'proband': {
+            'phenotypes': Gel2Decipher._map_pedigree_member_phenotypes(
+                proband, send_absent_phenotypes, hpo_index, migrate_hpo_terms)
+        },
+        'mother': parents['mother'],
+        'father': parents['father'],
+        'relatives': relatives,
+        'snvs': snvs
+    }
@@ -0,0 +1,94 @@
+import json
+import logging
+import mmap
+import os
+import re
+from pycipapi.models import CipApiCase
+from gel2decipher_sender.clients.cva_client import iter_json_array
+
+
+class CaseSnapshot(object):
+    """
+    Reads cases and their report events from local dumps instead of the CIPAPI and CVA. Every case has two files in
+    the snapshot directory:
+    * {case_id}-{case_version}.json: the interpretation request as returned by the CIPAPI
+    * {case_id}-{case_version}.report_events.ndjson: one report event entry per line as returned by CVA, or
+      {case_id}-{case_version}.report_events.json: a response of CVA holding the report events under 'result'
+    Report events are read lazily from a memory map, so large dumps are never loaded in memory.
+    """
+
+    CASE_FILE = re.compile(r"^(?P<case_id>[^-]+)-(?P<case_version>[^-.]+)\.json$")
+    CHUNK_SIZE = 1048576
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise ValueError("The snapshot directory {} does not exist".format(directory))
+        self.directory = directory
+
+    def _path(self, case_id, case_version, suffix):
+        return os.path.join(self.directory, "{}-{}{}".format(case_id, case_version, suffix))
+
+    def list_cases(self):
+        """
+        :return: the (case_id, case_version) in the snapshot
+        :rtype: list
+        """
+        cases = []
+        for file_name in sorted(os.listdir(self.directory)):
+            match = CaseSnapshot.CASE_FILE.match(file_name)
+            if match is not None:
+                cases.append((match.group('case_id'), match.group('case_version')))
+        logging.info("Found {} cases in the snapshot {}".format(len(cases), self.directory))
+        return cases
+
+    def get_case(self, case_id, case_version):
+        """
+        Same as CipApiClient.get_case
+        :rtype: CipApiCase
+        """
+        with open(self._path(case_id, case_version, ".json")) as case_file:
+            return CipApiCase(**json.load(case_file))
+
+    @staticmethod
+    def _iter_lines(mapped):
+        line = mapped.readline()
+        while line:
+            if line.strip():
+                yield json.loads(line)
+            line = mapped.readline()
+
+    @staticmethod
+    def _iter_chunks(mapped, chunk_size):
+        chunk = mapped.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = mapped.read(chunk_size)
+
+    def _iter_report_events(self, case_id, case_version):
+        ndjson = self._path(case_id, case_version, ".report_events.ndjson")
+        path = ndjson if os.path.exists(ndjson) else self._path(case_id, case_version, ".report_events.json")
+        with open(path, "rb") as report_events_file:
+            if os.fstat(report_events_file.fileno()).st_size == 0:
+                return
+            mapped = mmap.mmap(report_events_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if path == ndjson:
+                    for report_event in CaseSnapshot._iter_lines(mapped):
+                        yield report_event
+                else:
+                    for report_event in iter_json_array(
+                            CaseSnapshot._iter_chunks(mapped, self.CHUNK_SIZE), 'result'):
+                        yield report_event
+            finally:
+                mapped.close()
+
+    def get_report_events_streamed(self, query, transform=None):
+        """
+        Same as CvaClient.get_report_events_streamed, only the case in the query is read, other filters are expected
+        to be applied when the dump was exported
+        :type query: dict
+        :param transform: a function applied to every report event entry as parsed from JSON
+        :rtype: collections.Iterable
+        """
+        for report_event in self._iter_report_events(query['parent_id'], query['parent_version']):
+            yield transform(report_event) if transform is not None else report_event
@@ -3,9 +3,10 @@ import urllib2
 import logging
 import time
 import random
+from gel2decipher_sender.clients.deadline import DeadlineExceeded, check_deadline, remaining
 
 
-def wrapper(func, retries):
+def wrapper(func, retries, breaker=None):
     """
     This wrapper implements a truncated binary exponential backoff algorithm between retries.
     (https://en.wikipedia.org/wiki/Exponential_backoff#Binary_exponential_backoff)
@@ -14,9 +15,13 @@ def wrapper(func, retries):
     * requests.exceptions.ConnectionError
     * urllib2.URLError
     Other exceptions will override any retries.
+    Retries, infinite or not, stop when the deadline of the current thread is exceeded.
+    With a circuit breaker every attempt fails fast while the circuit is open, connection errors and server errors are
+    recorded as failures.
 
     :param func:       the wrapped function
     :param retries:    the maximum number of retries. -1 are infinite retries
+    :param breaker:    the circuit breaker of the upstream if any
     :return:           the return of the wrapped function if any
     """
 
@@ -28,11 +33,18 @@ def wrapper(func, retries):
         truncate_iteration = 8
         success = False
         while not success:
+            check_deadline()
+            if breaker is not None:
+                breaker.before_request()
             try:
                 results = func(*args, **kwargs)
                 success = True
+                if breaker is not None:
+                    breaker.record_success()
             except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
                     requests.exceptions.TooManyRedirects, urllib2.URLError), ex:
+                if breaker is not None:
+                    breaker.record_failure()
                 # do we want here any other requests.exception??
                 logging.error(str(ex))
                 # retries a fixed number of times
@@ -41,11 +53,26 @@ def wrapper(func, retries):
                 retries_count += 1
                 # waits for an increasing random time
                 random_sleep = random.randrange(0, (2 ** backoff_iteration) - 1)
+                time_left = remaining()
+                if time_left is not None and time_left <= random_sleep:
+                    raise DeadlineExceeded("The deadline would be exceeded before retrying: {}".format(str(ex)))
                 logging.debug("Retrying connection after %s seconds" % str(random_sleep))
                 time.sleep(random_sleep)
                 # when it reaches the maximum value that it may wait it stops increasing time
                 if backoff_iteration < truncate_iteration:
                     backoff_iteration += 1
+            except requests.exceptions.HTTPError, ex:
+                if breaker is not None:
+                    # the upstream answered, only server errors tell it is unhealthy
+                    if ex.response is not None and ex.response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                raise
+            except Exception:
+                if breaker is not None:
+                    breaker.release()
+                raise
         return results
 
     return retry
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from collections import deque
+from requests.compat import urlparse
+
+
+class CircuitOpen(Exception):
+
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast the requests to an upstream while most of its recent requests are failing. The circuit opens when the
+    failure rate goes over a threshold, after some time it lets a few probes through (half open) and it closes again
+    if these succeed.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_rate=0.5, window=20, min_requests=10, open_seconds=30, half_open_probes=1):
+        """
+        :param name: the upstream, used in logs and metrics
+        :param failure_rate: the ratio of failures in the window opening the circuit
+        :param window: the number of recent requests considered
+        :param min_requests: the number of requests in the window needed to open the circuit
+        :param open_seconds: the time the circuit stays open before sending probes
+        :param half_open_probes: the number of probes that must succeed to close the circuit
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.results = deque(maxlen=window)
+        self.open_until = 0
+        self.probes_in_flight = 0
+        self.probes_succeeded = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _transition(self, state):
+        logging.warning("Circuit to {} is now {}".format(self.name, state))
+        self.state = state
+        self.probes_in_flight = 0
+        self.probes_succeeded = 0
+        if state == self.OPEN:
+            self.open_until = time.time() + self.open_seconds
+            self.times_opened += 1
+        elif state == self.CLOSED:
+            self.results.clear()
+
+    def _available(self):
+        if self.state == self.OPEN:
+            return time.time() >= self.open_until
+        if self.state == self.HALF_OPEN:
+            return self.probes_in_flight + self.probes_succeeded < self.half_open_probes
+        return True
+
+    def before_request(self):
+        """
+        Raises CircuitOpen if the request is not to be sent
+        """
+        with self.lock:
+            if not self._available():
+                self.rejected += 1
+                raise CircuitOpen("The circuit to {} is {}".format(self.name, self.state))
+            if self.state == self.OPEN:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                self.probes_in_flight += 1
+
+    def record_success(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probes_in_flight -= 1
+                self.probes_succeeded += 1
+                if self.probes_succeeded >= self.half_open_probes:
+                    self._transition(self.CLOSED)
+            else:
+                self.results.append(True)
+
+    def record_failure(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self._transition(self.OPEN)
+            elif self.state == self.CLOSED:
+                self.results.append(False)
+                failures = self.results.count(False)
+                if len(self.results) >= self.min_requests and \
+                        failures >= self.failure_rate * len(self.results):
+                    self._transition(self.OPEN)
+
+    def release(self):
+        """
+        Records a request ending without telling anything about the health of the upstream
+        """
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probes_in_flight -= 1
+
+    def wait_until_available(self, poll_seconds=1):
+        """
+        Blocks while the circuit is open or its probes are in flight
+        """
+        while True:
+            with self.lock:
+                if self._available():
+                    return
+                wait = self.open_until - time.time() if self.state == self.OPEN else poll_seconds
+            time.sleep(max(0, min(wait, poll_seconds)))
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.results.count(False),
+                'requests': len(self.results),
+                'times_opened': self.times_opened,
+                'rejected': self.rejected
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url, **kwargs):
+    """
+    :param url: any URL of the upstream, breakers are shared by every client of the same host
+    :param kwargs: the settings of the breaker if it does not exist yet
+    :rtype: CircuitBreaker
+    """
+    host = urlparse(url).netloc
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host, **kwargs)
+        return breaker
+
+
+def breakers_stats():
+    """
+    :return: the stats of the breaker of every upstream host
+    :rtype: dict
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return dict((breaker.name, breaker.stats()) for breaker in breakers)
+
+
+def wait_for_upstreams():
+    """
+    Pauses the caller while the circuit to any upstream is open, so no work is started during an outage
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    for breaker in breakers:
+        breaker.wait_until_available()
@@ -0,0 +1,149 @@
+import re
+import json
+import logging
+from gel2decipher_sender.clients.rest_client import RestClient
+
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_array(chunks, key):
+    """
+    Incrementally parses the elements of the first JSON array under the given key from an iterator of chunks of
+    text. Only the element being parsed is held in memory.
+    :param chunks: an iterator over chunks of a JSON document
+    :param key: the key of the array to parse
+    :rtype: collections.Iterable
+    """
+    decoder = json.JSONDecoder()
+    array_start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    chunks = iter(chunks)
+    buffer = ""
+    match = None
+    for chunk in chunks:
+        buffer += chunk
+        match = array_start.search(buffer)
+        if match is not None:
+            break
+    if match is None:
+        return
+    buffer = buffer[match.end():]
+    # an incomplete element is not decoded again until the buffer has doubled, otherwise large elements arriving in
+    # many chunks would be parsed quadratically
+    next_attempt = 0
+    exhausted = False
+    while True:
+        position = _SEPARATORS.match(buffer).end()
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        if position < len(buffer) and (exhausted or len(buffer) >= next_attempt):
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+                buffer = buffer[end:]
+                next_attempt = 0
+                yield element
+                continue
+            except ValueError:
+                if exhausted:
+                    raise
+                next_attempt = 2 * len(buffer)
+        elif exhausted:
+            raise ValueError("Unexpected end of JSON array '{}'".format(key))
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+        else:
+            buffer = buffer[position:] + chunk
+
+
+class CvaClient(RestClient):
+    """
+    The subset of the CVA REST API used to fetch report events. It replaces the pyark client, which parsed every page
+    into ReportEventEntry models in the fetching process: here report events are plain JSON dictionaries that can be
+    streamed, slimmed down and pickled to the mapping processes, and the requests share the timeouts, deadlines,
+    hedging, circuit breakers and transports of the other clients.
+    * POST authentication with the user and password returns the token in response[0].result[0].token, it is sent
+      as a bearer token in the Authorization header
+    * GET report-events with the query and limit and skip parameters returns a page of report event entries in
+      response[0].result, a page shorter than limit is the last one
+    The pyark client remains the reference for this contract, TestGel2Decipher compares the report events of both for
+    a known case against a live CVA.
+    """
+
+    REPORT_EVENTS_ENDPOINT = "report-events"
+    PAGE_SIZE = 500
+
+    def __init__(self, url_base, user, password, retries=5, compress_requests=False,
+                 compression_threshold=RestClient.COMPRESSION_THRESHOLD, accept_encoding="gzip, deflate",
+                 timeout=RestClient.TIMEOUT, endpoint_timeouts=None, hedger=None, transport=None):
+        """
+        User and password are required, CVA tokens are renewed on the first 403
+        :param url_base:
+        :param user:
+        :param password:
+        :param compress_requests: gzips the request bodies larger than the compression threshold in bytes
+        :param accept_encoding: the encodings accepted in responses, such as pages of report events
+        :param timeout: the connect and read timeouts in seconds
+        :param endpoint_timeouts: the connect and read timeouts for the endpoints matching some regular expressions
+        :param hedger: hedges the GET requests being slower than usual
+        :param transport: sends the requests, by default through the shared session
+        """
+        RestClient.__init__(self, url_base, retries, compress_requests=compress_requests,
+                            compression_threshold=compression_threshold, accept_encoding=accept_encoding,
+                            timeout=timeout, endpoint_timeouts=endpoint_timeouts, hedger=hedger, transport=transport)
+        self.user = user
+        self.password = password
+        if not self.user or not self.password:
+            raise ValueError("Authentication is required. Provide user and password.")
+        self.set_authenticated_header()
+
+    def get_token(self):
+        response = self.post("authentication", payload={'username': self.user, 'password': self.password})
+        token = response['response'][0]['result'][0]['token']
+        return "Bearer {}".format(token)
+
+    def get_report_events_raw(self, query, page_size=PAGE_SIZE):
+        """
+        Iterates over the report events matching the query as plain JSON dictionaries, the pages are fetched with
+        limit and skip until a short page is returned.
+        :type query: dict
+        :type page_size: int
+        :rtype: collections.Iterable[dict]
+        """
+        query = dict(query)
+        skip = 0
+        while True:
+            query['limit'] = page_size
+            query['skip'] = skip
+            response = self.get(self.REPORT_EVENTS_ENDPOINT, url_params=query)
+            results = response['response'][0]['result'] if response else []
+            logging.debug("Fetched {} report events from CVA".format(len(results)))
+            for result in results:
+                yield result
+            if len(results) < page_size:
+                break
+            skip += len(results)
+
+    def get_report_events_streamed(self, query, transform=None, page_size=PAGE_SIZE):
+        """
+        As get_report_events_raw but the responses are parsed incrementally, so only one report event is held in
+        memory at a time. The optional transform is applied to every report event as soon as it is parsed, so it can
+        drop whatever is not needed.
+        :type query: dict
+        :param transform: a function receiving and returning a report event
+        :type page_size: int
+        :rtype: collections.Iterable[dict]
+        """
+        query = dict(query)
+        skip = 0
+        while True:
+            query['limit'] = page_size
+            query['skip'] = skip
+            results = 0
+            for result in iter_json_array(self.get_stream(self.REPORT_EVENTS_ENDPOINT, url_params=query), "result"):
+                results += 1
+                yield transform(result) if transform is not None else result
+            logging.debug("Streamed {} report events from CVA".format(results))
+            if results < page_size:
+                break
+            skip += results
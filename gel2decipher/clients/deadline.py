@@ -0,0 +1,47 @@
+import contextlib
+import threading
+import time
+
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds=None, at=None):
+    """
+    Sets a deadline for the requests made by the current thread, requests are not sent nor retried after it and their
+    timeouts are shortened to the remaining time. The previous deadline is restored on exit.
+    :param seconds: the time budget from now, None means no deadline
+    :param at: the deadline as a timestamp, overrides seconds
+    """
+    previous = get_deadline()
+    _local.deadline = at if at is not None else time.time() + seconds if seconds is not None else None
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def get_deadline():
+    """
+    :return: the deadline of the current thread as a timestamp or None
+    """
+    return getattr(_local, 'deadline', None)
+
+
+def remaining():
+    """
+    :return: the seconds left until the deadline of the current thread or None if there is no deadline
+    """
+    current = get_deadline()
+    return current - time.time() if current is not None else None
+
+
+def check_deadline():
+    if get_deadline() is not None and remaining() <= 0:
+        raise DeadlineExceeded("The deadline was exceeded")
@@ -1,18 +1,31 @@
 import logging
-from gel2decipher_sender.clients.rest_client import RestClient
+from gel2decipher_sender.clients.rest_client import RestClient, prefetch_pages
 from requests.exceptions import InvalidSchema
 
 
 class DecipherClient(RestClient):
 
-    def __init__(self, url_base, system_key, user_key):
+    PAGE_SIZE = 100
+
+    def __init__(self, url_base, system_key, user_key, compress_requests=False,
+                 compression_threshold=RestClient.COMPRESSION_THRESHOLD, accept_encoding="gzip, deflate",
+                 timeout=RestClient.TIMEOUT, endpoint_timeouts=None, hedger=None, transport=None):
         """
         System and user keys are required
         :param url_base:
         :param system_key:
         :param user_key:
-        """
-        RestClient.__init__(self, url_base)
+        :param compress_requests: gzips the request bodies larger than the compression threshold in bytes, such as
+        batches of variants or phenotypes
+        :param accept_encoding: the encodings accepted in responses
+        :param timeout: the connect and read timeouts in seconds
+        :param endpoint_timeouts: the connect and read timeouts for the endpoints matching some regular expressions
+        :param hedger: hedges the GET requests being slower than usual
+        :param transport: sends the requests, by default through the shared session
+        """
+        RestClient.__init__(self, url_base, compress_requests=compress_requests,
+                            compression_threshold=compression_threshold, accept_encoding=accept_encoding,
+                            timeout=timeout, endpoint_timeouts=endpoint_timeouts, hedger=hedger, transport=transport)
         self.system_key = system_key
         self.user_key = user_key
         if not self.system_key or not self.user_key:
@@ -46,6 +59,47 @@ class DecipherClient(RestClient):
                              payload=[dict(patient) for patient in patients])
         return response
 
+    def iter_paginated(self, endpoint, key, page_size=PAGE_SIZE):
+        """
+        Iterates over the records of a list endpoint one at a time, pages are requested with limit and offset and the
+        next page is fetched in the background while the current one is consumed
+        :param endpoint: the list endpoint
+        :param key: the key of the list of records in the response
+        :param page_size: the number of records per page
+        :rtype: collections.Iterable[dict]
+        """
+        def get_page(url_params):
+            records = self.get(endpoint, url_params=url_params)[key]
+            # the same page again means that pagination is not supported by the endpoint
+            return records if records != previous_records[0] else []
+
+        def next_page_params(url_params, records):
+            # a short page is the last one
+            if len(records) < page_size:
+                return None
+            previous_records[0] = records
+            return {'limit': page_size, 'offset': url_params['offset'] + len(records)}
+
+        previous_records = [None]
+        for records in prefetch_pages(get_page, next_page_params, {'limit': page_size, 'offset': 0}):
+            for record in records:
+                yield record
+
+    def iter_patients(self):
+        """
+        :return: iterates over the patients in the project
+        """
+        return self.iter_paginated("projects/{project_id}/patients".format(project_id=self.project_id), 'patients')
+
+    def get_patients(self):
+        """
+        :return: the patients in the project
+        """
+        return list(self.iter_patients())
+
+    def iter_persons_by_patient(self, patient_id):
+        return self.iter_paginated("patients/{patient_id}/persons".format(patient_id=patient_id), 'persons')
+
     def get_persons_by_patient(self, patient_id):
         response = self.get("patients/{patient_id}/persons".format(patient_id=patient_id))
         return response['persons']
@@ -118,6 +172,13 @@ class DecipherClient(RestClient):
         response = self.get("patients/{patient_id}/snvs".format(patient_id=patient_id))
         return response
 
+    def iter_snvs(self, patient_id):
+        """
+        :param patient_id:
+        :return: iterates over the variants of the patient
+        """
+        return self.iter_paginated("patients/{patient_id}/snvs".format(patient_id=patient_id), 'snvs')
+
     def delete_snv(self, snv_id):
         """
 
@@ -141,6 +202,13 @@ class DecipherClient(RestClient):
         phenotype_ids = [x["person_phenotype_id"] for x in response]
         return phenotype_ids
 
+    def iter_phenotypes(self, person_id):
+        """
+        :param person_id:
+        :return: iterates over the phenotypes of the person
+        """
+        return self.iter_paginated("persons/{person_id}/phenotypes".format(person_id=person_id), 'phenotypes')
+
     def delete_phenotype(self, phenotype_id):
         """
 
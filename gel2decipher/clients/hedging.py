@@ -0,0 +1,121 @@
+import logging
+import re
+import threading
+import time
+import Queue
+from collections import deque
+from gel2decipher_sender.clients.deadline import deadline, get_deadline
+
+
+class Hedger(object):
+    """
+    Sends a second identical request when the first has not answered within a percentile of the recent latencies of the
+    same endpoint, the first answer wins. Only to be used with idempotent requests.
+    """
+
+    def __init__(self, percentile=95, max_extra_load=0.05, window=1000, min_samples=20):
+        """
+        :param percentile: the percentile of the recent latencies after which a request is hedged
+        :param max_extra_load: the maximum ratio of hedges to requests
+        :param window: the number of recent latencies kept for every endpoint
+        :param min_samples: the number of latencies needed for an endpoint before hedging its requests
+        """
+        self.percentile = percentile
+        self.max_extra_load = max_extra_load
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.requests = 0
+        self.hedges = 0
+
+    @staticmethod
+    def endpoint_key(endpoint):
+        """
+        Endpoints differing only on identifiers share their latencies (eg: patients/{id}/persons)
+        """
+        return re.sub(r"\d+", "{id}", endpoint)
+
+    def _record(self, key, latency):
+        with self.lock:
+            latencies = self.latencies.get(key)
+            if latencies is None:
+                latencies = self.latencies[key] = deque(maxlen=self.window)
+            latencies.append(latency)
+
+    def _delay(self, key):
+        """
+        :return: the seconds to wait before hedging or None if there are not enough latencies yet
+        """
+        with self.lock:
+            self.requests += 1
+            latencies = list(self.latencies.get(key, []))
+        if len(latencies) < max(self.min_samples, 1):
+            return None
+        latencies.sort()
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))]
+
+    def _acquire_hedge(self):
+        with self.lock:
+            if self.hedges + 1 > self.max_extra_load * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def _attempt(self, key, answers, caller_deadline, func, args):
+        start = time.time()
+        try:
+            with deadline(at=caller_deadline):
+                result = func(*args)
+        except Exception, ex:
+            answers.put((False, ex))
+        else:
+            self._record(key, time.time() - start)
+            answers.put((True, result))
+
+    def _start_attempt(self, key, answers, func, args):
+        attempt = threading.Thread(target=self._attempt, args=(key, answers, get_deadline(), func, args))
+        # a request losing the race is abandoned
+        attempt.daemon = True
+        attempt.start()
+
+    def call(self, endpoint, func, *args):
+        """
+        :param endpoint: the endpoint requested, used to group latencies
+        :param func: the request, it has to be idempotent
+        :return: the result of the first request answering successfully
+        """
+        key = Hedger.endpoint_key(endpoint)
+        delay = self._delay(key)
+        if delay is None:
+            start = time.time()
+            result = func(*args)
+            self._record(key, time.time() - start)
+            return result
+        answers = Queue.Queue()
+        self._start_attempt(key, answers, func, args)
+        pending = 1
+        hedged = False
+        while True:
+            try:
+                success, value = answers.get(timeout=None if hedged else delay)
+            except Queue.Empty:
+                hedged = True
+                if self._acquire_hedge():
+                    logging.debug("Hedging request to {} after {} seconds".format(endpoint, delay))
+                    self._start_attempt(key, answers, func, args)
+                    pending += 1
+                continue
+            pending -= 1
+            if success:
+                return value
+            if pending == 0:
+                raise value
+
+    def stats(self):
+        """
+        :return: the number of requests and of hedges sent
+        :rtype: dict
+        """
+        with self.lock:
+            return {'requests': self.requests, 'hedges': self.hedges}
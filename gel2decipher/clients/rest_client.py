@@ -3,26 +3,91 @@ import requests
 import datetime
 import json
 import abc
+import re
+import zlib
 from requests.compat import urljoin
 from requests.exceptions import HTTPError
+from multiprocessing.pool import ThreadPool
 import gel2decipher_sender.clients.backoff_retrier as backoff_retrier
+from gel2decipher_sender.clients.hedging import Hedger
+from gel2decipher_sender.clients.single_flight import SingleFlight
+from gel2decipher_sender.clients.circuit_breaker import CircuitBreaker, get_breaker
+from gel2decipher_sender.clients.deadline import deadline, get_deadline, check_deadline, remaining
+
+
+def prefetch_pages(get_page, next_page_params, url_params):
+    """
+    Iterates over the pages of a paginated endpoint while the next page is being fetched in the background
+    :param get_page: a function receiving the query parameters and returning a page
+    :param next_page_params: a function receiving the query parameters and the page just fetched and returning the
+    query parameters for the next page or None if this was the last
+    :param url_params: the query parameters for the first page
+    :rtype: collections.Iterable
+    """
+    # the prefetching thread works under the deadline of the caller
+    caller_deadline = get_deadline()
+
+    def get_page_before_deadline(params):
+        with deadline(at=caller_deadline):
+            return get_page(params)
+
+    prefetcher = ThreadPool(1)
+    try:
+        next_page = prefetcher.apply_async(get_page_before_deadline, (url_params,))
+        while next_page is not None:
+            page = next_page.get()
+            url_params = next_page_params(url_params, page)
+            next_page = prefetcher.apply_async(get_page_before_deadline, (url_params,)) \
+                if url_params is not None else None
+            yield page
+    finally:
+        prefetcher.terminate()
 
 
 class RestClient(object):
 
     session = requests.Session()
+    COMPRESSION_THRESHOLD = 1024
+    TIMEOUT = (10, 120)
 
-    def __init__(self, url_base, retries=5):
+    def __init__(self, url_base, retries=5, compress_requests=False, compression_threshold=COMPRESSION_THRESHOLD,
+                 accept_encoding="gzip, deflate", timeout=TIMEOUT, endpoint_timeouts=None, hedger=None,
+                 circuit_breaker=None, coalesce_gets=True, transport=None):
+        """
+        :param compress_requests: gzips the POST and PATCH bodies larger than the compression threshold in bytes
+        :param accept_encoding: the encodings accepted in responses, requests decompresses these transparently
+        :param timeout: the connect and read timeouts in seconds
+        :param endpoint_timeouts: the connect and read timeouts for the endpoints matching some regular expressions
+        :type endpoint_timeouts: dict
+        :param hedger: hedges the GET requests being slower than usual, other verbs and streams are never hedged
+        :type hedger: Hedger
+        :param circuit_breaker: the circuit breaker of the upstream, by default the one shared by its host
+        :type circuit_breaker: CircuitBreaker
+        :param coalesce_gets: concurrent identical GET requests wait for the one in flight instead of being sent
+        :param transport: sends the requests, anything with the request method of a requests.Session such as the
+        transports in gel2decipher.clients.transport, by default the shared session
+        """
         self.url_base = url_base
+        self.transport = transport if transport is not None else self.session
+        self.hedger = hedger
+        self.single_flight = SingleFlight() if coalesce_gets else None
+        self.timeout = tuple(timeout)
+        self.endpoint_timeouts = [(re.compile(pattern), tuple(endpoint_timeout))
+                                  for pattern, endpoint_timeout in (endpoint_timeouts or {}).iteritems()]
         self.headers = {
-            'Accept': 'application/json'
+            'Accept': 'application/json',
+            'Accept-Encoding': accept_encoding
         }
+        self.compress_requests = compress_requests
+        self.compression_threshold = compression_threshold
         self.token = None
         self.renewed_token = False
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else get_breaker(url_base)
         # decorates the REST verbs with retries
-        self.get = backoff_retrier.wrapper(self.get, retries)
-        self.post = backoff_retrier.wrapper(self.post, retries)
-        self.delete = backoff_retrier.wrapper(self.delete, retries)
+        self.get = backoff_retrier.wrapper(self.get, retries, self.circuit_breaker)
+        self.get_stream = backoff_retrier.wrapper(self.get_stream, retries, self.circuit_breaker)
+        self.post = backoff_retrier.wrapper(self.post, retries, self.circuit_breaker)
+        self.delete = backoff_retrier.wrapper(self.delete, retries, self.circuit_breaker)
 
     @staticmethod
     def build_url(baseurl, endpoint):
@@ -37,6 +102,43 @@ class RestClient(object):
     def get_token(self):
         raise ValueError("Not implemented")
 
+    def _get_timeout(self, endpoint):
+        """
+        :return: the connect and read timeouts for the endpoint shortened to the deadline of the current thread
+        """
+        check_deadline()
+        timeout = self.timeout
+        for pattern, endpoint_timeout in self.endpoint_timeouts:
+            if pattern.match(endpoint):
+                timeout = endpoint_timeout
+                break
+        time_left = remaining()
+        if time_left is not None:
+            timeout = tuple(min(x, time_left) for x in timeout)
+        return timeout
+
+    def _request(self, method, url, session=True, **kwargs):
+        # without session a new connection is opened, unless another transport is in place
+        transport = self.transport if session or self.transport is not self.session else requests
+        return transport.request(method, url, **kwargs)
+
+    def _encode_payload(self, payload):
+        """
+        Serialises the payload into JSON, gzipped if compression is enabled and the body is large enough
+        :return: the body and the request headers
+        """
+        data = json.dumps(payload)
+        headers = dict(self.headers)
+        headers['Content-Type'] = 'application/json'
+        if self.compress_requests and len(data) >= self.compression_threshold:
+            # wbits 16 + MAX_WBITS writes a gzip header and trailer
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed = compressor.compress(data) + compressor.flush()
+            logging.debug("Compressed request body from {} to {} bytes".format(len(data), len(compressed)))
+            data = compressed
+            headers['Content-Encoding'] = 'gzip'
+        return data, headers
+
     def post(self, endpoint, payload, url_params={}, session=True):
         if endpoint is None or payload is None:
             raise ValueError("Must define payload and endpoint before post")
@@ -46,10 +148,9 @@ class RestClient(object):
             method="POST",
             url="{}?{}".format(url, "&".join(["{}={}".format(k, v) for k, v in url_params.iteritems()]))
         ))
-        if session:
-            response = self.session.post(url, json=payload, params=url_params, headers=self.headers)
-        else:
-            response = requests.post(url, json=payload, params=url_params, headers=self.headers)
+        data, headers = self._encode_payload(payload)
+        timeout = self._get_timeout(endpoint)
+        response = self._request("POST", url, session, data=data, params=url_params, headers=headers, timeout=timeout)
         self._verify_response(response)
         return json.loads(response.content) if response.content else None
 
@@ -62,28 +163,77 @@ class RestClient(object):
             method="PATCH",
             url="{}?{}".format(url, "&".join(["{}={}".format(k, v) for k, v in url_params.iteritems()]))
         ))
-        if session:
-            response = self.session.patch(url, json=payload, params=url_params, headers=self.headers)
-        else:
-            response = requests.patch(url, json=payload, params=url_params, headers=self.headers)
+        data, headers = self._encode_payload(payload)
+        timeout = self._get_timeout(endpoint)
+        response = self._request("PATCH", url, session, data=data, params=url_params, headers=headers, timeout=timeout)
         self._verify_response(response)
         return json.loads(response.content) if response.content else None
 
     def get(self, endpoint, url_params={}, session=True):
         if endpoint is None:
             raise ValueError("Must define endpoint before get")
+        if self.single_flight is not None:
+            # identical requests share the response body, every caller parses its own copy. The headers carry the
+            # credentials, Authorization or the Decipher tokens, requests made with other credentials are not identical
+            key = (self.build_url(self.url_base, endpoint), tuple(sorted(url_params.iteritems())),
+                   tuple(sorted(self.headers.iteritems())))
+            content = self.single_flight.call(key, self._get_hedged, endpoint, url_params, session)
+        else:
+            content = self._get_hedged(endpoint, url_params, session)
+        return json.loads(content) if content else None
+
+    def _get_hedged(self, endpoint, url_params, session):
+        if self.hedger is not None:
+            return self.hedger.call(endpoint, self._get, endpoint, url_params, session)
+        return self._get(endpoint, url_params, session)
+
+    def _get(self, endpoint, url_params, session):
+        """
+        :return: the response body
+        """
         url = self.build_url(self.url_base, endpoint)
         logging.debug("{date} {method} {url}".format(
             date=datetime.datetime.now(),
             method="GET",
             url="{}?{}".format(url, "&".join(["{}={}".format(k, v) for k, v in url_params.iteritems()]))
         ))
-        if session:
-            response = self.session.get(url, params=url_params, headers=self.headers)
-        else:
-            response = requests.get(url, params=url_params, headers=self.headers)
+        timeout = self._get_timeout(endpoint)
+        response = self._request("GET", url, session, params=url_params, headers=self.headers, timeout=timeout)
         self._verify_response(response)
-        return json.loads(response.content) if response.content else None
+        return response.content
+
+    def get_stream(self, endpoint, url_params={}, chunk_size=65536):
+        """
+        Returns an iterator over the chunks of the response body, the body is never fully loaded in memory
+        """
+        if endpoint is None:
+            raise ValueError("Must define endpoint before get")
+        url = self.build_url(self.url_base, endpoint)
+        logging.debug("{date} {method} {url}".format(
+            date=datetime.datetime.now(),
+            method="GET",
+            url="{}?{}".format(url, "&".join(["{}={}".format(k, v) for k, v in url_params.iteritems()]))
+        ))
+        timeout = self._get_timeout(endpoint)
+        response = self._request("GET", url, params=url_params, headers=self.headers, stream=True, timeout=timeout)
+        self._verify_response(response)
+        return self._iter_content(response, chunk_size)
+
+    @staticmethod
+    def _iter_content(response, chunk_size):
+        """
+        The read timeout bounds every read from the socket, a body trickling in is only stopped by the deadline of the
+        caller, which is checked on every chunk
+        """
+        caller_deadline = get_deadline()
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                with deadline(at=caller_deadline):
+                    check_deadline()
+                yield chunk
+        finally:
+            # the connection is released when the stream is abandoned
+            response.close()
 
     def delete(self, endpoint, url_params={}):
         if endpoint is None:
@@ -94,7 +244,8 @@ class RestClient(object):
             method="DELETE",
             url="{}?{}".format(url, "&".join(["{}={}".format(k, v) for k, v in url_params.iteritems()]))
         ))
-        response = self.session.delete(url, params=url_params, headers=self.headers)
+        timeout = self._get_timeout(endpoint)
+        response = self._request("DELETE", url, params=url_params, headers=self.headers, timeout=timeout)
         self._verify_response(response)
         return json.loads(response.content) if response.content else None
 
@@ -0,0 +1,70 @@
+import sys
+import threading
+from gel2decipher_sender.clients.deadline import DeadlineExceeded, remaining
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent calls: while a call with a key is in flight, further calls with the same key wait
+    for its result instead of making their own. Only to be used with idempotent calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def call(self, key, func, *args):
+        """
+        :param key: identifies identical calls, it must be hashable
+        :return: the result of func, or of the identical call in flight
+        """
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = _Flight()
+                    self.flights[key] = flight
+                    self.calls += 1
+                else:
+                    self.coalesced += 1
+            if leader:
+                return self._lead(key, flight, func, args)
+            # the follower waits within its own deadline
+            if not flight.done.wait(remaining()):
+                raise DeadlineExceeded("Deadline exceeded waiting for an identical request in flight")
+            if flight.exc_info is None:
+                return flight.result
+            # the leader may have run out of its own deadline, this caller tries on its own time
+            if not isinstance(flight.exc_info[1], DeadlineExceeded):
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+
+    def _lead(self, key, flight, func, args):
+        try:
+            flight.result = func(*args)
+            return flight.result
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def stats(self):
+        """
+        :return: the number of calls made and of calls coalesced into another
+        :rtype: dict
+        """
+        with self.lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced}
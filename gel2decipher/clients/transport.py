@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import requests
+from requests.compat import urlencode
+
+
+# endpoints exchanging credentials for a token, the credentials and the token are never recorded
+AUTHENTICATION_ENDPOINTS = ["authentication"]
+REDACTED = "redacted"
+
+
+class UnrecordedRequest(Exception):
+    pass
+
+
+class InMemoryResponse(object):
+    """
+    The parts of a requests.Response used by RestClient
+    """
+
+    def __init__(self, status_code=200, content="", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+def is_authentication(url):
+    """
+    :rtype: bool
+    """
+    return url.rstrip("/").split("/")[-1] in AUTHENTICATION_ENDPOINTS
+
+
+def request_key(method, url, params=None, data=None):
+    """
+    Identifies a request by its method, URL, sorted query parameters and a hash of its body. Headers are not part of
+    the key, nor the body of an authentication, so recordings do not depend on credentials.
+    :rtype: str
+    """
+    query = urlencode(sorted((params or {}).items()))
+    body = hashlib.sha1(data).hexdigest() if data and not is_authentication(url) else ""
+    return "{} {}{}{} {}".format(method.upper(), url, "?" if query else "", query, body)
+
+
+class InMemoryTransport(object):
+    """
+    Serves canned responses without any socket, so the CPU cost of the clients and the mapping can be measured
+    alone. Responses to the same request are served in the order they were added, the last one is repeated.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.served = {}
+
+    def add(self, method, url, content="", status_code=200, params=None, data=None):
+        """
+        :param content: the response body, a dict or a list is serialised into JSON
+        """
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content)
+        with self.lock:
+            self.responses.setdefault(request_key(method, url, params, data), []).append(
+                InMemoryResponse(status_code, content))
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        """
+        Same as requests.Session.request, other arguments are ignored
+        :rtype: InMemoryResponse
+        """
+        key = request_key(method, url, params, data)
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                raise UnrecordedRequest("No response for {}".format(key))
+            served = self.served.get(key, 0)
+            self.served[key] = served + 1
+            return responses[min(served, len(responses) - 1)]
+
+    def save(self):
+        pass
+
+
+class RecordingTransport(object):
+    """
+    Sends requests through a requests.Session and records every request and response in a cassette file, which is
+    replayed with ReplayTransport. Every interaction is appended to the cassette as one JSON line when it happens, so
+    recording holds no response in memory and a run killed midway leaves the interactions it made. Cassettes hold the
+    data returned by the upstreams and must be protected like it, the tokens returned by an authentication are
+    replaced by a placeholder.
+    """
+
+    def __init__(self, cassette, session=None):
+        """
+        :param cassette: the file where the interactions are written, one JSON document per line
+        :type session: requests.Session
+        """
+        self.cassette = cassette
+        self.session = session if session is not None else requests.Session()
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self._cassette_file = open(cassette, "w")
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        response = self.session.request(method, url, params=params, data=data, **kwargs)
+        # the body is read in full even for streams so it can be recorded
+        content = response.content
+        recorded_content = _redact_tokens(content) if is_authentication(url) else content
+        interaction = {'key': request_key(method, url, params, data), 'status_code': response.status_code}
+        try:
+            interaction['text'] = recorded_content.decode("utf-8")
+        except UnicodeDecodeError:
+            interaction['base64'] = base64.b64encode(recorded_content)
+        line = json.dumps(interaction)
+        with self.lock:
+            self._cassette_file.write(line + "\n")
+            self._cassette_file.flush()
+            self.recorded += 1
+        return InMemoryResponse(response.status_code, content, dict(response.headers))
+
+    def save(self):
+        with self.lock:
+            self._cassette_file.flush()
+            recorded = self.recorded
+        logging.info("Recorded {} interactions in {}".format(recorded, self.cassette))
+
+
+def _redact_tokens(content):
+    """
+    :return: the JSON content with the value of every field named like a token replaced, nothing if not JSON
+    """
+    def redact(value):
+        if isinstance(value, dict):
+            return dict((key, REDACTED if "token" in key.lower() else redact(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return [redact(item) for item in value]
+        return value
+    try:
+        return json.dumps(redact(json.loads(content)))
+    except ValueError:
+        return ""
+
+
+class ReplayTransport(InMemoryTransport):
+    """
+    Serves the responses recorded in a cassette by RecordingTransport, a request not recorded raises
+    UnrecordedRequest
+    """
+
+    def __init__(self, cassette):
+        InMemoryTransport.__init__(self)
+        if not os.path.exists(cassette):
+            raise ValueError("The cassette {} does not exist".format(cassette))
+        interactions = 0
+        with open(cassette) as cassette_file:
+            for line in cassette_file:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                content = interaction['text'].encode("utf-8") if 'text' in interaction \
+                    else base64.b64decode(interaction['base64'])
+                self.responses.setdefault(interaction['key'], []).append(
+                    InMemoryResponse(interaction['status_code'], content))
+                interactions += 1
+        logging.info("Replaying {} interactions from {}".format(interactions, cassette))
@@ -0,0 +1,314 @@
+import logging
+import multiprocessing
+import threading
+import time
+import Queue
+from gel2decipher_sender.case_sender import Gel2Decipher, UnacceptableCase, map_case
+from gel2decipher_sender.clients.deadline import DeadlineExceeded, deadline, get_deadline
+from gel2decipher_sender.clients.circuit_breaker import wait_for_upstreams
+from gel2decipher_sender.case_scheduler import CaseScheduler
+
+
+def _map_work_item(args):
+    """
+    Runs in a mapping process, any error travels back in the work item.
+    :param args: the work item, the mapping options and the profiler
+    :type args: tuple
+    :rtype: dict
+    """
+    work_item, mapping_options, profiler = args
+    if work_item['error'] is None:
+        try:
+            with profiler.profile_case(work_item['case_id'], work_item['case_version'], "map"):
+                work_item['payload'] = map_case(work_item['payload'], **mapping_options)
+        except UnacceptableCase, ex:
+            work_item['payload'] = None
+            work_item['error'] = ex
+        except Exception, ex:
+            # arbitrary exceptions may not be picklable
+            work_item['payload'] = None
+            work_item['error'] = ValueError("{}: {}".format(type(ex).__name__, str(ex)))
+    return work_item
+
+
+class _Budget(object):
+    """
+    A number of units shared by the cases in flight. A case larger than the whole budget is let through alone.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount, stop):
+        """
+        Waits until the amount fits in the budget
+        :type stop: threading.Event
+        :return: False if stopped while waiting
+        """
+        with self._condition:
+            while self.used > 0 and self.used + amount > self.limit:
+                if stop.is_set():
+                    return False
+                self._condition.wait(0.1)
+            self.used += amount
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, amount):
+        with self._condition:
+            self.used -= amount
+            self._condition.notify_all()
+
+
+class _Stage(object):
+    """
+    A bounded queue between two stages, a full queue blocks the stage feeding it
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = Queue.Queue(maxsize)
+        self.peak = 0
+
+    def put(self, item, stop):
+        """
+        :return: False if stopped while waiting for room
+        """
+        while not stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                self.peak = max(self.peak, self.queue.qsize())
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(self, stop):
+        """
+        :return: the next item or None if stopped
+        """
+        while not stop.is_set():
+            try:
+                return self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return None
+
+
+class CohortSender(object):
+
+    # the queue depths are logged every this number of cases
+    LOG_EVERY = 100
+    # the interval at which the stage threads are checked while waiting for a case to complete
+    CHECK_SECONDS = 1
+
+    def __init__(self, sender, fetch_workers=4, mapping_processes=None, upload_workers=2, scheduler=None,
+                 huge_lane_workers=1, max_cases_in_flight=None, max_cost_in_flight=None, queue_size=None,
+                 map_timeout=600):
+        """
+        Sends many cases fetching from the CIPAPI and CVA and uploading to Decipher in threads while the CPU bound
+        mapping runs in a pool of processes. The stages are linked by bounded queues and the cases in flight, from
+        the start of their fetch to the end of their upload, are capped so fetching cannot run ahead of a slow
+        upload and fill the memory.
+        :type sender: Gel2Decipher
+        :param fetch_workers: the number of threads fetching cases
+        :param mapping_processes: the number of mapping processes, None uses all available cores
+        :param upload_workers: the number of threads uploading cases to Decipher
+        :param scheduler: orders the cases by estimated cost, by default these are sent in the given order
+        :type scheduler: CaseScheduler
+        :param huge_lane_workers: the number of fetch threads serving the huge lane of the scheduler first
+        :param max_cases_in_flight: the maximum number of cases in flight, by default twice the number of workers
+        :param max_cost_in_flight: the maximum sum of the estimated costs of the cases in flight, None for no limit
+        :param queue_size: the capacity of the queues between stages, by default the number of workers reading them
+        :param map_timeout: the seconds given to map a case, shortened to the deadline of the case. A case is lost
+        when its mapping process dies, eg: killed for running out of memory, it fails once this time is over.
+        """
+        self.sender = sender
+        self.fetch_workers = fetch_workers
+        self.mapping_processes = mapping_processes if mapping_processes is not None else multiprocessing.cpu_count()
+        self.upload_workers = upload_workers
+        self.scheduler = scheduler if scheduler is not None else CaseScheduler()
+        self.huge_lane_workers = huge_lane_workers if self.scheduler.huge_cost is not None else 0
+        self.max_cases_in_flight = max_cases_in_flight if max_cases_in_flight is not None else \
+            2 * (fetch_workers + self.mapping_processes + upload_workers)
+        self.max_cost_in_flight = max_cost_in_flight
+        self.queue_size = queue_size
+        self.map_timeout = map_timeout
+        self._lane_errors = []
+        self._cases_in_flight = None
+        self._cost_in_flight = None
+        self._stages = []
+
+    def _fetch(self, case):
+        case_id, case_version = case
+        # no case is started during an outage of any upstream
+        wait_for_upstreams()
+        work_item = {'case_id': case_id, 'case_version': case_version, 'payload': None, 'patient_id': None,
+                     'error': None, 'deadline': None}
+        try:
+            # the deadline of the case starts with the fetch and carries on into the upload
+            with self.sender.profiler.profile_case(case_id, case_version, "fetch"), \
+                    deadline(self.sender.case_deadline):
+                work_item['deadline'] = get_deadline()
+                work_item['payload'] = self.sender.fetch_case(case_id, case_version)
+        except Exception, ex:
+            logging.error("Failed fetching case id={} and version={}: {}".format(case_id, case_version, str(ex)))
+            work_item['error'] = ex
+        return work_item
+
+    def _case_cost(self, case):
+        return self.scheduler.costs.get(case, 0.0) if self.max_cost_in_flight is not None else 0.0
+
+    def _fetch_lane(self, index, fetched, stop):
+        lane = CaseScheduler.HUGE if index < self.huge_lane_workers else CaseScheduler.SMALL
+        # every fetch worker takes the next case from the scheduler when there is room for one more case in flight
+        while self._cases_in_flight.acquire(1, stop):
+            case = self.scheduler.pop(lane)
+            if case is None:
+                self._cases_in_flight.release(1)
+                return
+            cost = self._case_cost(case)
+            if not self._cost_in_flight.acquire(cost, stop):
+                return
+            work_item = self._fetch(case)
+            work_item['cost'] = cost
+            if not fetched.put(work_item, stop):
+                return
+
+    def _map_lane(self, index, mapping_pool, mapping_options, mapping_profiler, fetched, mapped, stop):
+        work_item = fetched.get(stop)
+        while work_item is not None:
+            result = mapping_pool.apply_async(_map_work_item, ((work_item, mapping_options, mapping_profiler),))
+            expires = time.time() + self.map_timeout
+            if work_item['deadline'] is not None:
+                expires = min(expires, work_item['deadline'])
+            while not result.ready() and time.time() < expires:
+                if stop.is_set():
+                    return
+                result.wait(0.1)
+            try:
+                if not result.ready():
+                    raise DeadlineExceeded("The case was not mapped in time, its mapping process may have died")
+                work_item = result.get()
+            except Exception, ex:
+                # the work item could not be sent to or back from the mapping process
+                work_item['payload'] = None
+                work_item['error'] = ex
+            if not mapped.put(work_item, stop):
+                return
+            work_item = fetched.get(stop)
+
+    def _upload_lane(self, index, mapped, uploaded, stop):
+        work_item = mapped.get(stop)
+        while work_item is not None:
+            work_item = self._upload(work_item)
+            # the payload is gone, the case does not hold memory anymore
+            self._cases_in_flight.release(1)
+            self._cost_in_flight.release(work_item['cost'])
+            uploaded.put(work_item)
+            work_item = mapped.get(stop)
+
+    def _run_lane(self, target, *args):
+        try:
+            target(*args)
+        except Exception, ex:
+            # the case in the hands of this thread is lost, the send is aborted instead of waiting for it forever
+            logging.error("Stage thread {} failed: {}".format(threading.current_thread().name, str(ex)))
+            self._lane_errors.append(ex)
+
+    def _start_threads(self, target, args, workers, name):
+        threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._run_lane, args=(target, index) + args,
+                                      name="{}-{}".format(name, index))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _next_completed(self, uploaded, threads):
+        """
+        Waits for the next case to complete, checking that the stage threads are alive
+        :param threads: the fetch threads finish once the cases are drained, the others run until stopped
+        :type threads: list
+        :rtype: dict
+        """
+        while True:
+            try:
+                # a timed wait can be interrupted with Ctrl-C
+                return uploaded.get(timeout=self.CHECK_SECONDS)
+            except Queue.Empty:
+                pass
+            if self._lane_errors:
+                raise ValueError("A stage thread failed, cases were lost: {}".format(str(self._lane_errors[0])))
+            stopped = [thread.name for thread in threads if not thread.is_alive() and
+                       not thread.name.startswith("fetch")]
+            if stopped:
+                raise ValueError("The stage threads {} stopped, cases were lost".format(", ".join(stopped)))
+
+    def _upload(self, work_item):
+        if work_item['error'] is None:
+            try:
+                with self.sender.profiler.profile_case(work_item['case_id'], work_item['case_version'], "upload"), \
+                        deadline(at=work_item['deadline']):
+                    work_item['patient_id'] = self.sender.upload_case(work_item['payload'])
+            except Exception, ex:
+                logging.error("Failed uploading case id={} and version={}: {}".format(
+                    work_item['case_id'], work_item['case_version'], str(ex)))
+                work_item['error'] = ex
+        work_item['payload'] = None
+        return work_item
+
+    def queue_depths(self):
+        """
+        :return: the cases waiting in every queue and in flight, with their peaks, for the current send
+        :rtype: dict
+        """
+        depths = dict((stage.name, {'depth': stage.queue.qsize(), 'peak': stage.peak}) for stage in self._stages)
+        if self._cases_in_flight is not None:
+            depths['cases_in_flight'] = {'depth': self._cases_in_flight.used, 'peak': self._cases_in_flight.peak}
+            depths['cost_in_flight'] = {'depth': self._cost_in_flight.used, 'peak': self._cost_in_flight.peak}
+        return depths
+
+    def send_cases(self, cases):
+        """
+        :param cases: the list of (case_id, case_version) to send
+        :type cases: list
+        :return: iterates over (case_id, case_version, patient_id, error) as cases are completed
+        """
+        total = self.scheduler.add_cases(cases)
+        self.scheduler.log_summary()
+        # the mapping processes are forked before any thread is started
+        mapping_pool = multiprocessing.Pool(self.mapping_processes)
+        stop = threading.Event()
+        self._cases_in_flight = _Budget(self.max_cases_in_flight)
+        self._cost_in_flight = _Budget(self.max_cost_in_flight if self.max_cost_in_flight is not None else 0)
+        fetched = _Stage("fetched", self.queue_size or self.mapping_processes)
+        mapped = _Stage("mapped", self.queue_size or self.upload_workers)
+        # the results are small, the payloads have been released
+        uploaded = Queue.Queue()
+        self._stages = [fetched, mapped]
+        self._lane_errors = []
+        threads = []
+        try:
+            threads += self._start_threads(self._fetch_lane, (fetched, stop), self.fetch_workers, "fetch")
+            threads += self._start_threads(
+                self._map_lane, (mapping_pool, self.sender.mapping_options(), self.sender.profiler.for_process(),
+                                 fetched, mapped, stop),
+                self.mapping_processes, "map")
+            threads += self._start_threads(self._upload_lane, (mapped, uploaded, stop), self.upload_workers, "upload")
+            for completed in range(1, total + 1):
+                work_item = self._next_completed(uploaded, threads)
+                if completed % self.LOG_EVERY == 0:
+                    logging.info("Sent {} of {} cases, queue depths: {}".format(completed, total, self.queue_depths()))
+                yield work_item['case_id'], work_item['case_version'], work_item['patient_id'], work_item['error']
+            logging.info("Cohort sent, queue depths: {}".format(self.queue_depths()))
+        finally:
+            # the cases being fetched or uploaded are completed
+            stop.set()
+            for thread in threads:
+                thread.join()
+            mapping_pool.terminate()
@@ -201,16 +201,35 @@ def map_report_event(report_event, grch37_variant, variant_call, consequence_typ
     :type patient_id: str
     :rtype: Snv
     """
+    return _map_grch37_snv(grch37_variant.chromosome, grch37_variant.start, grch37_variant.reference,
+                           grch37_variant.alternate, variant_call.zygosity, report_event.eventJustification,
+                           consequence_type, patient_id)
+
+
+def map_accepted_variant(accepted_variant, consequence_type, patient_id):
+    """
+    :type accepted_variant: AcceptedVariant
+    :type consequence_type: ConsequenceType
+    :type patient_id: str
+    :rtype: Snv
+    """
+    return _map_grch37_snv(accepted_variant.chromosome, accepted_variant.start, accepted_variant.reference,
+                           accepted_variant.alternate, accepted_variant.zygosity, accepted_variant.event_justification,
+                           consequence_type, patient_id)
+
+
+def _map_grch37_snv(chromosome, start, reference, alternate, zygosity, event_justification, consequence_type,
+                    patient_id):
     snv = decipher_models.Snv(
         patient_id=patient_id,
         assembly=map_assembly(Assembly.GRCh37),
-        chr=normalise_chromosome(grch37_variant.chromosome),
-        start=grch37_variant.start,
-        ref_allele=grch37_variant.reference,
-        alt_allele=grch37_variant.alternate,
-        genotype=map_genotype(variant_call.zygosity),
+        chr=normalise_chromosome(chromosome),
+        start=start,
+        ref_allele=reference,
+        alt_allele=alternate,
+        genotype=map_genotype(zygosity),
         intergenic=False,
-        inheritance= map_inheritance(report_event.eventJustification),
+        inheritance= map_inheritance(event_justification),
         user_transcript=consequence_type.ensemblTranscriptId,
         user_gene=consequence_type.geneName
     )
@@ -0,0 +1,170 @@
+import logging
+import mmap
+import os
+import struct
+
+
+class HpoIndex(object):
+    """
+    A compact index of the HPO terms built from an OBO file, including obsolete terms and alternative identifiers.
+    The index is a binary file of fixed size records sorted by term and memory-mapped for lookups:
+    (term, target, flags) as unsigned 32 bits integers, where target is the replacement of an obsolete term or
+    the primary term of an alternative identifier.
+    """
+
+    MAGIC = "HPOIDX01"
+    HEADER = struct.Struct("<8sI")
+    RECORD = struct.Struct("<III")
+    OBSOLETE = 1
+    ALTERNATIVE = 2
+
+    VALID = "valid"
+    OBSOLETE_TERM = "obsolete"
+    ALTERNATIVE_TERM = "alternative"
+    UNKNOWN_TERM = "unknown"
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._open()
+
+    def _open(self):
+        with open(self.index_file, "rb") as index:
+            self._mmap = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC:
+            raise ValueError("{} is not an HPO index".format(self.index_file))
+
+    def __getstate__(self):
+        # memory maps cannot be pickled, the index is mapped again when unpickled
+        return {'index_file': self.index_file}
+
+    def __setstate__(self, state):
+        self.index_file = state['index_file']
+        self._open()
+
+    @staticmethod
+    def _parse_term(term):
+        return int(str(term).replace("HP:", ""))
+
+    @staticmethod
+    def _format_term(term):
+        return "HP:{:07d}".format(term)
+
+    @staticmethod
+    def _read_obo(obo_file):
+        """
+        :return: the list of (term, target, flags) for every term and alternative identifier
+        """
+        records = {}
+
+        def add_stanza(stanza):
+            if 'id' not in stanza or not stanza['id'][0].startswith("HP:"):
+                return
+            term = HpoIndex._parse_term(stanza['id'][0])
+            flags = 0
+            target = 0
+            if stanza.get('is_obsolete', ['false'])[0] == 'true':
+                flags = HpoIndex.OBSOLETE
+                if 'replaced_by' in stanza:
+                    target = HpoIndex._parse_term(stanza['replaced_by'][0])
+            records[term] = (term, target, flags)
+            for alt_id in stanza.get('alt_id', []):
+                alternative = HpoIndex._parse_term(alt_id)
+                records.setdefault(alternative, (alternative, term, HpoIndex.ALTERNATIVE))
+
+        stanza = None
+        with open(obo_file) as obo:
+            for line in obo:
+                line = line.strip()
+                if line.startswith("["):
+                    if stanza is not None:
+                        add_stanza(stanza)
+                    stanza = {} if line == "[Term]" else None
+                elif stanza is not None and ":" in line:
+                    tag, value = line.split(":", 1)
+                    # drops trailing modifiers and comments
+                    value = value.split(" !")[0].strip()
+                    stanza.setdefault(tag, []).append(value)
+        if stanza is not None:
+            add_stanza(stanza)
+        return [records[term] for term in sorted(records)]
+
+    @staticmethod
+    def build(obo_file, index_file):
+        """
+        Builds the index file from an OBO file
+        :rtype: HpoIndex
+        """
+        records = HpoIndex._read_obo(obo_file)
+        temporary_file = "{}.{}.tmp".format(index_file, os.getpid())
+        with open(temporary_file, "wb") as index:
+            index.write(HpoIndex.HEADER.pack(HpoIndex.MAGIC, len(records)))
+            for record in records:
+                index.write(HpoIndex.RECORD.pack(*record))
+        os.rename(temporary_file, index_file)
+        logging.info("Built HPO index with {} terms at {}".format(len(records), index_file))
+        return HpoIndex(index_file)
+
+    @staticmethod
+    def from_obo(obo_file):
+        """
+        Opens the index next to the OBO file building it if missing or outdated
+        :rtype: HpoIndex
+        """
+        index_file = "{}.idx".format(obo_file)
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(obo_file):
+            return HpoIndex.build(obo_file, index_file)
+        return HpoIndex(index_file)
+
+    def _find(self, term):
+        low = 0
+        high = self.size
+        while low < high:
+            middle = (low + high) // 2
+            record = self.RECORD.unpack_from(self._mmap, self.HEADER.size + middle * self.RECORD.size)
+            if record[0] < term:
+                low = middle + 1
+            elif record[0] > term:
+                high = middle
+            else:
+                return record
+        return None
+
+    def lookup(self, term):
+        """
+        :param term: an HPO term as in HP:0000118
+        :return: the status of the term and its replacement or primary term if any
+        """
+        try:
+            record = self._find(HpoIndex._parse_term(term))
+        except ValueError:
+            return self.UNKNOWN_TERM, None
+        if record is None:
+            return self.UNKNOWN_TERM, None
+        _, target, flags = record
+        target = HpoIndex._format_term(target) if target else None
+        if flags & self.OBSOLETE:
+            return self.OBSOLETE_TERM, target
+        if flags & self.ALTERNATIVE:
+            return self.ALTERNATIVE_TERM, target
+        return self.VALID, None
+
+    def validate(self, term, migrate=False):
+        """
+        :param term: an HPO term as in HP:0000118
+        :param migrate: obsolete terms and alternative identifiers are replaced by their current term
+        :return: the term to send or None if it should not be sent
+        """
+        migrated = term
+        # follows chains of replacements, bounded in case of cycles in the ontology
+        for _ in range(10):
+            status, replacement = self.lookup(migrated)
+            if status == self.VALID:
+                if migrated != term:
+                    logging.warning("Migrated HPO term {} to {}".format(term, migrated))
+                return migrated
+            if status == self.UNKNOWN_TERM or replacement is None or not migrate:
+                logging.warning("HPO term {} is {}".format(migrated, status))
+                return None
+            migrated = replacement
+        return None
@@ -0,0 +1,123 @@
+import cProfile
+import contextlib
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+
+
+class NullProfiler(object):
+    """
+    Does not profile anything
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @contextlib.contextmanager
+    def profile_case(self, case_id, case_version, stage="send"):
+        yield
+
+    def for_process(self):
+        """
+        :return: a picklable profiler for the cases mapped in other processes
+        """
+        return self
+
+
+class DeterministicProfiler(NullProfiler):
+    """
+    Profiles every case with cProfile and writes one pstats file per case and stage, also from the processes mapping
+    the cases
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+    @contextlib.contextmanager
+    def profile_case(self, case_id, case_version, stage="send"):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            stats_file = os.path.join(self.output_dir, "case-{}-{}-{}.pstats".format(case_id, case_version, stage))
+            profile.dump_stats(stats_file)
+            logging.info("Wrote profile {}".format(stats_file))
+
+
+class SamplingProfiler(NullProfiler):
+    """
+    Samples the stacks of the threads processing a case at a fixed interval, with a low overhead suited to long
+    bulk runs. The samples of all cases are merged and written on stop in the collapsed stacks format read by
+    flame graph tools, one line per distinct stack: frame;frame;frame count
+    """
+
+    def __init__(self, output_file, interval=0.005):
+        """
+        :param output_file: the file to write the collapsed stacks
+        :param interval: the seconds between samples
+        """
+        self.output_file = output_file
+        self.interval = interval
+        self.samples = Counter()
+        self.threads = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample)
+        self.sampler.daemon = True
+
+    def start(self):
+        self.sampler.start()
+
+    def for_process(self):
+        # the sampler thread only sees the threads of its own process
+        logging.warning("The cases mapped in other processes are not sampled")
+        return NullProfiler()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        with open(self.output_file, "w") as output:
+            for stack, count in sorted(self.samples.iteritems()):
+                output.write("{} {}\n".format(stack, count))
+        logging.info("Wrote {} samples to {}".format(sum(self.samples.values()), self.output_file))
+
+    @contextlib.contextmanager
+    def profile_case(self, case_id, case_version, stage="send"):
+        thread_id = threading.current_thread().ident
+        with self.lock:
+            self.threads[thread_id] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.threads[thread_id] -= 1
+                if self.threads[thread_id] == 0:
+                    del self.threads[thread_id]
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                thread_ids = list(self.threads)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.samples[self._collapse(frame)] += 1
@@ -0,0 +1,152 @@
+import logging
+import threading
+from gel2decipher_sender.clients.decipher_client import DecipherClient
+from gel2decipher_sender.clients.deadline import check_deadline
+
+
+def snv_key(snv):
+    """
+    :param snv: a variant as returned by Decipher or mapped by map_case
+    :type snv: dict
+    :rtype: str
+    """
+    return "{}:{}:{}:{}".format(snv['chr'], snv['start'], snv['ref_allele'], snv['alt_allele'])
+
+
+class ProjectMirror(object):
+    """
+    A local index of the patients in a Decipher project, their persons, phenotypes and variants. Patients are loaded
+    in one sweep over the project, persons, phenotypes and variants are loaded the first time they are needed.
+    Afterwards the index is kept up to date from our own writes, so checking whether something exists does not need a
+    request.
+    """
+
+    def __init__(self, decipher):
+        """
+        :type decipher: DecipherClient
+        """
+        self.decipher = decipher
+        self.lock = threading.Lock()
+        # notified when a reference reserved to create its patient is released
+        self.released = threading.Condition(self.lock)
+        self.patients = {}
+        self.reserved = set()
+        self.persons = {}
+        self.phenotypes = {}
+        self.snvs = {}
+
+    def build(self):
+        with self.lock:
+            self.patients = {}
+            self.persons = {}
+            self.phenotypes = {}
+            self.snvs = {}
+            for patient in self.decipher.iter_patients():
+                self.patients[patient['reference']] = patient['patient_id']
+            logging.info("Mirrored {} patients from project {}".format(len(self.patients), self.decipher.project_id))
+
+    def get_patient_id(self, reference):
+        """
+        :return: the patient id or None if there is no patient with this reference
+        """
+        with self.lock:
+            return self.patients.get(reference)
+
+    def reserve_patient(self, reference):
+        """
+        Gets the patient id or reserves the reference for the caller to create the patient, who must then either add
+        or release it. Callers for a reference reserved by another thread wait until it is released.
+        :return: the patient id or None if the reference was reserved for the caller
+        """
+        with self.lock:
+            while reference in self.reserved:
+                # waits with a timeout to honour the deadline of the case
+                self.released.wait(1)
+                check_deadline()
+            patient_id = self.patients.get(reference)
+            if patient_id is None:
+                self.reserved.add(reference)
+            return patient_id
+
+    def release_patient(self, reference):
+        """
+        Releases a reference reserved to create its patient when the patient could not be created
+        """
+        with self.lock:
+            self.reserved.discard(reference)
+            self.released.notify_all()
+
+    def add_patient(self, reference, patient_id):
+        with self.lock:
+            self.patients[reference] = patient_id
+            # a new patient has no variants
+            self.snvs[patient_id] = set()
+            self.reserved.discard(reference)
+            self.released.notify_all()
+
+    def remove_patient(self, reference):
+        with self.lock:
+            patient_id = self.patients.pop(reference, None)
+            for person in self.persons.pop(patient_id, None) or []:
+                self.phenotypes.pop(person['person_id'], None)
+            self.snvs.pop(patient_id, None)
+
+    def get_persons(self, patient_id):
+        """
+        :return: the persons for the patient as returned by Decipher
+        :rtype: list
+        """
+        with self.lock:
+            persons = self.persons.get(patient_id)
+        if persons is None:
+            # requests are not made holding the lock
+            persons = list(self.decipher.iter_persons_by_patient(patient_id))
+            with self.lock:
+                persons = self.persons.setdefault(patient_id, persons)
+        return list(persons)
+
+    def add_person(self, patient_id, person_id, relation):
+        self.get_persons(patient_id)
+        with self.lock:
+            self.persons[patient_id].append({'person_id': person_id, 'relation': relation})
+            # a new person has no phenotypes
+            self.phenotypes[person_id] = set()
+
+    def get_phenotype_ids(self, person_id):
+        """
+        :return: the HPO term numbers registered for the person
+        :rtype: set
+        """
+        with self.lock:
+            phenotype_ids = self.phenotypes.get(person_id)
+        if phenotype_ids is None:
+            phenotype_ids = set(phenotype['phenotype_id'] for phenotype in self.decipher.iter_phenotypes(person_id))
+            with self.lock:
+                phenotype_ids = self.phenotypes.setdefault(person_id, phenotype_ids)
+        return set(phenotype_ids)
+
+    def add_phenotypes(self, person_id, phenotype_ids):
+        """
+        Phenotypes of a person not loaded yet are read from Decipher when first needed, including these
+        """
+        with self.lock:
+            if person_id in self.phenotypes:
+                self.phenotypes[person_id].update(phenotype_ids)
+
+    def get_snv_keys(self, patient_id):
+        """
+        :return: the keys chr:start:ref:alt of the variants of the patient
+        :rtype: set
+        """
+        with self.lock:
+            keys = self.snvs.get(patient_id)
+        if keys is None:
+            keys = set(snv_key(snv) for snv in self.decipher.iter_snvs(patient_id))
+            with self.lock:
+                keys = self.snvs.setdefault(patient_id, keys)
+        return set(keys)
+
+    def add_snvs(self, patient_id, keys):
+        self.get_snv_keys(patient_id)
+        with self.lock:
+            self.snvs[patient_id].update(keys)
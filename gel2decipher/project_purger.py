@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import HTTPError
+from gel2decipher_sender.clients.decipher_client import DecipherClient
+
+
+class _RateLimit(object):
+    """
+    Pauses every worker when Decipher answers 429, honouring the Retry-After header if any
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paused_until = 0
+
+    def wait(self):
+        delay = self.paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, response, attempt):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else random.uniform(0, 2 ** attempt)
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + delay)
+        logging.warning("Rate limited by Decipher, pausing for {} seconds".format(delay))
+
+
+class ProjectPurger(object):
+
+    STATUS_DELETED = "deleted"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, decipher, progress_file, workers=4, max_attempts=8):
+        """
+        Deletes the patients in a Decipher project in parallel. Every deleted patient is appended to the progress
+        file so an interrupted purge can be resumed.
+        :type decipher: DecipherClient
+        :param progress_file: a file with one JSON record per patient processed
+        :param workers: the number of concurrent deletions
+        :param max_attempts: the number of attempts for a deletion being rate limited
+        """
+        self.decipher = decipher
+        self.progress_file = progress_file
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.rate_limit = _RateLimit()
+        self.progress_lock = threading.Lock()
+
+    def _read_progress(self):
+        deleted = set()
+        if os.path.exists(self.progress_file):
+            with open(self.progress_file) as progress:
+                for line in progress:
+                    record = json.loads(line)
+                    if record['status'] == self.STATUS_DELETED:
+                        deleted.add(str(record['patient_id']))
+        return deleted
+
+    def _write_progress(self, patient_id, status, error=None):
+        with self.progress_lock:
+            with open(self.progress_file, "a") as progress:
+                progress.write(json.dumps({'patient_id': patient_id, 'status': status, 'error': error}) + "\n")
+
+    @staticmethod
+    def _is_selected(patient, reference_prefix, created_before):
+        if reference_prefix is not None and not str(patient.get('reference', '')).startswith(reference_prefix):
+            return False
+        if created_before is not None:
+            created = patient.get('created')
+            if created is None or datetime.strptime(created[:10], "%Y-%m-%d") >= created_before:
+                return False
+        return True
+
+    def select_patients(self, reference_prefix=None, created_before=None):
+        """
+        :param reference_prefix: only patients having a reference starting with this prefix
+        :param created_before: only patients created before this date
+        :type created_before: datetime
+        :return: the identifiers of the patients to delete not deleted in a previous run
+        """
+        deleted = self._read_progress()
+        return [patient['patient_id'] for patient in self.decipher.iter_patients()
+                if ProjectPurger._is_selected(patient, reference_prefix, created_before) and
+                str(patient['patient_id']) not in deleted]
+
+    def _delete(self, patient_id):
+        for attempt in range(self.max_attempts):
+            self.rate_limit.wait()
+            try:
+                self.decipher.delete_patient(patient_id)
+                self._write_progress(patient_id, self.STATUS_DELETED)
+                return True
+            except HTTPError, ex:
+                if ex.response is not None and ex.response.status_code == 429:
+                    self.rate_limit.pause(ex.response, attempt)
+                    continue
+                logging.error("Failed deleting patient {}: {}".format(patient_id, str(ex)))
+                self._write_progress(patient_id, self.STATUS_FAILED, str(ex))
+                return False
+        self._write_progress(patient_id, self.STATUS_FAILED, "Rate limited")
+        return False
+
+    def purge(self, reference_prefix=None, created_before=None):
+        """
+        :return: the number of patients deleted and failed
+        """
+        patient_ids = self.select_patients(reference_prefix, created_before)
+        logging.info("Deleting {} patients from project {}".format(len(patient_ids), self.decipher.project_id))
+        pool = ThreadPool(self.workers)
+        try:
+            deleted = 0
+            failed = 0
+            for success in pool.imap_unordered(self._delete, patient_ids):
+                if success:
+                    deleted += 1
+                else:
+                    failed += 1
+                if (deleted + failed) % 100 == 0:
+                    logging.info("Deleted {} of {} patients".format(deleted, len(patient_ids)))
+        finally:
+            pool.terminate()
+        logging.info("Deleted {} patients, {} failed".format(deleted, failed))
+        return deleted, failed
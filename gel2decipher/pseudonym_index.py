@@ -0,0 +1,97 @@
+import logging
+import time
+import gel2decipher_sender.models.gel2decipher_mappings as gel2decipher
+from gel2decipher_sender.sqlite_connections import SqliteConnections
+
+
+class PseudonymIndex(SqliteConnections):
+    """
+    A persistent index of the pseudonyms sent to Decipher. Every case sent records the GEL participant id of its
+    proband, the hashed reference it was sent as and the Decipher patient id, so a case, a participant, a reference or
+    a patient are looked up in either direction through an indexed table instead of re-hashing a cohort or scanning
+    Decipher.
+    """
+
+    FIELDS = ["participant_id", "reference", "case_id", "case_version", "patient_id", "project_id", "recorded"]
+
+    def __init__(self, database):
+        """
+        :param database: the SQLite database file
+        """
+        self.database = database
+        self._reset()
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS pseudonyms ("
+                "participant_id TEXT NOT NULL, reference TEXT NOT NULL, case_id TEXT NOT NULL, "
+                "case_version TEXT NOT NULL, patient_id INTEGER, project_id INTEGER, recorded REAL NOT NULL, "
+                "PRIMARY KEY (case_id, case_version))")
+            connection.execute("CREATE INDEX IF NOT EXISTS pseudonyms_participant_id ON pseudonyms (participant_id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS pseudonyms_reference ON pseudonyms (reference)")
+            connection.execute("CREATE INDEX IF NOT EXISTS pseudonyms_patient_id ON pseudonyms (patient_id)")
+
+    def record(self, participant_id, case_id, case_version, patient_id, project_id=None, reference=None):
+        """
+        Records a case sent to Decipher, a case sent again replaces its previous record
+        :param participant_id: the GEL participant id of the proband
+        :param reference: the reference the proband was sent as, by default the hash of the participant id
+        """
+        self.import_records([(participant_id, case_id, case_version, patient_id, project_id, reference)])
+
+    def import_records(self, records):
+        """
+        Imports the cases of an existing cohort in one transaction
+        :param records: tuples of participant_id, case_id, case_version, patient_id, project_id and reference, the
+        last three can be None and the reference is by default the hash of the participant id
+        :type records: collections.Iterable
+        :return: the number of records imported
+        """
+        now = time.time()
+        rows = [(str(participant_id), reference if reference is not None else gel2decipher.hash_id(participant_id),
+                 str(case_id), str(case_version), patient_id, project_id, now)
+                for participant_id, case_id, case_version, patient_id, project_id, reference in records]
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO pseudonyms "
+                "(participant_id, reference, case_id, case_version, patient_id, project_id, recorded) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        logging.info("Recorded {} pseudonyms".format(len(rows)))
+        return len(rows)
+
+    def _select(self, column, value):
+        cursor = self._connect().execute(
+            "SELECT {} FROM pseudonyms WHERE {} = ? ORDER BY recorded".format(", ".join(self.FIELDS), column),
+            (value,))
+        return [dict(zip(self.FIELDS, row)) for row in cursor.fetchall()]
+
+    def by_case(self, case_id, case_version=None):
+        """
+        :param case_version: every version of the case if None
+        :return: the records of the case, the latest last
+        :rtype: list
+        """
+        records = self._select("case_id", str(case_id))
+        return [record for record in records if case_version is None or record['case_version'] == str(case_version)]
+
+    def by_participant(self, participant_id):
+        """
+        :rtype: list
+        """
+        return self._select("participant_id", str(participant_id))
+
+    def by_reference(self, reference):
+        """
+        :rtype: list
+        """
+        return self._select("reference", reference)
+
+    def by_patient_id(self, patient_id):
+        """
+        :rtype: list
+        """
+        return self._select("patient_id", patient_id)
+
+    def __len__(self):
+        return self._connect().execute("SELECT count(*) FROM pseudonyms").fetchone()[0]
@@ -0,0 +1,170 @@
+import array
+import logging
+import numpy
+from multiprocessing.pool import ThreadPool
+import gel2decipher_sender.models.gel2decipher_mappings as gel2decipher
+
+
+class ReportEventColumns(object):
+    """
+    The report events of many cases packed into columnar arrays, one row per report event, so the eligibility of a
+    cohort is computed with vectorised operations instead of walking the report events one by one.
+    Columns:
+    * case: the index of the case in case_ids
+    * chromosome: the code of the GRCh37 chromosome, 1 to 22, 23 for X, 24 for Y, 25 for MT and 0 if unknown
+    * position: the GRCh37 start, -1 if unknown
+    * tier: 1, 2 or 3, 0 if unknown
+    * zygosity: the code of the zygosity of the proband call, the position in ZYGOSITIES plus one and 0 if unknown
+    * has_grch37: whether the proband variant has a GRCh37 representation
+    * has_proband_call: whether the report event has an observed variant for the proband
+    """
+
+    CHROMOSOMES = dict([(str(chromosome), chromosome) for chromosome in range(1, 23)] +
+                       [("X", 23), ("Y", 24), ("MT", 25), ("M", 25)])
+    TIERS = {"TIER1": 1, "TIER2": 2, "TIER3": 3}
+    ZYGOSITIES = ["reference_homozygous", "heterozygous", "alternate_homozygous", "missing", "half_missing_reference",
+                  "half_missing_alternate", "alternate_hemizygous", "reference_hemizygous", "unk"]
+    COLUMNS = ["case", "chromosome", "position", "tier", "zygosity", "has_grch37", "has_proband_call"]
+
+    def __init__(self, case_ids, case, chromosome, position, tier, zygosity, has_grch37, has_proband_call):
+        """
+        :param case_ids: the (case_id, case_version) of every case
+        :type case_ids: list
+        """
+        self.case_ids = case_ids
+        self.case = case
+        self.chromosome = chromosome
+        self.position = position
+        self.tier = tier
+        self.zygosity = zygosity
+        self.has_grch37 = has_grch37
+        self.has_proband_call = has_proband_call
+
+    def __len__(self):
+        return len(self.case)
+
+    @staticmethod
+    def from_fetched_cases(fetched_cases):
+        """
+        :param fetched_cases: the cases as returned by Gel2Decipher.fetch_case, with slim report events
+        :type fetched_cases: collections.Iterable
+        :rtype: ReportEventColumns
+        """
+        zygosity_codes = dict((zygosity, code + 1) for code, zygosity in enumerate(ReportEventColumns.ZYGOSITIES))
+        case_ids = []
+        # typed buffers grow without boxing every value, they are turned into arrays without copying
+        case = array.array('i')
+        chromosome = array.array('b')
+        position = array.array('l')
+        tier = array.array('b')
+        zygosity = array.array('b')
+        has_grch37 = array.array('b')
+        has_proband_call = array.array('b')
+        for fetched_case in fetched_cases:
+            case_index = len(case_ids)
+            case_ids.append((fetched_case['case_id'], fetched_case['case_version']))
+            for report_event in fetched_case['report_events']:
+                observed_variants = report_event['observedVariants']
+                variant_call = observed_variants[0]['variantCall'] if observed_variants else {}
+                representations = observed_variants[0]['variant']['variants'] if observed_variants else []
+                variant = representations[0]['variant'] if representations else {}
+                case.append(case_index)
+                chromosome.append(ReportEventColumns.CHROMOSOMES.get(
+                    gel2decipher.normalise_chromosome(variant.get('chromosome') or ""), 0))
+                position.append(variant.get('start') if variant.get('start') is not None else -1)
+                tier.append(ReportEventColumns.TIERS.get(report_event['reportEvent'].get('tier'), 0))
+                zygosity.append(zygosity_codes.get(variant_call.get('zygosity'), 0))
+                has_grch37.append(len(representations) > 0)
+                has_proband_call.append(len(observed_variants) > 0)
+        logging.info("Packed {} report events from {} cases".format(len(case), len(case_ids)))
+        return ReportEventColumns(
+            case_ids,
+            numpy.frombuffer(case, dtype=numpy.int32) if case else numpy.zeros(0, dtype=numpy.int32),
+            numpy.frombuffer(chromosome, dtype=numpy.int8) if chromosome else numpy.zeros(0, dtype=numpy.int8),
+            numpy.array(position, dtype=numpy.int64),
+            numpy.frombuffer(tier, dtype=numpy.int8) if tier else numpy.zeros(0, dtype=numpy.int8),
+            numpy.frombuffer(zygosity, dtype=numpy.int8) if zygosity else numpy.zeros(0, dtype=numpy.int8),
+            numpy.array(has_grch37, dtype=numpy.bool_),
+            numpy.array(has_proband_call, dtype=numpy.bool_))
+
+    @staticmethod
+    def from_cases(sender, cases, workers=4):
+        """
+        Fetches the cases in threads and packs their report events
+        :type sender: Gel2Decipher
+        :param cases: the (case_id, case_version) to load
+        :param workers: the number of threads fetching cases
+        :rtype: ReportEventColumns
+        """
+        pool = ThreadPool(workers)
+        try:
+            return ReportEventColumns.from_fetched_cases(
+                pool.imap(lambda case: sender.fetch_case(case[0], case[1]), cases))
+        finally:
+            pool.terminate()
+
+    def save(self, path):
+        """
+        Writes the columns into a NumPy .npz file
+        """
+        numpy.savez(path, case_ids=numpy.array(self.case_ids, dtype=str).reshape(-1, 2),
+                    **dict((column, getattr(self, column)) for column in self.COLUMNS))
+
+    @staticmethod
+    def load(path):
+        """
+        :rtype: ReportEventColumns
+        """
+        data = numpy.load(path)
+        case_ids = [(str(case_id), str(case_version)) for case_id, case_version in data['case_ids']]
+        return ReportEventColumns(case_ids, **dict((column, data[column]) for column in ReportEventColumns.COLUMNS))
+
+    def mappable_genotype(self):
+        """
+        :return: a mask of the report events whose zygosity maps to a Decipher genotype
+        """
+        mappable = [code + 1 for code, zygosity in enumerate(self.ZYGOSITIES)
+                    if gel2decipher.map_genotype(zygosity) is not None]
+        return numpy.in1d(self.zygosity, mappable)
+
+    def eligible(self):
+        """
+        :return: a mask of the report events that would be sent: a proband call with a GRCh37 representation, a
+        genotype Decipher accepts and tier 1 or 2
+        """
+        return self.has_proband_call & self.has_grch37 & ((self.tier == 1) | (self.tier == 2)) & \
+            self.mappable_genotype()
+
+    def count_by_case(self, mask=None):
+        """
+        :param mask: counts only the report events in the mask, all if None
+        :return: the number of report events of every case, in the order of case_ids
+        """
+        case = self.case if mask is None else self.case[mask]
+        return numpy.bincount(case, minlength=len(self.case_ids))
+
+    def eligible_cases(self, min_events=1):
+        """
+        :param min_events: the number of eligible report events required
+        :return: the (case_id, case_version) having enough eligible report events
+        :rtype: list
+        """
+        counts = self.count_by_case(self.eligible())
+        return [self.case_ids[index] for index in numpy.flatnonzero(counts >= min_events)]
+
+    def summary(self):
+        """
+        :return: the number of report events and of cases passing every criteria
+        :rtype: dict
+        """
+        criteria = [
+            ('report_events', numpy.ones(len(self), dtype=numpy.bool_)),
+            ('proband_call', self.has_proband_call),
+            ('grch37', self.has_grch37),
+            ('tier1_tier2', (self.tier == 1) | (self.tier == 2)),
+            ('mappable_genotype', self.mappable_genotype()),
+            ('eligible', self.eligible())
+        ]
+        return dict((name, {'report_events': int(mask.sum()),
+                            'cases': int(numpy.count_nonzero(self.count_by_case(mask)))})
+                    for name, mask in criteria)
@@ -0,0 +1,75 @@
+import logging
+import signal
+import threading
+from gel2decipher_sender.work_queue import WorkQueue, QueueWorker
+from gel2decipher_sender.clients.circuit_breaker import breakers_stats
+
+
+class SenderDaemon(object):
+
+    def __init__(self, sender, work_queue, workers=4, poll_seconds=5):
+        """
+        Keeps one warmed sender running and sends the cases submitted to a work queue as they arrive. The worker
+        threads share the sender so the Decipher info, the connection pools, the circuit breakers, the latency
+        statistics, the project mirror and the transcript cache are reused across cases.
+        :type sender: Gel2Decipher
+        :param work_queue: where cases are submitted, a DirectoryWorkQueue is a spool directory
+        :type work_queue: WorkQueue
+        :param workers: the number of threads sending cases
+        :param poll_seconds: the interval at which an idle worker looks for new cases
+        """
+        self.sender = sender
+        self.work_queue = work_queue
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._threads = []
+        self.sent = [0] * workers
+
+    def _run_worker(self, index, owner):
+        worker = QueueWorker(self.work_queue, self.sender.send_case, owner=owner)
+        try:
+            self.sent[index] = worker.run(poll_seconds=self.poll_seconds, stop=self._stop)
+        except Exception, ex:
+            logging.error("Worker {} stopped: {}".format(owner, str(ex)))
+
+    def start(self):
+        default_owner = WorkQueue.default_owner()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run_worker, args=(index, "{}-{}".format(default_owner, index)),
+                                      name="sender-{}".format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logging.info("Sender daemon started with {} workers".format(self.workers))
+
+    def stop(self, timeout=None):
+        """
+        Stops the workers once their cases in progress are sent
+        :param timeout: seconds to wait for every worker
+        :return: the number of cases sent
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        if self.sender.transcript_cache is not None:
+            self.sender.transcript_cache.report()
+        logging.info("Sender daemon sent {} cases, circuit breakers: {}".format(sum(self.sent), breakers_stats()))
+        return sum(self.sent)
+
+    def serve_forever(self):
+        """
+        Runs until SIGTERM or SIGINT, must be called from the main thread
+        :return: the number of cases sent
+        """
+        def handle_signal(signum, frame):
+            logging.info("Received signal {}, stopping".format(signum))
+            self._stop.set()
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+        self.start()
+        # waits with a timeout as signals do not interrupt a blocking wait
+        while not self._stop.wait(1):
+            pass
+        return self.stop()
@@ -0,0 +1,32 @@
+import os
+import sqlite3
+import threading
+
+
+class SqliteConnections(object):
+    """
+    Gives every thread its own connection to the SQLite database in the database attribute, as SQLite connections
+    cannot be used across threads. Connections are opened again in forked processes and are not pickled, the
+    attributes named in PICKLED are.
+    """
+
+    PICKLED = ['database']
+
+    def _reset(self):
+        """
+        Drops the connections, called on init and when unpickled
+        """
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.PICKLED)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _connect(self):
+        if getattr(self._local, 'connection', None) is None or self._local.pid != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.connection = sqlite3.connect(self.database, timeout=60)
+        return self._local.connection
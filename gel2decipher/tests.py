@@ -1,11 +1,48 @@
 import os
+import gzip
+import json
+import time
+import pickle
+import pstats
+import shutil
 import logging
+import tempfile
+import threading
+import multiprocessing
+from StringIO import StringIO
 from unittest import TestCase
-from requests.exceptions import HTTPError, InvalidSchema
+from requests.exceptions import HTTPError, InvalidSchema, ConnectionError
+from protocols.participant_1_0_3 import PedigreeMember, HpoTerm, ConsentStatus
+from protocols.cva_1_0_0 import ReportEventEntry
+from pyark.cva_client import CvaClient as PyarkCvaClient
 
 from gel2decipher_sender.clients.decipher_client import DecipherClient
+from gel2decipher_sender.clients.rest_client import RestClient, prefetch_pages
+from gel2decipher_sender.clients.deadline import DeadlineExceeded, deadline, get_deadline, check_deadline
+from gel2decipher_sender.clients.hedging import Hedger
+from gel2decipher_sender.clients.single_flight import SingleFlight
+from gel2decipher_sender.clients.transport import InMemoryTransport, InMemoryResponse, RecordingTransport, \
+    ReplayTransport, UnrecordedRequest
+from gel2decipher_sender.clients.circuit_breaker import CircuitBreaker, CircuitOpen
+from gel2decipher_sender.clients.cva_client import CvaClient, iter_json_array
+import gel2decipher_sender.clients.backoff_retrier as backoff_retrier
+import gel2decipher_sender.models.gel2decipher_mappings as gel2decipher
 from gel2decipher_sender.models.decipher_models import *
-from gel2decipher_sender.case_sender import Gel2Decipher, UnacceptableCase
+from gel2decipher_sender.case_sender import Gel2Decipher, UnacceptableCase, slim_report_event
+from gel2decipher_sender.cohort_sender import CohortSender, _map_work_item
+from gel2decipher_sender.case_discovery import CaseDiscovery
+from gel2decipher_sender.project_purger import ProjectPurger
+from gel2decipher_sender.models.hpo_index import HpoIndex
+from gel2decipher_sender.transcript_cache import TranscriptCache
+from gel2decipher_sender.project_mirror import ProjectMirror
+from gel2decipher_sender.pseudonym_index import PseudonymIndex
+from gel2decipher_sender.profiler import DeterministicProfiler, SamplingProfiler, NullProfiler
+from gel2decipher_sender.case_snapshot import CaseSnapshot
+from gel2decipher_sender.report_event_columns import ReportEventColumns
+from gel2decipher_sender.case_prescan import CasePreScan
+from gel2decipher_sender.case_scheduler import CaseScheduler
+from gel2decipher_sender.work_queue import WorkQueue, SqliteWorkQueue, DirectoryWorkQueue, QueueWorker
+from gel2decipher_sender.sender_daemon import SenderDaemon
 
 
 class TestGel2Decipher(TestCase):
@@ -22,7 +59,7 @@ class TestGel2Decipher(TestCase):
 
     def setUp(self):
         logging.basicConfig(level=logging.INFO)
-        config = {
+        self.config = {
             'gel_user': self.GEL_USER,
             'gel_password': self.GEL_PASSWORD,
             'cipapi_url': self.CIPAPI_URL_BASE,
@@ -33,7 +70,7 @@ class TestGel2Decipher(TestCase):
             'send_absent_phenotypes': False
         }
         logging.info("CVA URL: {}".format(self.CVA_URL_BASE))
-        self.sender = Gel2Decipher(config)
+        self.sender = Gel2Decipher(self.config)
 
     def test_send_case(self):
 
@@ -49,6 +86,1222 @@ class TestGel2Decipher(TestCase):
             except UnacceptableCase, e:
                 logging.error(e.message)
 
+    def test_resend_case_with_project_mirror(self):
+
+        self.config['mirror_project'] = True
+        sender = Gel2Decipher(self.config)
+        patient_id = sender.send_case("615", "1")
+        variants = sender.decipher.get_snvs(patient_id)['snvs']
+        self.assertEqual(sender.send_case("615", "1"), patient_id, "Expected the existing patient to be updated")
+        self.assertEqual(len(sender.decipher.get_snvs(patient_id)['snvs']), len(variants))
+        sender.decipher.delete_patient(patient_id)
+
+    def test_send_cases_with_process_pool(self):
+
+        cases = [("615", "1"), ("502", "1"), ("1026", "1"), ("2146", "1")]
+        cohort_sender = CohortSender(self.sender, fetch_workers=2, mapping_processes=2, upload_workers=1)
+        results = list(cohort_sender.send_cases(cases))
+        self.assertEqual(len(results), len(cases))
+        for case_id, case_version, patient_id, error in results:
+            if error is None:
+                self.assertIsNotNone(patient_id)
+                self.sender.decipher.delete_patient(patient_id)
+            else:
+                logging.error("Case {} version {}: {}".format(case_id, case_version, str(error)))
+
+    def test_cva_client_matches_pyark(self):
+
+        query = Gel2Decipher._report_events_query("615", "1")
+        pyark_client = PyarkCvaClient(self.CVA_URL_BASE, user=self.GEL_USER, password=self.GEL_PASSWORD)
+        expected = [report_event.toJsonDict() for report_event in pyark_client.report_events().get_report_events(query)]
+        self.assertGreater(len(expected), 0)
+        report_events = list(self.sender.cva.get_report_events_raw(query))
+        self.assertEqual([ReportEventEntry.fromJsonDict(report_event).toJsonDict() for report_event in report_events],
+                         expected)
+        streamed = self.sender.cva.get_report_events_streamed(
+            query, transform=lambda report_event: ReportEventEntry.fromJsonDict(report_event).toJsonDict())
+        self.assertEqual(list(streamed), expected)
+
+    def test_discover_cases(self):
+
+        discovery = CaseDiscovery(self.sender.cipapi, page_size=10)
+        cases = []
+        for case_id, case_version in discovery.discover_cases(programme="rare_disease"):
+            cases.append((case_id, case_version))
+            if len(cases) == 25:
+                break
+        self.assertEqual(len(cases), 25)
+        self.assertEqual(len(set(cases)), 25, "Expected no duplicated cases across pages")
+
+
+def _run_queue_worker(work_queue, output):
+
+    def send_case(case_id, case_version):
+        with open(output, "a") as sent_cases:
+            sent_cases.write("{}:{}\n".format(case_id, case_version))
+        return case_id
+
+    QueueWorker(work_queue, send_case).run()
+
+
+class _RecordingDecipher(object):
+    """
+    Stands for a DecipherClient with one registered patient, records every write
+    """
+
+    project_id = 1
+    user_id = 1
+    SNV = {'chr': "7", 'start': 117119258, 'ref_allele': "TCTC", 'alt_allele': "T"}
+
+    def __init__(self):
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def _write(self, write):
+        with self.lock:
+            self.writes.append(write)
+
+    def iter_patients(self):
+        return iter([{'reference': "reference", 'patient_id': 10}])
+
+    def create_patients(self, patients):
+        self._write(("create_patients", patients[0].reference))
+        # gives other threads the chance to create the same patient
+        time.sleep(0.1)
+        return [{'patient_id': 11}]
+
+    def iter_persons_by_patient(self, patient_id):
+        return iter([{'person_id': 100, 'relation': "patient"}, {'person_id': 101, 'relation': "mother"},
+                     {'person_id': 102, 'relation': "father"}])
+
+    def iter_phenotypes(self, person_id):
+        return iter([{'phenotype_id': 1234, 'observation': "present"}] if person_id in [100, 101] else [])
+
+    def iter_snvs(self, patient_id):
+        return iter([self.SNV] if patient_id == 10 else [])
+
+    def create_phenotypes(self, phenotypes, person_id):
+        self._write(("create_phenotypes", person_id))
+        return [{'phenotype_id': phenotype.phenotype_id} for phenotype in phenotypes]
+
+    def update_person(self, affection_status, person_id):
+        self._write(("update_person", person_id))
+
+    def create_persons(self, persons, patient_id):
+        self._write(("create_persons", patient_id))
+        return [103]
+
+    def create_snvs(self, snvs, patient_id):
+        self._write(("create_snvs", patient_id))
+
+
+class TestUploadCase(TestCase):
+
+    PHENOTYPES = [{'term': "HP:0001234", 'phenotype_id': 1234, 'observation': "present"}]
+
+    def setUp(self):
+        self.decipher = _RecordingDecipher()
+        self.sender = Gel2Decipher.__new__(Gel2Decipher)
+        self.sender._decipher = self.decipher
+        self.sender.mirror = ProjectMirror(self.decipher)
+        self.sender.mirror.build()
+        self.sender.pseudonym_index = None
+        self.mapped_case = {
+            'case_id': "615", 'case_version': "1", 'participant_id': "111000001",
+            'patient': {'reference': "reference", 'project_id': 1, 'user_id': 1, 'sex': "male"},
+            'proband': {'phenotypes': list(self.PHENOTYPES)},
+            'mother': {'relation_status': "affected", 'phenotypes': list(self.PHENOTYPES)},
+            'father': {'relation_status': "unaffected", 'phenotypes': []},
+            'relatives': [],
+            'snvs': [dict(_RecordingDecipher.SNV)]
+        }
+
+    def test_existing_patient_not_sent_again(self):
+        self.assertEqual(self.sender.upload_case(self.mapped_case), 10)
+        self.assertEqual(self.decipher.writes, [], "Expected no request for an existing patient")
+        # only what is missing is created
+        self.mapped_case['relatives'] = [
+            {'relation': "sibling", 'relation_status': "affected", 'phenotypes': self.PHENOTYPES}]
+        self.sender.upload_case(self.mapped_case)
+        self.assertEqual(self.decipher.writes, [("create_persons", 10), ("create_phenotypes", 103)])
+
+    def test_new_phenotypes_sent(self):
+        self.mapped_case['proband']['phenotypes'].append(
+            {'term': "HP:0005678", 'phenotype_id': 5678, 'observation': "present"})
+        self.sender.upload_case(self.mapped_case)
+        self.assertEqual(self.decipher.writes, [("create_phenotypes", 100)])
+        # the phenotypes sent are mirrored
+        self.sender.upload_case(self.mapped_case)
+        self.assertEqual(self.decipher.writes, [("create_phenotypes", 100)])
+
+    def test_patient_created_once(self):
+        self.mapped_case['patient']['reference'] = "new reference"
+        patient_ids = []
+
+        def upload():
+            patient_ids.append(self.sender.upload_case(self.mapped_case))
+        threads = [threading.Thread(target=upload) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(patient_ids, [11, 11, 11])
+        self.assertEqual([write for write in self.decipher.writes if write[0] == "create_patients"],
+                         [("create_patients", "new reference")])
+
+
+class _TemporaryDirectoryTestCase(TestCase):
+    """
+    Gives every test a temporary directory, removed afterwards
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestWorkQueue(_TemporaryDirectoryTestCase):
+
+    def _test_cases_sent_once(self, work_queue):
+        cases = [(str(x), "1") for x in range(200)]
+        self.assertEqual(work_queue.add_cases(cases), 200)
+        self.assertEqual(work_queue.add_cases(cases), 0, "Expected cases not to be added twice")
+        output = os.path.join(self.directory, "sent_cases.txt")
+        workers = [multiprocessing.Process(target=_run_queue_worker, args=(work_queue, output)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        with open(output) as sent_cases:
+            sent = sent_cases.read().splitlines()
+        self.assertEqual(sorted(sent), sorted(["{}:{}".format(x, y) for x, y in cases]))
+        self.assertEqual(work_queue.counts()[WorkQueue.DONE], 200)
+
+    def _test_expired_lease(self, work_queue):
+        work_queue.add_cases([("615", "1")])
+        case = work_queue.acquire("node1")
+        time.sleep(0.5)
+        self.assertEqual(work_queue.acquire("node2"), case, "Expected expired lease to be reclaimed")
+        self.assertFalse(work_queue.heartbeat(case, "node1"))
+        self.assertFalse(work_queue.complete(case, "node1", "1"))
+        self.assertTrue(work_queue.complete(case, "node2", "1"))
+        self.assertIsNone(work_queue.acquire("node1"))
+
+    def _test_expired_last_attempt(self, work_queue):
+        work_queue.add_cases([("615", "1")])
+        for owner in ["node1", "node2"]:
+            self.assertEqual(work_queue.acquire(owner), ("615", "1"))
+            time.sleep(0.5)
+        self.assertIsNone(work_queue.acquire("node3"), "Expected no attempt beyond the maximum")
+        self.assertEqual(work_queue.counts()[WorkQueue.FAILED], 1)
+        self.assertFalse(work_queue.complete(("615", "1"), "node2", "1"))
+
+    def test_sqlite_queue(self):
+        self._test_cases_sent_once(SqliteWorkQueue(os.path.join(self.directory, "queue.db")))
+
+    def test_directory_queue(self):
+        self._test_cases_sent_once(DirectoryWorkQueue(os.path.join(self.directory, "queue")))
+
+    def test_sqlite_expired_lease(self):
+        self._test_expired_lease(SqliteWorkQueue(os.path.join(self.directory, "queue.db"), lease_seconds=0.2))
+
+    def test_directory_expired_lease(self):
+        self._test_expired_lease(DirectoryWorkQueue(os.path.join(self.directory, "queue"), lease_seconds=0.2))
+
+    def test_sqlite_expired_last_attempt(self):
+        self._test_expired_last_attempt(
+            SqliteWorkQueue(os.path.join(self.directory, "queue.db"), lease_seconds=0.2, max_attempts=2))
+
+    def test_directory_expired_last_attempt(self):
+        self._test_expired_last_attempt(
+            DirectoryWorkQueue(os.path.join(self.directory, "queue"), lease_seconds=0.2, max_attempts=2))
+
+
+class TestSenderDaemon(_TemporaryDirectoryTestCase):
+
+    class Sender(object):
+        transcript_cache = None
+
+        def __init__(self):
+            self.sent = []
+            self.lock = threading.Lock()
+
+        def send_case(self, case_id, case_version):
+            with self.lock:
+                self.sent.append((case_id, case_version))
+            return case_id
+
+    def _wait_until_done(self, work_queue, cases):
+        start = time.time()
+        while work_queue.counts().get(WorkQueue.DONE, 0) < cases and time.time() - start < 10:
+            time.sleep(0.05)
+
+    def test_cases_submitted_while_running(self):
+        work_queue = DirectoryWorkQueue(os.path.join(self.directory, "spool"))
+        sender = self.Sender()
+        daemon = SenderDaemon(sender, work_queue, workers=3, poll_seconds=0.05)
+        daemon.start()
+        work_queue.add_cases([(str(x), "1") for x in range(10)])
+        self._wait_until_done(work_queue, 10)
+        # the workers keep polling once the queue is drained
+        work_queue.add_cases([(str(x), "2") for x in range(5)])
+        self._wait_until_done(work_queue, 15)
+        self.assertEqual(daemon.stop(timeout=5), 15)
+        self.assertEqual(len(sender.sent), 15)
+        self.assertEqual(len(set(sender.sent)), 15)
+
+    def test_queue_errors_retried(self):
+        work_queue = DirectoryWorkQueue(os.path.join(self.directory, "spool"))
+        acquire = work_queue.acquire
+        failures = []
+
+        def failing_acquire(owner):
+            if not failures:
+                failures.append(owner)
+                raise IOError("Spool directory not available")
+            return acquire(owner)
+        work_queue.acquire = failing_acquire
+        sender = self.Sender()
+        daemon = SenderDaemon(sender, work_queue, workers=1, poll_seconds=0.05)
+        daemon.start()
+        work_queue.add_cases([(str(x), "1") for x in range(5)])
+        self._wait_until_done(work_queue, 5)
+        self.assertEqual(daemon.stop(timeout=5), 5)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(len(sender.sent), 5)
+
+
+class TestHpoIndex(_TemporaryDirectoryTestCase):
+
+    OBO = """format-version: 1.2
+ontology: hp
+
+[Term]
+id: HP:0000001
+name: All
+
+[Term]
+id: HP:0000118
+name: Phenotypic abnormality
+alt_id: HP:0000117 ! old identifier
+is_a: HP:0000001 ! All
+
+[Term]
+id: HP:0000005
+name: obsolete Mode of inheritance
+is_obsolete: true
+replaced_by: HP:0000118
+
+[Term]
+id: HP:0000006
+name: obsolete term without replacement
+is_obsolete: true
+
+[Typedef]
+id: part_of
+"""
+
+    def setUp(self):
+        _TemporaryDirectoryTestCase.setUp(self)
+        obo_file = os.path.join(self.directory, "hp.obo")
+        with open(obo_file, "w") as obo:
+            obo.write(self.OBO)
+        self.hpo_index = HpoIndex.from_obo(obo_file)
+
+    def test_lookup(self):
+        self.assertEqual(self.hpo_index.lookup("HP:0000118"), (HpoIndex.VALID, None))
+        self.assertEqual(self.hpo_index.lookup("HP:0000117"), (HpoIndex.ALTERNATIVE_TERM, "HP:0000118"))
+        self.assertEqual(self.hpo_index.lookup("HP:0000005"), (HpoIndex.OBSOLETE_TERM, "HP:0000118"))
+        self.assertEqual(self.hpo_index.lookup("HP:0000006"), (HpoIndex.OBSOLETE_TERM, None))
+        self.assertEqual(self.hpo_index.lookup("HP:9999999"), (HpoIndex.UNKNOWN_TERM, None))
+        self.assertEqual(self.hpo_index.lookup("part_of"), (HpoIndex.UNKNOWN_TERM, None))
+
+    def test_validate(self):
+        self.assertEqual(self.hpo_index.validate("HP:0000118"), "HP:0000118")
+        self.assertIsNone(self.hpo_index.validate("HP:0000005"))
+        self.assertEqual(self.hpo_index.validate("HP:0000005", migrate=True), "HP:0000118")
+        self.assertEqual(self.hpo_index.validate("HP:0000117", migrate=True), "HP:0000118")
+        self.assertIsNone(self.hpo_index.validate("HP:0000006", migrate=True))
+        self.assertIsNone(self.hpo_index.validate("HP:9999999", migrate=True))
+
+    def test_pickle(self):
+        hpo_index = pickle.loads(pickle.dumps(self.hpo_index, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(hpo_index.validate("HP:0000117", migrate=True), "HP:0000118")
+
+    def test_map_phenotypes(self):
+        pedigree_member = _pedigree_member(1, terms=("HP:0000118", "HP:0000005", "HP:0000006", "part_of"))
+        phenotypes = Gel2Decipher._map_pedigree_member_phenotypes(
+            pedigree_member, False, hpo_index=self.hpo_index, migrate_hpo_terms=True)
+        self.assertEqual([(phenotype['term'], phenotype['phenotype_id']) for phenotype in phenotypes],
+                         [("HP:0000118", 118), ("HP:0000118", 118)])
+        phenotypes = Gel2Decipher._map_pedigree_member_phenotypes(pedigree_member, False, hpo_index=self.hpo_index)
+        self.assertEqual([phenotype['term'] for phenotype in phenotypes], ["HP:0000118"])
+
+
+class TestTranscriptCache(_TemporaryDirectoryTestCase):
+
+    class Variant(object):
+        def __init__(self, chromosome, start, reference, alternate):
+            self.chromosome = chromosome
+            self.start = start
+            self.reference = reference
+            self.alternate = alternate
+
+    def setUp(self):
+        _TemporaryDirectoryTestCase.setUp(self)
+        self.database = os.path.join(self.directory, "transcripts.db")
+
+    def test_cache(self):
+        variant = self.Variant("7", 117119258, "TCTC", "T")
+        cache = TranscriptCache(self.database, "cellbase_v4")
+        self.assertIsNone(cache.get(variant, ["CFTR"], "TIER1"))
+        cache.put(variant, ["CFTR"], "TIER1", "ENST00000003084", "CFTR")
+        cache.flush()
+        # a new cache on the same file, the gene symbols order does not matter
+        cache = TranscriptCache(self.database, "cellbase_v4")
+        self.assertEqual(cache.get(variant, ["CFTR", "CFTR"], "TIER1"), ("ENST00000003084", "CFTR"))
+        self.assertIsNone(cache.get(variant, ["CFTR"], "TIER2"))
+        self.assertIsNone(TranscriptCache(self.database, "cellbase_v5").get(variant, ["CFTR"], "TIER1"))
+        self.assertRaises(ValueError, TranscriptCache, self.database, None)
+        stats = cache.report()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 2, 1))
+
+    def test_lru_eviction(self):
+        cache = TranscriptCache(self.database, "cellbase_v4", max_entries=2)
+        variants = [self.Variant("1", x, "A", "C") for x in range(3)]
+        for variant in variants[:2]:
+            cache.put(variant, [], "TIER1", "ENST{}".format(variant.start), "GENE")
+        cache.flush()
+        time.sleep(0.01)
+        cache.get(variants[0], [], "TIER1")
+        cache.flush()
+        time.sleep(0.01)
+        cache.put(variants[2], [], "TIER1", "ENST2", "GENE")
+        cache.flush()
+        self.assertIsNotNone(cache.get(variants[0], [], "TIER1"))
+        self.assertIsNone(cache.get(variants[1], [], "TIER1"), "Expected the least recently used to be evicted")
+        self.assertIsNotNone(cache.get(variants[2], [], "TIER1"))
+
+    def test_threads(self):
+        cache = TranscriptCache(self.database, "cellbase_v4")
+        variants = [self.Variant("1", x, "A", "C") for x in range(400)]
+
+        def select_transcripts(offset):
+            for variant in variants[offset::4]:
+                if cache.get(variant, [], "TIER1") is None:
+                    cache.put(variant, [], "TIER1", "ENST{}".format(variant.start), "GENE")
+                cache.flush()
+        threads = [threading.Thread(target=select_transcripts, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.report()
+        self.assertEqual((stats['misses'], stats['entries']), (400, 400))
+
+
+class TestPseudonymIndex(_TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        _TemporaryDirectoryTestCase.setUp(self)
+        self.database = os.path.join(self.directory, "pseudonyms.db")
+
+    def test_lookups(self):
+        index = PseudonymIndex(self.database)
+        index.record("111000001", "615", "1", 1001, project_id=5)
+        index.record("111000001", "615", "2", 1001, project_id=5)
+        reference = index.by_case("615", "1")[0]['reference']
+        self.assertEqual(reference, gel2decipher.hash_id("111000001"))
+        # a new index on the same file
+        index = PseudonymIndex(self.database)
+        self.assertEqual(len(index.by_case("615")), 2)
+        self.assertEqual(index.by_reference(reference)[0]['participant_id'], "111000001")
+        self.assertEqual([record['case_version'] for record in index.by_patient_id(1001)], ["1", "2"])
+        self.assertEqual(index.by_participant("111000002"), [])
+
+    def test_import(self):
+        index = PseudonymIndex(self.database)
+        records = [("11100{:04d}".format(x), str(x), "1", None, None, None) for x in range(1000)]
+        self.assertEqual(index.import_records(records), 1000)
+        # importing again replaces the records
+        index.import_records(records)
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(index.by_participant("111000500")[0]['case_id'], "500")
+        self.assertIsNone(index.by_case("500", "1")[0]['patient_id'])
+
+
+class TestProfiler(_TemporaryDirectoryTestCase):
+
+    @staticmethod
+    def _busy_case():
+        return sum(x * x for x in range(200000))
+
+    def test_deterministic_profiler(self):
+        profiler = DeterministicProfiler(self.directory)
+        with profiler.profile_case("615", "1"):
+            self._busy_case()
+        stats = pstats.Stats(os.path.join(self.directory, "case-615-1-send.pstats"))
+        self.assertTrue(any(function[2] == "_busy_case" for function in stats.stats))
+
+    def test_mapping_process_profiled(self):
+        work_item = {'case_id': "615", 'case_version': "1", 'payload': {}, 'error': None}
+        pool = multiprocessing.Pool(1)
+        try:
+            work_item = pool.apply(_map_work_item, ((work_item, {}, DeterministicProfiler(self.directory)),))
+        finally:
+            pool.terminate()
+        # the case fails mapping, its profile is written anyway
+        self.assertIsNotNone(work_item['error'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "case-615-1-map.pstats")))
+
+    def test_sampling_profiler(self):
+        output_file = os.path.join(self.directory, "stacks.txt")
+        profiler = SamplingProfiler(output_file, interval=0.001)
+        profiler.start()
+        for case_id in ["615", "502"]:
+            with profiler.profile_case(case_id, "1"):
+                self._busy_case()
+        # samples are not taken outside of a case
+        time.sleep(0.05)
+        profiler.stop()
+        with open(output_file) as stacks:
+            lines = stacks.read().splitlines()
+        self.assertTrue(any(":_busy_case" in line for line in lines))
+        self.assertTrue(all("sleep" not in line for line in lines))
+        self.assertTrue(all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines))
+
+
+class TestCaseSnapshot(_TemporaryDirectoryTestCase):
+
+    REPORT_EVENTS = [{'reportEventId': "RE{}".format(i), 'observedVariants': []} for i in range(3)]
+
+    def setUp(self):
+        _TemporaryDirectoryTestCase.setUp(self)
+        for case_id in ["615", "502"]:
+            with open(os.path.join(self.directory, "{}-1.json".format(case_id)), "w") as case_file:
+                json.dump({'case_id': case_id}, case_file)
+        with open(os.path.join(self.directory, "615-1.report_events.ndjson"), "w") as ndjson:
+            for report_event in self.REPORT_EVENTS:
+                ndjson.write(json.dumps(report_event) + "\n")
+        with open(os.path.join(self.directory, "502-1.report_events.json"), "w") as cva_response:
+            json.dump({'response': [{'result': self.REPORT_EVENTS}]}, cva_response)
+        self.snapshot = CaseSnapshot(self.directory)
+
+    def test_list_cases(self):
+        self.assertEqual(self.snapshot.list_cases(), [("502", "1"), ("615", "1")])
+
+    def test_report_events(self):
+        for case_id in ["615", "502"]:
+            report_events = list(self.snapshot.get_report_events_streamed(
+                {'parent_id': case_id, 'parent_version': "1"},
+                transform=lambda report_event: report_event['reportEventId']))
+            self.assertEqual(report_events, ["RE0", "RE1", "RE2"])
+
+    def test_sender_without_decipher(self):
+        sender = Gel2Decipher({'snapshot_dir': self.directory, 'send_absent_phenotypes': False,
+                               'decipher_project_id': 7, 'decipher_user_id': 11})
+        options = sender.mapping_options()
+        self.assertEqual((options['project_id'], options['user_id']), (7, 11))
+        self.assertIsNone(sender._decipher, "Expected no Decipher client before sending")
+        self.assertRaises(ValueError, lambda: sender.decipher)
+
+
+class TestReportEventColumns(_TemporaryDirectoryTestCase):
+
+    @staticmethod
+    def _report_event(tier, zygosity="heterozygous", chromosome="chr1", proband_call=True, grch37=True):
+        representations = [{'assembly': "GRCh37", 'variant': {'chromosome': chromosome, 'start': 1000}}] \
+            if grch37 else []
+        observed_variants = [{'variantCall': {'participantId': "p1", 'zygosity': zygosity},
+                              'variant': {'variants': representations}}] if proband_call else []
+        return {'reportEvent': {'tier': tier}, 'observedVariants': observed_variants}
+
+    def setUp(self):
+        _TemporaryDirectoryTestCase.setUp(self)
+        self.columns = ReportEventColumns.from_fetched_cases([
+            {'case_id': "615", 'case_version': "1", 'report_events': [
+                self._report_event("TIER1"), self._report_event("TIER3", chromosome="X")]},
+            {'case_id': "502", 'case_version': "1", 'report_events': [
+                self._report_event("TIER2", zygosity="reference_homozygous"),
+                self._report_event("TIER1", grch37=False)]},
+            {'case_id': "1026", 'case_version': "2", 'report_events': [
+                self._report_event("TIER2", proband_call=False)]}
+        ])
+
+    def test_columns(self):
+        self.assertEqual(len(self.columns), 5)
+        self.assertEqual(list(self.columns.chromosome), [1, 23, 1, 0, 0])
+        self.assertEqual(list(self.columns.tier), [1, 3, 2, 1, 2])
+        self.assertEqual(list(self.columns.count_by_case()), [2, 2, 1])
+
+    def test_eligibility(self):
+        self.assertEqual(list(self.columns.eligible()), [True, False, False, False, False])
+        self.assertEqual(self.columns.eligible_cases(), [("615", "1")])
+        summary = self.columns.summary()
+        self.assertEqual(summary['grch37'], {'report_events': 3, 'cases': 2})
+        self.assertEqual(summary['eligible'], {'report_events': 1, 'cases': 1})
+
+    def test_save_and_load(self):
+        path = os.path.join(self.directory, "columns.npz")
+        self.columns.save(path)
+        loaded = ReportEventColumns.load(path)
+        self.assertEqual(loaded.case_ids, self.columns.case_ids)
+        self.assertEqual(list(loaded.eligible()), list(self.columns.eligible()))
+
+
+def _pedigree_member(pedigree_id, year_of_birth=2000, terms=("HP:0000252",)):
+    return PedigreeMember(
+        pedigreeId=pedigree_id, participantId="11100000{}".format(pedigree_id), isProband=pedigree_id == 1,
+        yearOfBirth=year_of_birth, personKaryotypicSex="XY", sex="MALE", affectionStatus="AFFECTED",
+        consentStatus=ConsentStatus(secondaryFindingConsent=True),
+        hpoTermList=[HpoTerm(term=term, termPresence="yes") for term in terms])
+
+
+class _FakePedigree(object):
+    """
+    The parts of a CIPAPI pedigree used to map a case, the member with pedigree id 1 is the proband
+    """
+
+    def __init__(self, members, relations=None):
+        """
+        :param relations: the relation to the proband of every other pedigree id
+        """
+        self.members = members
+        self.relations = relations if relations is not None else {}
+
+    def get_proband(self):
+        return [member for member in self.members if member.isProband][0]
+
+    def get_father(self, proband):
+        return None
+
+    def get_mother(self, proband):
+        return None
+
+    def get_relationship(self, pedigree_id, proband_pedigree_id):
+        return self.relations[pedigree_id]
+
+
+def _report_event_entry(participant_id="111000001"):
+    """
+    A report event of CVA as slimmed down when fetched, with a variant Decipher accepts
+    """
+    return {
+        'reportEvent': {
+            'tier': "TIER1", 'eventJustification': "Classified as: Tier1, passed the deNovo segregation filter",
+            'genomicEntities': [{'geneSymbol': "CFTR"}]},
+        'observedVariants': [{
+            'variantCall': {'participantId': participant_id, 'zygosity': "heterozygous"},
+            'variant': {'variants': [{'assembly': "GRCh37", 'variant': {
+                'chromosome': "7", 'start': 117199644, 'reference': "ATCT", 'alternate': "A",
+                'annotation': {'consequenceTypes': [{
+                    'geneName': "CFTR", 'ensemblTranscriptId': "ENST00000003084", 'biotype': "protein_coding",
+                    'transcriptAnnotationFlags': ["basic"],
+                    'sequenceOntologyTerms': [{'accession': "SO:0001893", 'name': "transcript_ablation"}]}]}}}]}}]
+    }
+
+
+class _FakeSender(object):
+
+    def __init__(self, cases, pedigrees=None):
+        self.cases = cases
+        self.pedigrees = pedigrees if pedigrees is not None else {}
+
+    def fetch_case(self, case_id, case_version, full_populate=True):
+        if case_id not in self.cases:
+            raise HTTPError("404:not found")
+        pedigree = self.pedigrees.get(case_id, _FakePedigree([_pedigree_member(1)]))
+        return {'case_id': case_id, 'case_version': case_version, 'pedigree': pedigree,
+                'report_events': self.cases[case_id]}
+
+    def mapping_options(self):
+        return {'project_id': 1, 'user_id': 1, 'send_absent_phenotypes': False, 'hpo_index': None,
+                'migrate_hpo_terms': False, 'transcript_cache': None}
+
+
+class TestCasePreScan(_TemporaryDirectoryTestCase):
+
+    def test_go_no_go(self):
+        report_event = TestReportEventColumns._report_event
+        sender = _FakeSender({
+            "615": [report_event("TIER1"), report_event("TIER2", grch37=False)],
+            "502": [report_event("TIER1", zygosity="reference_homozygous")],
+            "1026": [report_event("TIER1"), report_event("TIER1", proband_call=False)],
+            "1027": [report_event("TIER2", grch37=False)]
+        })
+        cases = [("615", "1"), ("502", "1"), ("1026", "1"), ("1027", "1"), ("9999", "1")]
+        rows = CasePreScan(sender, workers=2).scan(cases)
+        self.assertEqual([row['decision'] for row in rows], ["go", "no-go", "no-go", "no-go", "no-go"])
+        self.assertEqual(rows[1]['unmappable_genotypes'], 1)
+        self.assertEqual((rows[0]['members'], rows[0]['hpo_terms']), (1, 1))
+        self.assertTrue(rows[4]['reasons'].startswith("fetch failed"))
+        self.assertEqual(CasePreScan.go_cases(rows), [("615", "1")])
+        table = os.path.join(self.directory, "prescan.tsv")
+        CasePreScan.write_table(rows, table)
+        with open(table) as table_file:
+            self.assertEqual(len(table_file.read().splitlines()), 6)
+
+    def test_invalid_pedigree(self):
+        report_event = TestReportEventColumns._report_event
+        sender = _FakeSender({"615": [report_event("TIER1")], "502": [report_event("TIER1")],
+                              "1026": [report_event("TIER1")]}, pedigrees={
+            # Decipher takes ages up to 100
+            "615": _FakePedigree([_pedigree_member(1, year_of_birth=1900)]),
+            "502": _FakePedigree([_pedigree_member(1), _pedigree_member(2)], relations={2: "MaternalAunt"}),
+            "1026": _FakePedigree([_pedigree_member(1, terms=("HP:0000252", "HP:unknown"))])
+        })
+        rows = CasePreScan(sender, workers=2).scan([("615", "1"), ("502", "1"), ("1026", "1")])
+        self.assertEqual([row['decision'] for row in rows], ["no-go", "go", "no-go"])
+        self.assertTrue(rows[0]['reasons'].startswith("invalid pedigree: Patient"))
+        self.assertIn("age", rows[0]['reasons'])
+        self.assertEqual((rows[1]['members'], rows[1]['hpo_terms']), (2, 2))
+        self.assertTrue(rows[2]['reasons'].startswith("unmappable pedigree"))
+
+
+class _SlowUploadCohortSender(CohortSender):
+
+    def _upload(self, work_item):
+        time.sleep(0.05)
+        return CohortSender._upload(self, work_item)
+
+
+class _DyingPedigree(_FakePedigree):
+    """
+    Kills the mapping process mapping it, as when it runs out of memory
+    """
+
+    def get_proband(self):
+        os._exit(1)
+
+
+class _FailingUploadCohortSender(CohortSender):
+
+    def _upload(self, work_item):
+        raise RuntimeError("Unexpected error")
+
+
+class TestCohortSenderBackpressure(TestCase):
+
+    class Sender(object):
+        profiler = NullProfiler()
+        case_deadline = None
+
+        def fetch_case(self, case_id, case_version):
+            return {'case_id': case_id, 'case_version': case_version,
+                    'pedigree': _FakePedigree([_pedigree_member(1)]), 'report_events': [_report_event_entry()]}
+
+        def mapping_options(self):
+            return {'project_id': 1, 'user_id': 1}
+
+        def upload_case(self, mapped_case):
+            if len(mapped_case['snvs']) != 1:
+                raise ValueError("Expected one variant")
+            return 1000 + int(mapped_case['case_id'])
+
+    def test_cases_in_flight_bounded(self):
+        cohort_sender = _SlowUploadCohortSender(self.Sender(), fetch_workers=4, mapping_processes=2, upload_workers=1,
+                                                max_cases_in_flight=3, queue_size=1)
+        results = list(cohort_sender.send_cases([(str(x), "1") for x in range(20)]))
+        self.assertEqual(sorted(result[0] for result in results), sorted(str(x) for x in range(20)))
+        for case_id, case_version, patient_id, error in results:
+            self.assertIsNone(error)
+            self.assertEqual(patient_id, 1000 + int(case_id))
+        depths = cohort_sender.queue_depths()
+        # fetching waited for the slow upload
+        self.assertLessEqual(depths['cases_in_flight']['peak'], 3)
+        self.assertLessEqual(depths['fetched']['peak'], 1)
+        self.assertEqual(depths['cases_in_flight']['depth'], 0)
+
+    def test_cost_in_flight_bounded(self):
+        costs = dict(((str(x), "1"), 10.0) for x in range(10))
+        costs[("0", "1")] = 100.0
+        cohort_sender = _SlowUploadCohortSender(self.Sender(), fetch_workers=4, mapping_processes=2, upload_workers=2,
+                                                scheduler=CaseScheduler(costs), max_cost_in_flight=30)
+        results = list(cohort_sender.send_cases(sorted(costs)))
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(error is None for case_id, case_version, patient_id, error in results))
+        # a case larger than the budget goes alone
+        peak = cohort_sender.queue_depths()['cost_in_flight']['peak']
+        self.assertTrue(peak <= 30 or peak == 100)
+
+    def test_mapping_process_died(self):
+        sender = self.Sender()
+        fetch_case = sender.fetch_case
+
+        def dying_fetch_case(case_id, case_version):
+            fetched_case = fetch_case(case_id, case_version)
+            if case_id == "3":
+                fetched_case['pedigree'] = _DyingPedigree([])
+            return fetched_case
+        sender.fetch_case = dying_fetch_case
+        cohort_sender = CohortSender(sender, fetch_workers=2, mapping_processes=2, upload_workers=1, map_timeout=2)
+        results = dict((result[0], result) for result in cohort_sender.send_cases([(str(x), "1") for x in range(6)]))
+        self.assertEqual(len(results), 6)
+        self.assertIsInstance(results["3"][3], DeadlineExceeded)
+        self.assertTrue(all(results[str(x)][3] is None for x in range(6) if x != 3))
+
+    def test_stage_thread_failed(self):
+        cohort_sender = _FailingUploadCohortSender(self.Sender(), fetch_workers=1, mapping_processes=1,
+                                                   upload_workers=1)
+        with self.assertRaises(ValueError):
+            list(cohort_sender.send_cases([(str(x), "1") for x in range(3)]))
+
+
+class TestCaseScheduler(TestCase):
+
+    def test_shortest_first(self):
+        costs = {("615", "1"): CaseScheduler.estimate_cost(3, 500), ("502", "1"): CaseScheduler.estimate_cost(1, 10),
+                 ("1026", "1"): CaseScheduler.estimate_cost(2, 10, hpo_terms=30)}
+        scheduler = CaseScheduler(costs)
+        self.assertEqual(scheduler.add_cases([("615", "1"), ("502", "1"), ("1026", "1"), ("9999", "1")]), 4)
+        # cases without a cost come first, in the order they were added
+        self.assertEqual(list(scheduler), [("9999", "1"), ("502", "1"), ("1026", "1"), ("615", "1")])
+        self.assertIsNone(scheduler.pop())
+
+    def test_huge_lane(self):
+        scheduler = CaseScheduler({("615", "1"): 5000.0, ("502", "1"): 10.0, ("1026", "1"): 20.0}, huge_cost=1000)
+        scheduler.add_cases([("615", "1"), ("502", "1"), ("1026", "1")])
+        self.assertEqual(len(scheduler), 3)
+        self.assertEqual(scheduler.pop(CaseScheduler.HUGE), ("615", "1"))
+        # a worker of the huge lane takes small cases once its lane is empty
+        self.assertEqual(scheduler.pop(CaseScheduler.HUGE), ("502", "1"))
+        self.assertEqual(scheduler.pop(CaseScheduler.SMALL), ("1026", "1"))
+
+    def test_costs_from_pre_scan(self):
+        rows = [{'case_id': "615", 'case_version': "1", 'members': 3, 'report_events': 40, 'hpo_terms': 12}]
+        self.assertEqual(CaseScheduler.costs_from_pre_scan(rows), {("615", "1"): 3 * 20 + 40 + 12.0})
+
+
+class _StaticTokenClient(RestClient):
+
+    def get_token(self):
+        return "token"
+
+
+class TestRequestCompression(TestCase):
+
+    class Session(object):
+        """
+        Stands for a requests.Session keeping the body and headers of every request
+        """
+
+        def __init__(self):
+            self.requests = []
+
+        def request(self, method, url, data=None, headers=None, **kwargs):
+            self.requests.append((data, headers))
+            return InMemoryResponse(200, json.dumps({'created': True}))
+
+    @staticmethod
+    def _gunzip(data):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    def test_threshold(self):
+        client = _StaticTokenClient("http://localhost/", compress_requests=True, compression_threshold=100)
+        small = {'reference': "x" * 50}
+        data, headers = client._encode_payload(small)
+        self.assertEqual(data, json.dumps(small))
+        self.assertNotIn('Content-Encoding', headers)
+        large = {'reference': "x" * 100}
+        data, headers = client._encode_payload(large)
+        self.assertEqual(headers['Content-Encoding'], "gzip")
+        self.assertEqual(headers['Content-Type'], "application/json")
+        self.assertEqual(json.loads(self._gunzip(data)), large)
+        self.assertLess(len(data), len(json.dumps(large)))
+
+    def test_disabled(self):
+        client = _StaticTokenClient("http://localhost/", compression_threshold=100)
+        data, headers = client._encode_payload({'reference': "x" * 1000})
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(json.loads(data), {'reference': "x" * 1000})
+
+    def test_compressed_post(self):
+        session = self.Session()
+        client = _StaticTokenClient("http://localhost/", compress_requests=True, transport=session)
+        payload = [{'patient_id': 1, 'phenotype_id': phenotype_id} for phenotype_id in range(200)]
+        self.assertEqual(client.post("phenotypes", payload), {'created': True})
+        client.patch("phenotypes", payload[:1])
+        (posted, post_headers), (patched, patch_headers) = session.requests
+        self.assertEqual(post_headers['Content-Encoding'], "gzip")
+        self.assertEqual(json.loads(self._gunzip(posted)), payload)
+        # the headers of the client are not changed
+        self.assertNotIn('Content-Encoding', client.headers)
+        self.assertNotIn('Content-Encoding', patch_headers)
+        self.assertEqual(json.loads(patched), payload[:1])
+
+
+class TestDeadline(TestCase):
+
+    def test_retries_stop_at_deadline(self):
+        def unreachable():
+            raise ConnectionError("unreachable")
+        start = time.time()
+        with deadline(1):
+            self.assertRaises(DeadlineExceeded, backoff_retrier.wrapper(unreachable, -1))
+        self.assertLess(time.time() - start, 2)
+
+    def test_timeouts_shortened_to_deadline(self):
+        client = _StaticTokenClient("http://localhost", timeout=(10, 120), endpoint_timeouts={"report-events": (5, 300)})
+        self.assertEqual(client._get_timeout("report-events"), (5, 300))
+        self.assertEqual(client._get_timeout("patients"), (10, 120))
+        with deadline(2):
+            self.assertTrue(all(timeout <= 2 for timeout in client._get_timeout("report-events")))
+        with deadline(at=time.time() - 1):
+            self.assertRaises(DeadlineExceeded, client._get_timeout, "patients")
+
+    def test_prefetch_propagates_deadline(self):
+        def next_page_params(url_params, page):
+            return {'page': url_params['page'] + 1} if url_params['page'] < 3 else None
+        at = time.time() + 60
+        with deadline(at=at):
+            pages = list(prefetch_pages(lambda url_params: get_deadline(), next_page_params, {'page': 1}))
+        self.assertEqual(pages, [at] * 3)
+        self.assertIsNone(get_deadline())
+
+    def test_stream_stops_at_deadline(self):
+        transport = InMemoryTransport()
+        transport.add("GET", "http://localhost/report-events")
+        transport.responses.values()[0][0] = _SlowDripResponse(200, "x" * 100)
+        client = _StaticTokenClient("http://localhost/", transport=transport)
+        chunks = []
+        with deadline(0.5):
+            stream = client.get_stream("report-events", chunk_size=10)
+            with self.assertRaises(DeadlineExceeded):
+                for chunk in stream:
+                    chunks.append(chunk)
+        self.assertLess(len(chunks), 10)
+
+
+class _SlowDripResponse(InMemoryResponse):
+
+    def iter_content(self, chunk_size=1):
+        for chunk in InMemoryResponse.iter_content(self, chunk_size):
+            time.sleep(0.1)
+            yield chunk
+
+
+class TestHedger(TestCase):
+
+    def test_hedged_request_wins(self):
+        hedger = Hedger(percentile=50, max_extra_load=1, min_samples=5)
+        for _ in range(5):
+            hedger.call("patients/1/persons", lambda: "fast")
+        # the first request hangs, the hedge answers
+        latencies = [2, 0]
+        start = time.time()
+        result = hedger.call("patients/2/persons", lambda: time.sleep(latencies.pop(0)) or "hedged")
+        self.assertEqual(result, "hedged")
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(hedger.stats()['hedges'], 1)
+
+    def test_hedges_are_capped(self):
+        hedger = Hedger(percentile=50, max_extra_load=0.1, min_samples=5)
+        for _ in range(10):
+            hedger.call("info", lambda: None)
+        for _ in range(10):
+            hedger.call("info", lambda: time.sleep(0.01))
+        self.assertLessEqual(hedger.stats()['hedges'], 0.1 * hedger.stats()['requests'])
+
+    def test_errors_are_raised(self):
+        hedger = Hedger(percentile=50, min_samples=1)
+
+        def failing():
+            raise HTTPError("500:error")
+        hedger.call("info", lambda: None)
+        self.assertRaises(HTTPError, hedger.call, "info", failing)
+
+
+class _SlowInfoClient(_StaticTokenClient):
+
+    def __init__(self, *args, **kwargs):
+        _StaticTokenClient.__init__(self, *args, **kwargs)
+        self.requests = 0
+
+    def _get(self, endpoint, url_params, session):
+        self.requests += 1
+        time.sleep(0.2)
+        return json.dumps({'endpoint': endpoint, 'params': url_params})
+
+
+class TestTransport(_TemporaryDirectoryTestCase):
+
+    class Session(object):
+        """
+        Stands for a requests.Session answering every request with its method and URL
+        """
+
+        def request(self, method, url, **kwargs):
+            return InMemoryResponse(200, json.dumps({'method': method, 'url': url}))
+
+    def test_in_memory(self):
+        transport = InMemoryTransport()
+        transport.add("GET", "http://localhost/info", {'user': 1})
+        transport.add("GET", "http://localhost/patients", [1, 2], params={'limit': 2, 'offset': 0})
+        transport.add("POST", "http://localhost/patients", [{'patient_id': 5}], data=json.dumps([{'sex': "46XX"}]))
+        transport.add("DELETE", "http://localhost/patients/5", status_code=404)
+        client = _StaticTokenClient("http://localhost/", transport=transport, retries=0)
+        self.assertEqual(client.get("info"), {'user': 1})
+        self.assertEqual(client.get("patients", {'offset': 0, 'limit': 2}), [1, 2])
+        self.assertEqual(client.post("patients", [{'sex': "46XX"}]), [{'patient_id': 5}])
+        self.assertEqual("".join(client.get_stream("info", chunk_size=3)), json.dumps({'user': 1}))
+        self.assertRaises(HTTPError, client.delete, "patients/5")
+        self.assertRaises(UnrecordedRequest, client.get, "patients/5")
+
+    def test_record_and_replay(self):
+        cassette = os.path.join(self.directory, "cassette.jsonl")
+        recorder = RecordingTransport(cassette, session=self.Session())
+        client = _StaticTokenClient("http://localhost/", transport=recorder)
+        recorded = [client.get("info"), client.get("patients", {'limit': 2}), client.post("patients", [{'a': 1}])]
+        recorder.save()
+        client = _StaticTokenClient("http://localhost/", transport=ReplayTransport(cassette))
+        replayed = [client.get("info"), client.get("patients", {'limit': 2}), client.post("patients", [{'a': 1}])]
+        self.assertEqual(replayed, recorded)
+        # the body is part of the request
+        self.assertRaises(UnrecordedRequest, client.post, "patients", [{'a': 2}])
+
+    def test_recorded_as_it_happens(self):
+        cassette = os.path.join(self.directory, "cassette.jsonl")
+        recorder = RecordingTransport(cassette, session=self.Session())
+        client = _StaticTokenClient("http://localhost/", transport=recorder)
+        recorded = [client.get("info"), client.get("patients")]
+        # without saving, as when the run is killed
+        client = _StaticTokenClient("http://localhost/", transport=ReplayTransport(cassette))
+        self.assertEqual([client.get("info"), client.get("patients")], recorded)
+        with open(cassette) as cassette_file:
+            self.assertEqual(len(cassette_file.readlines()), 2)
+
+    def test_authentication_not_recorded(self):
+        class Session(object):
+            def request(self, method, url, **kwargs):
+                return InMemoryResponse(200, json.dumps({'response': [{'result': [{'token': "secret-token"}]}]}))
+        cassette = os.path.join(self.directory, "cassette.jsonl")
+        recorder = RecordingTransport(cassette, session=Session())
+        client = _StaticTokenClient("http://localhost/", transport=recorder)
+        response = client.post("authentication", {'username': "user", 'password': "secret-password"})
+        self.assertEqual(response['response'][0]['result'][0]['token'], "secret-token")
+        recorder.save()
+        with open(cassette) as cassette_file:
+            recorded = cassette_file.read()
+        self.assertNotIn("secret", recorded)
+        # the credentials are not part of the request
+        client = _StaticTokenClient("http://localhost/", transport=ReplayTransport(cassette))
+        response = client.post("authentication", {'username': "other", 'password': "other-password"})
+        self.assertEqual(response['response'][0]['result'][0]['token'], "redacted")
+
+
+class TestCvaClient(TestCase):
+
+    URL_BASE = "http://localhost/cva/api/0/"
+    QUERY = {'parent_id': "615", 'parent_version': "1"}
+
+    def setUp(self):
+        self.transport = InMemoryTransport()
+        self.transport.add("POST", self.URL_BASE + "authentication", {'response': [{'result': [{'token': "abc"}]}]})
+        self.report_events = [{'reportEventId': "RE{}".format(i)} for i in range(5)]
+        for skip in range(0, 6, 2):
+            params = dict(self.QUERY, limit=2, skip=skip)
+            self.transport.add("GET", self.URL_BASE + "report-events",
+                               {'response': [{'result': self.report_events[skip:skip + 2]}]}, params=params)
+
+    def test_authentication(self):
+        client = CvaClient(self.URL_BASE, "user", "password", transport=self.transport)
+        self.assertEqual(client.headers["Authorization"], "Bearer abc")
+        self.assertRaises(ValueError, CvaClient, self.URL_BASE, "user", None, transport=self.transport)
+
+    def test_compression_settings(self):
+        client = CvaClient(self.URL_BASE, "user", "password", compress_requests=True, compression_threshold=10,
+                           accept_encoding="identity", transport=self.transport)
+        self.assertEqual(client.headers["Accept-Encoding"], "identity")
+        data, headers = client._encode_payload({'username': "x" * 10})
+        self.assertEqual(headers['Content-Encoding'], "gzip")
+
+    def test_report_events_paged(self):
+        client = CvaClient(self.URL_BASE, "user", "password", transport=self.transport)
+        self.assertEqual(list(client.get_report_events_raw(self.QUERY, page_size=2)), self.report_events)
+        streamed = client.get_report_events_streamed(
+            self.QUERY, transform=lambda report_event: report_event['reportEventId'], page_size=2)
+        self.assertEqual(list(streamed), ["RE0", "RE1", "RE2", "RE3", "RE4"])
+        # a full last page needs an empty page to finish
+        self.assertRaises(UnrecordedRequest, list, client.get_report_events_raw(self.QUERY, page_size=5))
+
+
+class TestReportEventStreaming(TestCase):
+
+    @staticmethod
+    def _chunks(text, size):
+        return [text[start:start + size] for start in range(0, len(text), size)]
+
+    def test_iter_json_array(self):
+        results = [{'reportEventId': "RE{}".format(i), 'values': [i, {'nested': "]}, \"quoted\""}]} for i in range(5)]
+        text = json.dumps({'response': [{'time': 10, 'result': results, 'numResults': 5}]})
+        # every split, down to one character per chunk, gives the same elements
+        for size in [1, 2, 7, 64, len(text)]:
+            self.assertEqual(list(iter_json_array(self._chunks(text, size), "result")), results)
+
+    def test_iter_json_array_empty(self):
+        self.assertEqual(list(iter_json_array(['{"response": [{"result": [', ' ]}]}'], "result")), [])
+        self.assertEqual(list(iter_json_array([], "result")), [])
+
+    def test_iter_json_array_missing_key(self):
+        self.assertEqual(list(iter_json_array(self._chunks('{"response": [{"error": "not found"}]}', 3), "result")),
+                         [])
+
+    def test_iter_json_array_truncated(self):
+        text = json.dumps({'result': [{'reportEventId': "RE0"}, {'reportEventId': "RE1"}]})
+        elements = iter_json_array(self._chunks(text[:-20], 4), "result")
+        self.assertEqual(next(elements), {'reportEventId': "RE0"})
+        self.assertRaises(ValueError, list, elements)
+
+    def test_slim_report_event(self):
+        report_event = _report_event_entry("111000001")
+        report_event['reportEvent']['score'] = 0.9
+        report_event['reportEvent']['genomicEntities'][0]['ensemblId'] = "ENSG00000001626"
+        variant = report_event['observedVariants'][0]['variant']
+        variant['variants'][0]['variant']['annotation']['populationFrequencies'] = [{'study': "GNOMAD"}]
+        variant['variants'].append({'assembly': "GRCh38", 'variant': {'chromosome': "7", 'start': 117559590}})
+        other_member = {'variantCall': {'participantId': "111000002", 'zygosity': "reference_homozygous"},
+                        'variant': variant}
+        report_event['observedVariants'].insert(0, other_member)
+        slimmed = slim_report_event(report_event, "111000001")
+        # only the proband's call and its GRCh37 representation are kept
+        self.assertEqual(len(slimmed['observedVariants']), 1)
+        observed_variant = slimmed['observedVariants'][0]
+        self.assertEqual(observed_variant['variantCall'], {'participantId': "111000001", 'zygosity': "heterozygous"})
+        self.assertEqual([representation['assembly'] for representation in observed_variant['variant']['variants']],
+                         ["GRCh37"])
+        grch37 = observed_variant['variant']['variants'][0]['variant']
+        self.assertEqual((grch37['chromosome'], grch37['start'], grch37['reference'], grch37['alternate']),
+                         ("7", 117199644, "ATCT", "A"))
+        self.assertNotIn('populationFrequencies', grch37['annotation'])
+        consequence_type = grch37['annotation']['consequenceTypes'][0]
+        self.assertEqual((consequence_type['ensemblTranscriptId'], consequence_type['geneName'],
+                          consequence_type['biotype'], consequence_type['transcriptAnnotationFlags']),
+                         ("ENST00000003084", "CFTR", "protein_coding", ["basic"]))
+        self.assertEqual(consequence_type['sequenceOntologyTerms'][0]['accession'], "SO:0001893")
+        self.assertEqual(slimmed['reportEvent'], {
+            'tier': "TIER1", 'eventJustification': report_event['reportEvent']['eventJustification'],
+            'genomicEntities': [{'geneSymbol': "CFTR"}]})
+        # a report event without a call for the proband keeps no observed variant
+        self.assertEqual(slim_report_event(report_event, "111000009")['observedVariants'], [])
+
+
+class TestSingleFlight(TestCase):
+
+    @staticmethod
+    def _concurrently(func, callers):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func())) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_gets_coalesced(self):
+        client = _SlowInfoClient("http://localhost")
+        results = self._concurrently(lambda: client.get("info", {'page': 1}), 5)
+        self.assertEqual(client.requests, 1)
+        self.assertEqual(client.single_flight.stats(), {'calls': 1, 'coalesced': 4})
+        # every caller has its own copy
+        results[0]['endpoint'] = "changed"
+        self.assertEqual(results[1]['endpoint'], "info")
+        self._concurrently(lambda: client.get("info", {'page': 2}), 1)
+        self.assertEqual(client.requests, 2, "Expected requests with other parameters to be sent")
+
+    def test_other_credentials_not_coalesced(self):
+        client = _SlowInfoClient("http://localhost")
+        client.headers["X-Auth-Token-User"] = "user"
+        other_client = _SlowInfoClient("http://localhost")
+        other_client.headers["X-Auth-Token-User"] = "other user"
+        other_client.single_flight = client.single_flight
+        threads = [threading.Thread(target=lambda: client.get("info")),
+                   threading.Thread(target=lambda: other_client.get("info"))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((client.requests, other_client.requests), (1, 1))
+        self.assertEqual(client.single_flight.stats(), {'calls': 2, 'coalesced': 0})
+
+    def test_disabled(self):
+        client = _SlowInfoClient("http://localhost", coalesce_gets=False)
+        self._concurrently(lambda: client.get("info"), 3)
+        self.assertEqual(client.requests, 3)
+
+    def test_errors_shared(self):
+        single_flight = SingleFlight()
+
+        def failing():
+            time.sleep(0.2)
+            raise HTTPError("500:error")
+        errors = []
+
+        def call():
+            try:
+                single_flight.call("info", failing)
+            except HTTPError, ex:
+                errors.append(ex)
+        self._concurrently(call, 3)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(single_flight.stats()['calls'], 1)
+
+    def test_leader_deadline_not_shared(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.3)
+            check_deadline()
+            return "done"
+
+        def short_deadline():
+            with deadline(0.1):
+                try:
+                    return single_flight.call("info", slow)
+                except DeadlineExceeded:
+                    return "exceeded"
+        leader = threading.Thread(target=short_deadline)
+        leader.start()
+        time.sleep(0.05)
+        # the follower outlives the deadline of the leader and sends its own request
+        self.assertEqual(single_flight.call("info", slow), "done")
+        leader.join()
+        self.assertEqual(len(calls), 2)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_open_half_open_and_close(self):
+        breaker = CircuitBreaker("decipher", failure_rate=0.5, window=4, min_requests=4, open_seconds=0.1)
+        for _ in range(2):
+            breaker.before_request()
+            breaker.record_success()
+        for _ in range(2):
+            breaker.before_request()
+            breaker.record_failure()
+        self.assertEqual(breaker.stats()['state'], CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpen, breaker.before_request)
+        breaker.wait_until_available()
+        # a single probe goes through
+        breaker.before_request()
+        self.assertRaises(CircuitOpen, breaker.before_request)
+        breaker.record_success()
+        self.assertEqual(breaker.stats()['state'], CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.stats()['rejected'], 2)
+
+    def test_retries_fail_fast_when_open(self):
+        breaker = CircuitBreaker("cva", window=2, min_requests=2, open_seconds=60)
+        calls = []
+
+        def unreachable():
+            calls.append(1)
+            raise ConnectionError("unreachable")
+        self.assertRaises(CircuitOpen, backoff_retrier.wrapper(unreachable, -1, breaker))
+        self.assertEqual(len(calls), 2)
+
 
 class TestDecipherApi(TestCase):
 
@@ -334,6 +1587,28 @@ class TestDecipherApi(TestCase):
         except HTTPError, ex:
             self.assertEqual(ex.response.status_code, 400, "Expected 400 for wrong patient id")
 
+    def test_paginated_iterators(self):
+        persons = self.decipher.get_persons_by_patient(self.patient1_id)
+        self.assertEqual(list(self.decipher.iter_persons_by_patient(self.patient1_id)), persons)
+        references = [patient['reference'] for patient in self.decipher.iter_paginated(
+            "projects/{}/patients".format(self.decipher.project_id), 'patients', page_size=1)]
+        self.assertIn(self.patient1.reference, references)
+        self.assertIn(self.patient2.reference, references)
+        self.assertEqual(len(references), len(set(references)), "Expected no duplicated patients across pages")
+
+    def test_purge_project(self):
+        patients = [Patient(sex="46XX", reference="purge-test-{}".format(x), project_id=self.decipher.project_id,
+                            consent="No", user_id=self.decipher.user_id, age="unknown") for x in range(5)]
+        self.decipher.create_patients(patients)
+        progress_file = os.path.join(tempfile.mkdtemp(), "purge.jsonl")
+        purger = ProjectPurger(self.decipher, progress_file, workers=2)
+        self.assertEqual(purger.purge(reference_prefix="purge-test-"), (5, 0))
+        self.assertEqual(purger.select_patients(reference_prefix="purge-test-"), [])
+        # patients not matching the prefix are kept
+        references = [patient['reference'] for patient in self.decipher.get_patients()]
+        self.assertIn(self.patient1.reference, references)
+        shutil.rmtree(os.path.dirname(progress_file))
+
     def test_create_phenotypes(self):
         """
         Creates a phenotype related to a patient
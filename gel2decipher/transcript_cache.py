@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from gel2decipher_sender.sqlite_connections import SqliteConnections
+
+
+class TranscriptCache(SqliteConnections):
+    """
+    A persistent cache of the transcript and gene selected for a variant, shared by every case in a cohort. Entries
+    are keyed by the GRCh37 coordinates, the gene symbols provided by tiering, the tier and the annotation version.
+    The least recently used entries are evicted beyond a maximum number of entries. Hits and last use times are kept
+    in memory and written to disk on flush, so lookups do not write.
+    """
+
+    PICKLED = ['database', 'annotation_version', 'max_entries']
+
+    def __init__(self, database, annotation_version, max_entries=1000000):
+        """
+        :param database: the SQLite database file
+        :param annotation_version: the version of the annotations, selections with other versions are not reused
+        :param max_entries: the number of entries beyond which the least recently used are evicted
+        """
+        if not annotation_version:
+            # a selection made on other annotations would be served silently
+            raise ValueError("The transcript cache needs the version of the annotations")
+        self.database = database
+        self.annotation_version = annotation_version
+        self.max_entries = max_entries
+        self._reset()
+        connection = self._connect()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            "key TEXT PRIMARY KEY, transcript TEXT, gene TEXT, last_used REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)")
+        connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        connection.execute("INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0)")
+        connection.execute("INSERT OR IGNORE INTO stats (name, value) VALUES ('misses', 0)")
+        connection.commit()
+
+    def _reset(self):
+        SqliteConnections._reset(self)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._used = {}
+        self._selected = {}
+
+    def _key(self, grch37_variant, gene_symbols, tier):
+        return "{}:{}:{}:{}|{}|{}|{}".format(
+            grch37_variant.chromosome, grch37_variant.start, grch37_variant.reference, grch37_variant.alternate,
+            ",".join(sorted(set(str(gene_symbol) for gene_symbol in gene_symbols))), tier, self.annotation_version)
+
+    def get(self, grch37_variant, gene_symbols, tier):
+        """
+        :param grch37_variant: a VariantAvro or an AcceptedVariant
+        :type gene_symbols: list
+        :type tier: Tier
+        :return: the selected transcript and gene or None if not cached
+        """
+        key = self._key(grch37_variant, gene_symbols, tier)
+        with self._lock:
+            selection = self._selected.get(key)
+        if selection is None:
+            selection = self._connect().execute(
+                "SELECT transcript, gene FROM transcripts WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if selection is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._used[key] = time.time()
+        return selection[0], selection[1]
+
+    def put(self, grch37_variant, gene_symbols, tier, transcript, gene):
+        key = self._key(grch37_variant, gene_symbols, tier)
+        with self._lock:
+            self._selected[key] = (transcript, gene)
+            self._used[key] = time.time()
+
+    def flush(self):
+        """
+        Writes the new selections, the last use times and the hit counts, then evicts the least recently used
+        entries beyond the maximum size
+        """
+        with self._lock:
+            if not self._used and not self.hits and not self.misses:
+                return
+            # other threads keep looking up while this one writes
+            hits, misses, used, selected = self.hits, self.misses, self._used, self._selected
+            self.hits = 0
+            self.misses = 0
+            self._used = {}
+            self._selected = {}
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO transcripts (key, transcript, gene, last_used) VALUES (?, ?, ?, ?)",
+                [(key, transcript, gene, used[key]) for key, (transcript, gene) in selected.iteritems()])
+            connection.executemany(
+                "UPDATE transcripts SET last_used = ? WHERE key = ? AND last_used < ?",
+                [(last_used, key, last_used) for key, last_used in used.iteritems()])
+            connection.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (hits,))
+            connection.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'", (misses,))
+            excess = connection.execute("SELECT count(*) FROM transcripts").fetchone()[0] - self.max_entries
+            if excess > 0:
+                connection.execute(
+                    "DELETE FROM transcripts WHERE key IN "
+                    "(SELECT key FROM transcripts ORDER BY last_used LIMIT ?)", (excess,))
+
+    def report(self):
+        """
+        :return: the hits, misses and hit rate accumulated in the database and its number of entries
+        :rtype: dict
+        """
+        self.flush()
+        connection = self._connect()
+        stats = dict(connection.execute("SELECT name, value FROM stats").fetchall())
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        stats['entries'] = connection.execute("SELECT count(*) FROM transcripts").fetchone()[0]
+        logging.info("Transcript cache: {hits} hits, {misses} misses, hit rate {hit_rate:.2%}, {entries} entries"
+                     .format(**stats))
+        return stats
@@ -0,0 +1,419 @@
+import abc
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from gel2decipher_sender.clients.circuit_breaker import wait_for_upstreams
+
+
+class WorkQueue(object):
+    """
+    A queue of cases to send shared by several workers. A worker acquires a lease on a case, keeps it alive with
+    heartbeats and completes it. Leases that are not renewed expire and the case is reclaimed by other workers, so
+    each case is sent once as long as workers heartbeat within the lease time.
+    """
+
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+    # the error of a case whose lease expired on its last attempt
+    LEASE_EXPIRED = "lease expired"
+
+    def __init__(self, lease_seconds=600, max_attempts=3):
+        """
+        :param lease_seconds: the time a lease is valid without heartbeats
+        :param max_attempts: the number of failed attempts after which a case is not retried
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    @staticmethod
+    def default_owner():
+        return "{}-{}".format(socket.gethostname(), os.getpid())
+
+    @abc.abstractmethod
+    def add_cases(self, cases):
+        """
+        Adds cases to the queue, cases already in the queue are ignored
+        :param cases: list of (case_id, case_version)
+        :return: the number of cases added
+        """
+        raise ValueError("Not implemented")
+
+    @abc.abstractmethod
+    def acquire(self, owner):
+        """
+        :return: a leased (case_id, case_version) or None if there is no case available
+        """
+        raise ValueError("Not implemented")
+
+    @abc.abstractmethod
+    def heartbeat(self, case, owner):
+        """
+        :return: False if the lease was lost
+        """
+        raise ValueError("Not implemented")
+
+    @abc.abstractmethod
+    def complete(self, case, owner, patient_id):
+        """
+        :return: False if the lease was lost
+        """
+        raise ValueError("Not implemented")
+
+    @abc.abstractmethod
+    def fail(self, case, owner, error):
+        """
+        Releases the case to be retried unless it reached the maximum number of attempts
+        :return: False if the lease was lost
+        """
+        raise ValueError("Not implemented")
+
+    @abc.abstractmethod
+    def counts(self):
+        """
+        :return: the number of cases in each status
+        :rtype: dict
+        """
+        raise ValueError("Not implemented")
+
+
+class SqliteWorkQueue(WorkQueue):
+    """
+    Work queue in a SQLite database, suited for several processes in the same node. SQLite locking is not reliable
+    on network filesystems, use a DirectoryWorkQueue to share work across nodes.
+    """
+
+    def __init__(self, database, lease_seconds=600, max_attempts=3):
+        WorkQueue.__init__(self, lease_seconds, max_attempts)
+        self.database = database
+        connection = self._connect()
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cases ("
+                "case_id TEXT NOT NULL, case_version TEXT NOT NULL, status TEXT NOT NULL, owner TEXT, "
+                "lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, patient_id TEXT, error TEXT, "
+                "PRIMARY KEY (case_id, case_version))")
+            connection.execute("CREATE INDEX IF NOT EXISTS cases_status ON cases (status, lease_expires)")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # autocommit mode, transactions are explicitly started where needed
+        return sqlite3.connect(self.database, timeout=60, isolation_level=None)
+
+    def add_cases(self, cases):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            added = 0
+            for case_id, case_version in cases:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO cases (case_id, case_version, status) VALUES (?, ?, ?)",
+                    (str(case_id), str(case_version), self.PENDING))
+                added += cursor.rowcount
+            connection.execute("COMMIT")
+            return added
+        finally:
+            connection.close()
+
+    def acquire(self, owner):
+        connection = self._connect()
+        try:
+            now = time.time()
+            connection.execute("BEGIN IMMEDIATE")
+            # a case whose worker died during its last attempt is not retried
+            connection.execute(
+                "UPDATE cases SET status = ?, lease_expires = NULL, error = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (self.FAILED, self.LEASE_EXPIRED, self.LEASED, now, self.max_attempts))
+            row = connection.execute(
+                "SELECT case_id, case_version FROM cases "
+                "WHERE status = ? OR (status = ? AND lease_expires < ?) LIMIT 1",
+                (self.PENDING, self.LEASED, now)).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE cases SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE case_id = ? AND case_version = ?",
+                    (self.LEASED, owner, now + self.lease_seconds, row[0], row[1]))
+            connection.execute("COMMIT")
+            return (row[0], row[1]) if row is not None else None
+        finally:
+            connection.close()
+
+    def _update_lease(self, case, owner, assignments, values):
+        connection = self._connect()
+        try:
+            cursor = connection.execute(
+                "UPDATE cases SET {} WHERE case_id = ? AND case_version = ? AND status = ? AND owner = ?".format(
+                    assignments),
+                tuple(values) + (case[0], case[1], self.LEASED, owner))
+            return cursor.rowcount == 1
+        finally:
+            connection.close()
+
+    def heartbeat(self, case, owner):
+        return self._update_lease(case, owner, "lease_expires = ?", [time.time() + self.lease_seconds])
+
+    def complete(self, case, owner, patient_id):
+        return self._update_lease(
+            case, owner, "status = ?, lease_expires = NULL, patient_id = ?, error = NULL",
+            [self.DONE, str(patient_id)])
+
+    def fail(self, case, owner, error):
+        return self._update_lease(
+            case, owner, "status = CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_expires = NULL, error = ?",
+            [self.max_attempts, self.FAILED, self.PENDING, str(error)])
+
+    def counts(self):
+        connection = self._connect()
+        try:
+            counts = {self.PENDING: 0, self.LEASED: 0, self.DONE: 0, self.FAILED: 0}
+            for status, count in connection.execute("SELECT status, count(*) FROM cases GROUP BY status"):
+                counts[status] = count
+            return counts
+        finally:
+            connection.close()
+
+
+class DirectoryWorkQueue(WorkQueue):
+    """
+    Work queue in a directory of a shared filesystem. Every case is a file moving between the folders pending,
+    leased, done and failed with atomic renames. A leased file is named after its owner and its modification time is
+    the last heartbeat.
+    """
+
+    OWNER_SEPARATOR = "@"
+
+    def __init__(self, directory, lease_seconds=600, max_attempts=3):
+        WorkQueue.__init__(self, lease_seconds, max_attempts)
+        self.directory = directory
+        for status in [self.PENDING, self.LEASED, self.DONE, self.FAILED]:
+            folder = os.path.join(self.directory, status)
+            if not os.path.exists(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # another worker created it meanwhile
+                    pass
+
+    @staticmethod
+    def _case_name(case):
+        return "{}-{}".format(case[0], case[1])
+
+    @staticmethod
+    def _parse_case_name(name):
+        case_id, case_version = name.split(DirectoryWorkQueue.OWNER_SEPARATOR)[0].rsplit("-", 1)
+        return case_id, case_version
+
+    def _path(self, status, case, owner=None):
+        name = self._case_name(case)
+        if owner is not None:
+            name = "{}{}{}".format(name, self.OWNER_SEPARATOR, owner)
+        return os.path.join(self.directory, status, name)
+
+    @staticmethod
+    def _read(path):
+        with open(path) as record:
+            content = record.read()
+        return json.loads(content) if content else {}
+
+    @staticmethod
+    def _write(path, record):
+        with open(path, "w") as output:
+            output.write(json.dumps(record))
+
+    def _move(self, source, target):
+        try:
+            os.rename(source, target)
+            return True
+        except OSError:
+            # somebody else moved it first
+            return False
+
+    def add_cases(self, cases):
+        existing = set(filename.split(self.OWNER_SEPARATOR)[0]
+                       for status in [self.PENDING, self.LEASED, self.DONE, self.FAILED]
+                       for filename in os.listdir(os.path.join(self.directory, status)))
+        added = 0
+        for case in cases:
+            name = self._case_name(case)
+            if name in existing:
+                continue
+            existing.add(name)
+            self._write(self._path(self.PENDING, case), {"attempts": 0})
+            added += 1
+        return added
+
+    def _reclaim_expired(self):
+        now = time.time()
+        leased_folder = os.path.join(self.directory, self.LEASED)
+        for filename in os.listdir(leased_folder):
+            path = os.path.join(leased_folder, filename)
+            try:
+                expired = os.path.getmtime(path) + self.lease_seconds < now
+            except OSError:
+                continue
+            if not expired:
+                continue
+            case = self._parse_case_name(filename)
+            try:
+                last_attempt = self._read(path).get("attempts", 0) >= self.max_attempts
+            except IOError:
+                # somebody else reclaimed it first
+                continue
+            if not last_attempt:
+                if self._move(path, self._path(self.PENDING, case)):
+                    logging.warning("Reclaimed expired lease {}".format(filename))
+            elif self._move(path, self._path(self.FAILED, case)):
+                # a case whose worker died during its last attempt is not retried
+                record = self._read(self._path(self.FAILED, case))
+                record["error"] = self.LEASE_EXPIRED
+                self._write(self._path(self.FAILED, case), record)
+                logging.error("Expired lease {} on the last attempt, the case failed".format(filename))
+
+    def acquire(self, owner):
+        self._reclaim_expired()
+        pending_folder = os.path.join(self.directory, self.PENDING)
+        for filename in sorted(os.listdir(pending_folder)):
+            case = self._parse_case_name(filename)
+            pending = os.path.join(pending_folder, filename)
+            leased = self._path(self.LEASED, case, owner)
+            try:
+                # renames keep the modification time, a fresh one avoids being reclaimed straight away
+                os.utime(pending, None)
+            except OSError:
+                continue
+            if self._move(pending, leased):
+                record = self._read(leased)
+                record["attempts"] = record.get("attempts", 0) + 1
+                # writing the record also refreshes the modification time
+                self._write(leased, record)
+                return case
+        return None
+
+    def heartbeat(self, case, owner):
+        try:
+            os.utime(self._path(self.LEASED, case, owner), None)
+            return True
+        except OSError:
+            return False
+
+    def complete(self, case, owner, patient_id):
+        leased = self._path(self.LEASED, case, owner)
+        try:
+            record = self._read(leased)
+        except IOError:
+            return False
+        record["patient_id"] = str(patient_id)
+        self._write(leased, record)
+        return self._move(leased, self._path(self.DONE, case))
+
+    def fail(self, case, owner, error):
+        leased = self._path(self.LEASED, case, owner)
+        try:
+            record = self._read(leased)
+        except IOError:
+            return False
+        record["error"] = str(error)
+        self._write(leased, record)
+        status = self.FAILED if record.get("attempts", 0) >= self.max_attempts else self.PENDING
+        return self._move(leased, self._path(status, case))
+
+    def counts(self):
+        return {status: len(os.listdir(os.path.join(self.directory, status)))
+                for status in [self.PENDING, self.LEASED, self.DONE, self.FAILED]}
+
+
+class _Heartbeat(threading.Thread):
+
+    def __init__(self, work_queue, case, owner, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.work_queue = work_queue
+        self.case = case
+        self.owner = owner
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                alive = self.work_queue.heartbeat(self.case, self.owner)
+            except Exception, ex:
+                # a transient error, the lease is still valid until it expires
+                logging.warning("Failed renewing the lease on case {}: {}".format(self.case, str(ex)))
+                continue
+            if not alive:
+                logging.error("Lost the lease on case {}".format(self.case))
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class QueueWorker(object):
+
+    def __init__(self, work_queue, send_case, owner=None):
+        """
+        Sends the cases in a work queue at its own pace until the queue is drained
+        :type work_queue: WorkQueue
+        :param send_case: a function receiving case id and version and returning the Decipher patient id
+        :param owner: the identifier of this worker, by default the host name and process id
+        """
+        self.work_queue = work_queue
+        self.send_case = send_case
+        self.owner = owner if owner is not None else WorkQueue.default_owner()
+        self.heartbeat_interval = work_queue.lease_seconds / 3.0
+
+    def process_case(self, case):
+        heartbeat = _Heartbeat(self.work_queue, case, self.owner, self.heartbeat_interval)
+        heartbeat.start()
+        try:
+            patient_id = self.send_case(case[0], case[1])
+        except Exception, ex:
+            heartbeat.stop()
+            logging.error("Failed sending case {}: {}".format(case, str(ex)))
+            self.work_queue.fail(case, self.owner, ex)
+            return False
+        heartbeat.stop()
+        if not self.work_queue.complete(case, self.owner, patient_id):
+            logging.error("Case {} was sent but its lease had been lost".format(case))
+        return True
+
+    def run(self, poll_seconds=None, stop=None):
+        """
+        :param poll_seconds: keeps polling the queue at this interval once drained instead of returning, errors
+        accessing the queue are then retried at the same interval
+        :param stop: an event stopping a polling worker after the case in progress
+        :type stop: threading.Event
+        :return: the number of cases sent by this worker
+        """
+        stop = stop if stop is not None else threading.Event()
+        sent = 0
+        while not stop.is_set():
+            # no case is leased during an outage of any upstream
+            wait_for_upstreams()
+            try:
+                case = self.work_queue.acquire(self.owner)
+                if case is not None and self.process_case(case):
+                    sent += 1
+            except Exception, ex:
+                if poll_seconds is None:
+                    raise
+                # eg: a locked database or an I/O error in the spool directory, a case leased meanwhile is
+                # reclaimed once its lease expires
+                logging.error("Worker {} failed accessing the queue: {}".format(self.owner, str(ex)))
+                stop.wait(poll_seconds)
+                continue
+            if case is None:
+                if poll_seconds is None:
+                    break
+                stop.wait(poll_seconds)
+        logging.info("Worker {} sent {} cases, queue status: {}".format(self.owner, sent, self.work_queue.counts()))
+        return sent
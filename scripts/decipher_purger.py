@@ -0,0 +1,35 @@
+#!/env/python
+import argparse
+import logging
+from datetime import datetime
+
+from gel2decipher.clients.decipher_client import DecipherClient
+from gel2decipher.project_purger import ProjectPurger
+
+
+def parse_date(date):
+    return datetime.strptime(date, "%Y-%m-%d")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Deletes the patients in a Decipher project')
+    parser.add_argument('--decipher-system-key', help="Decipher's system key", required=True)
+    parser.add_argument('--decipher-user-key', help="Decipher's user key", required=True)
+    parser.add_argument('--decipher-url', help="Decipher's URL", required=True)
+    parser.add_argument('--progress-file', help="Records the progress, a purge is resumed from this file",
+                        required=True)
+    parser.add_argument('--reference-prefix', help="Deletes only patients with a reference starting by this prefix")
+    parser.add_argument('--created-before', help="Deletes only patients created before this date (YYYY-MM-DD)",
+                        type=parse_date)
+    parser.add_argument('--workers', help="Number of concurrent deletions", type=int, default=4)
+    args = parser.parse_args()
+
+    decipher = DecipherClient(args.decipher_url, args.decipher_system_key, args.decipher_user_key)
+    purger = ProjectPurger(decipher, args.progress_file, workers=args.workers)
+    purger.purge(reference_prefix=args.reference_prefix, created_before=args.created_before)
+
+
+if __name__ == '__main__':
+    main()
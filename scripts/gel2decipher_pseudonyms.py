@@ -0,0 +1,53 @@
+#!/env/python
+import argparse
+import csv
+import logging
+import sys
+
+from gel2decipher.pseudonym_index import PseudonymIndex
+
+
+def read_records(import_file):
+    """
+    Reads tab separated participant_id, case_id and case_version with optional patient_id and project_id columns
+    """
+    with open(import_file) as records:
+        for row in csv.DictReader(records, delimiter="\t"):
+            yield (row['participant_id'], row['case_id'], row['case_version'], row.get('patient_id') or None,
+                   row.get('project_id') or None, None)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Looks up the pseudonyms of the cases sent to Decipher')
+    parser.add_argument('--pseudonym-index', help="The SQLite file written by gel2decipher_sender.py", required=True)
+    parser.add_argument('--import-file', help="Imports an existing cohort from a tab separated file with "
+                                              "participant_id, case_id, case_version and optionally patient_id and "
+                                              "project_id columns")
+    parser.add_argument('--case', help="Looks up a case as CASE_ID or CASE_ID:CASE_VERSION")
+    parser.add_argument('--participant', help="Looks up a GEL participant id")
+    parser.add_argument('--reference', help="Looks up a Decipher reference")
+    parser.add_argument('--patient-id', help="Looks up a Decipher patient id", type=int)
+    args = parser.parse_args()
+
+    index = PseudonymIndex(args.pseudonym_index)
+    if args.import_file:
+        index.import_records(read_records(args.import_file))
+    records = []
+    if args.case:
+        records += index.by_case(*args.case.split(":"))
+    if args.participant:
+        records += index.by_participant(args.participant)
+    if args.reference:
+        records += index.by_reference(args.reference)
+    if args.patient_id is not None:
+        records += index.by_patient_id(args.patient_id)
+    if records:
+        writer = csv.DictWriter(sys.stdout, fieldnames=PseudonymIndex.FIELDS, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(records)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,142 @@
 #!/env/python
 import argparse
 import logging
+from datetime import datetime
 
-from gel2decipher.case_sender import Gel2Decipher
+from gel2decipher.case_discovery import CaseDiscovery
+from gel2decipher.case_prescan import CasePreScan
+from gel2decipher.case_scheduler import CaseScheduler
+from gel2decipher.case_sender import Gel2Decipher, UnacceptableCase
+from gel2decipher.cohort_sender import CohortSender
+from gel2decipher.profiler import DeterministicProfiler, SamplingProfiler
+from gel2decipher.work_queue import SqliteWorkQueue, DirectoryWorkQueue, QueueWorker
+from gel2decipher.sender_daemon import SenderDaemon
+from gel2decipher.clients.circuit_breaker import CircuitOpen, breakers_stats, wait_for_upstreams
+from gel2decipher.clients.deadline import DeadlineExceeded
+
+
+def parse_case(case):
+    case_id, case_version = case.split(":")
+    return case_id, case_version
+
+
+def parse_date(date):
+    return datetime.strptime(date, "%Y-%m-%d")
 
 
 def main():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser(description='Loader from the CIPAPI to CVA')
-    parser.add_argument('--cipapi-url', help='The URL for the CIPAPI', required=True)
-    parser.add_argument('--cva-url', help='The URL for CVA', required=True)
-    parser.add_argument('--gel-user', help='The user for GEL', required=True)
-    parser.add_argument('--gel-password', help='The password for GEL', required=True)
-    parser.add_argument('--decipher-system-key', help="Decipher's system key", required=True)
-    parser.add_argument('--decipher-user-key', help="Decipher's user key", required=True)
-    parser.add_argument('--decipher-url', help="Decipher's URL", required=True)
+    parser.add_argument('--cipapi-url', help='The URL for the CIPAPI')
+    parser.add_argument('--cva-url', help='The URL for CVA')
+    parser.add_argument('--gel-user', help='The user for GEL')
+    parser.add_argument('--gel-password', help='The password for GEL')
+    parser.add_argument('--snapshot-dir', help="Reads cases and report events from local dumps of the CIPAPI and CVA "
+                                               "instead, no GEL credentials are needed")
+    parser.add_argument('--decipher-system-key', help="Decipher's system key")
+    parser.add_argument('--decipher-user-key', help="Decipher's user key")
+    parser.add_argument('--decipher-url', help="Decipher's URL")
+    parser.add_argument('--decipher-project-id', help="The Decipher project of the patients, by default the project "
+                                                      "of the Decipher keys", type=int)
+    parser.add_argument('--decipher-user-id', help="The Decipher user of the patients, by default the user of the "
+                                                   "Decipher keys", type=int)
     parser.add_argument('--send-absent-phenotypes', help="Flag to send absent phenotypes", action='store_true')
+    parser.add_argument('--hpo-obo', help="HPO ontology in OBO format, unknown and obsolete terms are not sent")
+    parser.add_argument('--migrate-hpo-terms', help="Sends the replacement of obsolete HPO terms", action='store_true')
+    parser.add_argument('--transcript-cache', help="SQLite file caching the transcripts selected for each variant "
+                                                   "across cases")
+    parser.add_argument('--annotation-version', help="Version of the annotations, cached transcripts are only reused "
+                                                     "within the same version, required with --transcript-cache")
+    parser.add_argument('--pseudonym-index', help="SQLite file recording the participant, reference and Decipher "
+                                                  "patient of every case sent, see gel2decipher_pseudonyms.py")
+    parser.add_argument('--mirror-project', help="Indexes the Decipher project locally so existing patients are "
+                                                 "updated instead of failing", action='store_true')
+    parser.add_argument('--compress-decipher-requests', help="Gzips large request bodies sent to Decipher",
+                        action='store_true')
+    parser.add_argument('--decipher-compression-threshold', help="Size in bytes from which request bodies sent to "
+                                                                 "Decipher are gzipped", type=int, default=1024)
+    parser.add_argument('--cva-accept-encoding', help="Encodings accepted in CVA responses, identity disables "
+                                                      "compression", default="gzip, deflate")
+    parser.add_argument('--decipher-accept-encoding', help="Encodings accepted in Decipher responses, identity "
+                                                           "disables compression", default="gzip, deflate")
+    parser.add_argument('--case-deadline', help="Seconds given to send every case, a case running out of time is "
+                                                "failed and a patient it created in Decipher is deleted", type=float)
+    parser.add_argument('--cva-timeout', help="Connect and read timeouts in seconds for CVA requests",
+                        nargs=2, type=float, default=[10, 120])
+    parser.add_argument('--decipher-timeout', help="Connect and read timeouts in seconds for Decipher requests",
+                        nargs=2, type=float, default=[10, 120])
+    parser.add_argument('--hedge-percentile', help="Sends a second GET request to CVA or Decipher when the first has "
+                                                   "not answered within this percentile of recent latencies",
+                        type=float)
+    parser.add_argument('--hedge-max-extra-load', help="Maximum ratio of hedged requests to requests", type=float,
+                        default=0.05)
+    parser.add_argument('--breaker-failure-rate', help="Ratio of failed requests opening the circuit to CVA or "
+                                                       "Decipher, requests fail fast while it is open", type=float)
+    parser.add_argument('--breaker-open-seconds', help="Seconds the circuit stays open before probing the upstream",
+                        type=float)
+    parser.add_argument('--record', help="Records the CVA and Decipher traffic into this cassette file")
+    parser.add_argument('--replay', help="Replays the CVA and Decipher traffic from this cassette file instead of "
+                                         "sending any request, use with --snapshot-dir to run offline")
+    parser.add_argument('--pre-scan', help="Checks the cases with report events fetched without annotations, writes "
+                                           "a go/no-go table in this file and only sends the cases that can be sent")
+    parser.add_argument('--pre-scan-only', help="Stops after writing the go/no-go table", action='store_true')
+    parser.add_argument('--shortest-first', help="Sends the cases with the fewest members, HPO terms and report "
+                                                 "events first, the sizes are taken from --pre-scan",
+                        action='store_true')
+    parser.add_argument('--huge-case-cost', help="Cases with a larger estimated cost are fetched first by "
+                                                 "--huge-lane-workers dedicated threads", type=float)
+    parser.add_argument('--huge-lane-workers', help="Number of fetch threads serving huge cases first", type=int,
+                        default=1)
+    parser.add_argument('--cases', help="The cases to send as CASE_ID:CASE_VERSION, if not provided cases are "
+                                        "discovered in the CIPAPI", nargs='+', type=parse_case)
+    parser.add_argument('--status', help="Discovers cases having this last status")
+    parser.add_argument('--programme', help="Discovers cases in this programme (eg: rare_disease)")
+    parser.add_argument('--from-date', help="Discovers cases modified after this date (YYYY-MM-DD)", type=parse_date)
+    parser.add_argument('--to-date', help="Discovers cases modified before this date (YYYY-MM-DD)", type=parse_date)
+    parser.add_argument('--mapping-processes', help="Maps the cases in this number of processes", type=int)
+    parser.add_argument('--fetch-workers', help="Number of threads fetching cases", type=int, default=4)
+    parser.add_argument('--upload-workers', help="Number of threads uploading cases", type=int, default=2)
+    parser.add_argument('--max-cases-in-flight', help="Maximum number of cases fetched and not yet uploaded, by "
+                                                      "default twice the number of workers", type=int)
+    parser.add_argument('--max-cost-in-flight', help="Maximum sum of the estimated costs of the cases fetched and not "
+                                                     "yet uploaded, the costs are taken from --pre-scan", type=float)
+    parser.add_argument('--queue-size', help="Capacity of the queues between fetching, mapping and uploading", type=int)
+    parser.add_argument('--map-timeout', help="Seconds given to map a case, a case whose mapping process died fails "
+                                              "after them", type=float, default=600)
+    parser.add_argument('--work-queue', help="Shares the cases with other senders through a work queue in this "
+                                             "SQLite file or directory")
+    parser.add_argument('--work-queue-backend', help="Use a SQLite database for several processes in one node or a "
+                                                     "directory in a shared filesystem for several nodes",
+                        choices=['sqlite', 'directory'], default='sqlite')
+    parser.add_argument('--lease-seconds', help="Time a case is leased without heartbeats", type=int, default=600)
+    parser.add_argument('--daemon', help="Keeps running and sends the cases submitted to the work queue with "
+                                         "gel2decipher_submit.py until SIGTERM", action='store_true')
+    parser.add_argument('--daemon-workers', help="Number of threads sending cases in the daemon", type=int, default=4)
+    parser.add_argument('--poll-seconds', help="Interval at which the daemon looks for new cases", type=float,
+                        default=5)
+    parser.add_argument('--profile', help="Profiles every case with cProfile writing pstats files, or samples the "
+                                          "stacks writing merged collapsed stacks for flame graphs",
+                        choices=['deterministic', 'sampling'])
+    parser.add_argument('--profile-output', help="Directory for the pstats files or file for the collapsed stacks",
+                        default="profiles")
     args = parser.parse_args()
+    if not args.snapshot_dir and not (args.cipapi_url and args.cva_url and args.gel_user and args.gel_password):
+        parser.error("--cipapi-url, --cva-url, --gel-user and --gel-password are required without --snapshot-dir")
+    decipher_ids = args.decipher_project_id is not None and args.decipher_user_id is not None
+    if not (args.decipher_url and args.decipher_system_key and args.decipher_user_key) \
+            and not (args.pre_scan_only and decipher_ids):
+        parser.error("--decipher-url, --decipher-system-key and --decipher-user-key are required, unless only "
+                     "pre-scanning with --decipher-project-id and --decipher-user-id")
+    if args.transcript_cache and not args.annotation_version:
+        parser.error("--transcript-cache requires --annotation-version")
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be used together")
+    if args.daemon and not args.work_queue:
+        parser.error("--daemon requires --work-queue")
+    if (args.shortest_first or args.huge_case_cost is not None or args.max_cost_in_flight is not None) \
+            and not args.pre_scan:
+        parser.error("--shortest-first, --huge-case-cost and --max-cost-in-flight require --pre-scan")
 
     config = {
         "cipapi_url": args.cipapi_url,
@@ -27,10 +146,99 @@ def main():
         "decipher_system_key": args.decipher_system_key,
         "decipher_user_key": args.decipher_user_key,
         "decipher_url": args.decipher_url,
-        "send_absent_phenotypes": args.send_absent_phenotypes
+        "decipher_project_id": args.decipher_project_id,
+        "decipher_user_id": args.decipher_user_id,
+        "snapshot_dir": args.snapshot_dir,
+        "send_absent_phenotypes": args.send_absent_phenotypes,
+        "decipher_compress_requests": args.compress_decipher_requests,
+        "decipher_compression_threshold": args.decipher_compression_threshold,
+        "cva_accept_encoding": args.cva_accept_encoding,
+        "decipher_accept_encoding": args.decipher_accept_encoding,
+        "hpo_obo": args.hpo_obo,
+        "migrate_hpo_terms": args.migrate_hpo_terms,
+        "transcript_cache": args.transcript_cache,
+        "annotation_version": args.annotation_version,
+        "mirror_project": args.mirror_project,
+        "pseudonym_index": args.pseudonym_index,
+        "case_deadline": args.case_deadline,
+        "cva_timeout": args.cva_timeout,
+        "decipher_timeout": args.decipher_timeout,
+        "hedge_percentile": args.hedge_percentile,
+        "hedge_max_extra_load": args.hedge_max_extra_load,
+        "breaker_failure_rate": args.breaker_failure_rate,
+        "breaker_open_seconds": args.breaker_open_seconds,
+        "record_cassette": args.record,
+        "replay_cassette": args.replay
     }
     loader = Gel2Decipher(config)
-    loader.send_case()
+    if args.profile == 'deterministic':
+        loader.set_profiler(DeterministicProfiler(args.profile_output))
+    elif args.profile == 'sampling':
+        loader.set_profiler(SamplingProfiler(args.profile_output))
+    loader.profiler.start()
+    try:
+        if args.daemon:
+            work_queue = SqliteWorkQueue(args.work_queue, lease_seconds=args.lease_seconds) \
+                if args.work_queue_backend == 'sqlite' else \
+                DirectoryWorkQueue(args.work_queue, lease_seconds=args.lease_seconds)
+            if args.cases:
+                logging.info("Added {} cases to the work queue".format(work_queue.add_cases(args.cases)))
+            SenderDaemon(loader, work_queue, workers=args.daemon_workers,
+                         poll_seconds=args.poll_seconds).serve_forever()
+            return
+        cases = args.cases
+        if not cases and loader.snapshot is not None:
+            cases = loader.snapshot.list_cases()
+        elif not cases:
+            cases = CaseDiscovery(loader.cipapi).discover_cases(
+                status=args.status, programme=args.programme, from_date=args.from_date, to_date=args.to_date)
+        scheduler = CaseScheduler()
+        if args.pre_scan:
+            rows = CasePreScan(loader, workers=args.fetch_workers).scan(cases)
+            CasePreScan.write_table(rows, args.pre_scan)
+            cases = CasePreScan.go_cases(rows)
+            if args.pre_scan_only:
+                return
+            if args.shortest_first or args.huge_case_cost is not None or args.max_cost_in_flight is not None:
+                scheduler = CaseScheduler(CaseScheduler.costs_from_pre_scan(rows), huge_cost=args.huge_case_cost,
+                                          shortest_first=args.shortest_first)
+        if args.work_queue:
+            if args.work_queue_backend == 'sqlite':
+                work_queue = SqliteWorkQueue(args.work_queue, lease_seconds=args.lease_seconds)
+            else:
+                work_queue = DirectoryWorkQueue(args.work_queue, lease_seconds=args.lease_seconds)
+            logging.info("Added {} cases to the work queue".format(work_queue.add_cases(cases)))
+            QueueWorker(work_queue, loader.send_case).run()
+        elif args.mapping_processes:
+            cohort_sender = CohortSender(loader, fetch_workers=args.fetch_workers,
+                                         mapping_processes=args.mapping_processes, upload_workers=args.upload_workers,
+                                         scheduler=scheduler, huge_lane_workers=args.huge_lane_workers,
+                                         max_cases_in_flight=args.max_cases_in_flight,
+                                         max_cost_in_flight=args.max_cost_in_flight, queue_size=args.queue_size,
+                                         map_timeout=args.map_timeout)
+            for case_id, case_version, patient_id, error in cohort_sender.send_cases(cases):
+                if error is not None:
+                    logging.error("Case {} version {} was not sent: {}".format(case_id, case_version, str(error)))
+                else:
+                    logging.info("Case {} version {} sent as patient {}".format(case_id, case_version, patient_id))
+        else:
+            scheduler.add_cases(cases)
+            for case_id, case_version in scheduler:
+                wait_for_upstreams()
+                try:
+                    patient_id = loader.send_case(case_id, case_version)
+                    logging.info("Case {} version {} sent as patient {}".format(case_id, case_version, patient_id))
+                except (UnacceptableCase, CircuitOpen, DeadlineExceeded), ex:
+                    logging.error("Case {} version {} was not sent: {}".format(case_id, case_version, str(ex)))
+    finally:
+        # the profiles and the cassette are written even if the run fails
+        loader.profiler.stop()
+        if loader.transport is not None:
+            loader.transport.save()
+
+    logging.info("Circuit breakers: {}".format(breakers_stats()))
+    if loader.transcript_cache is not None:
+        loader.transcript_cache.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,32 @@
+#!/env/python
+import argparse
+import logging
+
+from gel2decipher.work_queue import SqliteWorkQueue, DirectoryWorkQueue
+
+
+def parse_case(case):
+    case_id, case_version = case.split(":")
+    return case_id, case_version
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Submits cases to a running gel2decipher_sender.py --daemon')
+    parser.add_argument('--work-queue', help="The SQLite file or directory of the daemon's work queue", required=True)
+    parser.add_argument('--work-queue-backend', help="Use a SQLite database or a directory",
+                        choices=['sqlite', 'directory'], default='sqlite')
+    parser.add_argument('--cases', help="The cases to send as CASE_ID:CASE_VERSION", nargs='+', type=parse_case,
+                        required=True)
+    args = parser.parse_args()
+
+    if args.work_queue_backend == 'sqlite':
+        work_queue = SqliteWorkQueue(args.work_queue)
+    else:
+        work_queue = DirectoryWorkQueue(args.work_queue)
+    logging.info("Submitted {} cases, queue status: {}".format(work_queue.add_cases(args.cases), work_queue.counts()))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,8 @@ setup(
     name='gel2decipher',
     version='0.1.0',
     packages=find_packages(),
-    scripts=['scripts/gel2decipher_sender.py'],
+    scripts=['scripts/gel2decipher_sender.py', 'scripts/gel2decipher_submit.py',
+             'scripts/gel2decipher_pseudonyms.py', 'scripts/decipher_purger.py'],
     url='',
     license='',
     author='priesgo',
@@ -18,6 +19,7 @@ setup(
         'pycipapi==0.1.0',
         'pyark==0.1.0',
         'booby==0.7.0',
-        'enum34'
+        'enum34',
+        'numpy<1.17'
     ]
 )